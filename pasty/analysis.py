@@ -0,0 +1,54 @@
+"""Facts about a file's content which are worked out once, when the file is
+saved, and stored on the PastyFile.
+
+Each step is a single scan done in C (encoding, hashing, counting and a
+regular expression), rather than iterating over lines in Python.
+"""
+import collections
+import hashlib
+import re
+
+
+#: Content with a NUL byte in this many bytes at the start is binary, the
+#: same test git uses.
+BINARY_CHECK_BYTES = 8000
+
+#: Lines and bytes at the start kept for guessing the language.
+HEAD_LINES = 10
+HEAD_BYTES = 10 * 256
+
+Analysis = collections.namedtuple(
+    'Analysis', 'data size content_hash num_lines is_binary head')
+
+
+def analyze(content):
+    """Returns an Analysis for a unicode or UTF-8 encoded string.
+
+    data is the content as bytes, and head is the first few lines as unicode.
+    """
+    data = content.encode('utf-8') if isinstance(content, unicode) else content
+    num_lines = data.count(b'\n')
+
+    if data and not data.endswith(b'\n'):
+        num_lines += 1
+
+    head = lines_pattern(HEAD_LINES).match(data)
+    head = data[:head.end() if head else len(data)][:HEAD_BYTES]
+
+    return Analysis(
+        data=data,
+        size=len(data),
+        content_hash=hashlib.sha1(data).hexdigest(),
+        num_lines=num_lines,
+        is_binary=b'\x00' in data[:BINARY_CHECK_BYTES],
+        # The slice may split a character.
+        head=head.decode('utf-8', 'ignore'),
+    )
+
+
+def lines_pattern(count):
+    """Returns a pattern matching count whole lines. The re module caches
+    compiled patterns.
+    """
+    return re.compile(br'(?:[^\n]*\n){%d}' % count)
+
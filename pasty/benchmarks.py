@@ -0,0 +1,261 @@
+"""Benchmarks for the expensive parts of creating and showing pastes.
+
+These run against the App Engine service stubs used by the tests, so the
+numbers are for our own code rather than the real datastore or Cloud Storage.
+Memcache is flushed before each timed run, so results cached by one run
+(e.g. tokens or rendered pages) aren't what the next run measures. Run them
+with `./manage.py benchmark`.
+"""
+import collections
+import platform
+import time
+
+from django.test import Client
+from django.urls import reverse
+from google.appengine.api import memcache
+
+from . import analysis
+from . import index
+from . import utils
+from .models import LexerConfig, Paste
+
+
+#: Mapping of {<name>: <setup function>}. Calling the setup function returns
+#: the function to time. Setup functions make their own input, so large
+#: content is only built for the benchmarks which are run.
+BENCHMARKS = collections.OrderedDict()
+
+#: Sizes in bytes for the content benchmarks.
+SIZES = [('1k', 1024), ('10k', 10 * 1024), ('100k', 100 * 1024)]
+
+SAMPLES = {
+    'example.py': (
+        u'import os\n\n\n'
+        u'class Example(object):\n'
+        u'    """A docstring."""\n'
+        u'    def method(self, value=None):\n'
+        u'        # A comment.\n'
+        u'        return os.path.join(u"foo", str(value), *[1, 2.5])\n\n\n'
+    ),
+    'example.js': (
+        u'function example(value) {\n'
+        u'\t"use strict";\n'
+        u'\tvar items = [1, 2.5, "three"]; // A comment.\n'
+        u'\treturn items.map(function(x) { return x + value; });\n'
+        u'}\n\n'
+    ),
+    'example.css': (
+        u'.example > a:hover, #example {\n'
+        u'\tfont-family: "Helvetica", sans-serif;\n'
+        u'\tmargin: 0 auto 10px; /* A comment. */\n'
+        u'\tcolor: #ff0000;\n'
+        u'}\n\n'
+    ),
+    'example.html': (
+        u'<div class="example" id="example">\n'
+        u'\t<a href="/foo/?bar=baz&amp;x=1">Link</a>\n'
+        u'\t<!-- A comment. -->\n'
+        u'\t<script>var x = 1;</script>\n'
+        u'</div>\n'
+    ),
+    'example.txt': (
+        u'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do\n'
+        u'eiusmod tempor incididunt ut labore et dolore magna aliqua.\n\n'
+    ),
+}
+
+
+def make_content(filename, size):
+    """Returns sample content for the file type, size characters long."""
+    sample = SAMPLES[filename]
+    repeat = (size // len(sample)) + 1
+
+    return (sample * repeat)[:size]
+
+
+def benchmark(name):
+    """Decorator to register a benchmark setup function."""
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+
+        return setup
+
+    return decorator
+
+
+def _register_content_benchmarks():
+    for filename in sorted(SAMPLES):
+        for size_name, size in SIZES:
+            suffix = '[%s-%s]' % (filename, size_name)
+
+            def choose_with_filename(filename=filename, size=size):
+                content = make_content(filename, size)
+
+                return lambda: utils.choose_lexer(content, filename=filename)
+
+            def choose_without_filename(filename=filename, size=size):
+                content = make_content(filename, size)
+
+                return lambda: utils.choose_lexer(content)
+
+            def highlight(filename=filename, size=size):
+                content = make_content(filename, size)
+
+                return lambda: utils.highlight_content(content, filename=filename)
+
+            def summarize(filename=filename, size=size):
+                content = make_content(filename, size)
+
+                return lambda: utils.summarize_content(content, filename=filename)
+
+            benchmark('choose_lexer' + suffix)(choose_with_filename)
+            benchmark('choose_lexer_guess' + suffix)(choose_without_filename)
+            benchmark('highlight_content' + suffix)(highlight)
+            benchmark('summarize_content' + suffix)(summarize)
+
+    for size_name, size in SIZES + [('1m', 1024 * 1024), ('4m', 4 * 1024 * 1024)]:
+        def count(size=size):
+            content = make_content('example.txt', size)
+
+            return lambda: utils.count_lines(content)
+
+        def analyze(size=size):
+            content = make_content('example.py', size)
+
+            return lambda: analysis.analyze(content)
+
+        benchmark('count_lines[%s]' % size_name)(count)
+        benchmark('analyze[%s]' % size_name)(analyze)
+
+
+def make_files(num_files, size=2 * 1024):
+    filenames = sorted(SAMPLES)
+    files = []
+
+    for n in range(num_files):
+        filename = filenames[n % len(filenames)]
+        files.append((filename, make_content(filename, size)))
+
+    return files
+
+
+def _register_paste_benchmarks():
+    for num_files in [1, 5, 10, 50]:
+        def create(num_files=num_files):
+            files = make_files(num_files)
+
+            return lambda: Paste.create_with_files(files=files)
+
+        benchmark('create_with_files[%d]' % num_files)(create)
+
+    @benchmark('create_document_for_paste[10]')
+    def create_document():
+        paste = Paste.create_with_files(files=make_files(10))
+
+        return lambda: index.create_document_for_paste(paste)
+
+    @benchmark('view_paste_detail[10]')
+    def view_paste_detail():
+        LexerConfig.get()
+        paste = Paste.create_with_files(files=make_files(10))
+        url = reverse('paste_detail', args=[paste.key.id()])
+        client = Client()
+
+        return lambda: client.get(url)
+
+    @benchmark('view_paste_list')
+    def view_paste_list():
+        for n in range(15):
+            paste = Paste.create_with_files(files=make_files(2))
+            index.add_paste(paste)
+
+        url = reverse('paste_list')
+        client = Client()
+
+        return lambda: client.get(url)
+
+
+_register_content_benchmarks()
+_register_paste_benchmarks()
+
+
+def time_function(func, repeat, before=None):
+    """Returns a list of run times for the function, in milliseconds. before
+    is called ahead of each run, and isn't timed.
+    """
+    timings = []
+
+    for _ in range(repeat):
+        if before is not None:
+            before()
+
+        started = time.time()
+        func()
+        timings.append((time.time() - started) * 1000)
+
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+    else:
+        return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmarks(names=None, repeat=5):
+    """Runs the benchmarks, each with fresh service stubs, and returns a dict
+    of results which can be saved as JSON.
+    """
+    # Imported here because the tests package imports test-only libraries.
+    from .tests import activate_testbed
+
+    if names is None:
+        names = list(BENCHMARKS)
+    results = collections.OrderedDict()
+
+    for name in names:
+        bed = activate_testbed()
+
+        try:
+            func = BENCHMARKS[name]()
+            # One run to warm caches, e.g. Pygments loading lexer modules.
+            func()
+            timings = time_function(func, repeat, before=memcache.flush_all)
+        finally:
+            bed.deactivate()
+
+        results[name] = {
+            'min_ms': round(min(timings), 3),
+            'median_ms': round(median(timings), 3),
+            'max_ms': round(max(timings), 3),
+            'runs': repeat,
+        }
+
+    return {
+        'python': platform.python_version(),
+        'benchmarks': results,
+    }
+
+
+def compare(results, baseline, threshold=0.2):
+    """Returns a list of (name, baseline_ms, result_ms, ratio) for benchmarks
+    whose median time is more than threshold slower than the baseline.
+    """
+    regressions = []
+    baseline = baseline['benchmarks']
+
+    for name, result in results['benchmarks'].items():
+        if name not in baseline:
+            continue
+
+        before, after = baseline[name]['median_ms'], result['median_ms']
+        ratio = (after / before) if before else 1.0
+
+        if ratio > (1 + threshold):
+            regressions.append((name, before, after, ratio))
+
+    return regressions
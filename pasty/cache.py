@@ -0,0 +1,198 @@
+"""Caching for expensive values like highlighted file content.
+
+When a value isn't cached, only one caller makes it at a time. Other
+threads in the instance wait for that caller's result, and other instances
+wait on a lease in memcache, so a popular new paste is rendered once rather
+than once per request.
+
+Values too large for a memcache entry are compressed and split into chunks.
+"""
+import collections
+import threading
+import time
+import uuid
+import zlib
+
+from google.appengine.api import memcache
+
+
+CACHE_TTL = 24 * 60 * 60
+#: Seconds to keep the stale copy. It can be from an older render version or
+#: lexer config, so it is only kept long enough to cover a re-render.
+STALE_TTL = 10 * 60
+#: Seconds another instance may hold the lease before we render anyway.
+LEASE_TTL = 10
+#: Seconds to wait for another instance, and how often to check.
+LEASE_WAIT = 3
+LEASE_POLL = 0.1
+#: Memcache refuses values of 1 MB or more.
+MAX_VALUE_SIZE = 1000 * 1000 - 1024
+#: Most chunks for a large value, keeping a set_multi call under its 32 MB
+#: limit.
+MAX_CHUNKS = 30
+
+#: Stored at the key of a large value. The compressed value is in chunks at
+#: '<prefix>:<n>'. The prefix is unique, so chunks from another write of the
+#: same key are never mixed in.
+Chunked = collections.namedtuple('Chunked', 'prefix count is_unicode')
+
+
+class NotCacheable(object):
+    """Stored at the key of a value too large even for chunks, so instances
+    waiting for it render it themselves straight away.
+    """
+
+_lock = threading.Lock()
+_in_flight = {}
+
+
+class Flight(object):
+    """The result of a call which other threads are waiting for."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+def get_or_set(key, func, stale_key=None):
+    """Returns the cached value for key, or calls func() to make it and caches
+    that. stale_key is for a copy which can be shown while waiting for
+    another instance to make the value, e.g. from an older render version.
+    """
+    value = _get(key)
+
+    if value is not None:
+        return value
+
+    with _lock:
+        flight = _in_flight.get(key)
+        leader = flight is None
+
+        if leader:
+            flight = _in_flight[key] = Flight()
+
+    if not leader:
+        return flight.wait()
+
+    try:
+        flight.value = _get_or_set_with_lease(key, func, stale_key)
+    except Exception as err:
+        flight.error = err
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+
+        flight.done.set()
+
+    return flight.value
+
+
+def _get_or_set_with_lease(key, func, stale_key):
+    lease_key = 'lease:' + key
+    have_lease = memcache.add(lease_key, 1, time=LEASE_TTL)
+
+    if not have_lease:
+        value = _wait_for_value(key, stale_key)
+
+        if value is not None:
+            return value
+
+    try:
+        value = func()
+        _cache_value(key, value, stale_key)
+    finally:
+        # Only release our own lease. If we gave up waiting, the lease is
+        # still another instance's.
+        if have_lease:
+            memcache.delete(lease_key)
+
+    return value
+
+
+def _wait_for_value(key, stale_key):
+    """Returns a stale copy if there is one, otherwise waits for another
+    instance to cache the value. Returns None if we give up waiting.
+    """
+    if stale_key:
+        value = _get(stale_key)
+
+        if value is not None:
+            return value
+
+    deadline = time.time() + LEASE_WAIT
+
+    while time.time() < deadline:
+        time.sleep(LEASE_POLL)
+        value = memcache.get(key)
+
+        if isinstance(value, NotCacheable):
+            return None
+
+        value = _get_chunks(value)
+
+        if value is not None:
+            return value
+
+
+def _get(key):
+    """Returns the value at key, joining it from chunks if it was large, or
+    None if it isn't cached.
+    """
+    value = memcache.get(key)
+
+    if isinstance(value, NotCacheable):
+        return None
+
+    return _get_chunks(value)
+
+
+def _get_chunks(value):
+    """Returns the value for a Chunked, or the value as it is otherwise.
+    Returns None if any chunk is missing.
+    """
+    if not isinstance(value, Chunked):
+        return value
+
+    keys = ['%s:%d' % (value.prefix, n) for n in range(value.count)]
+    chunks = memcache.get_multi(keys)
+
+    if len(chunks) < len(keys):
+        return None
+
+    data = zlib.decompress(b''.join(chunks[k] for k in keys))
+
+    return data.decode('utf-8') if value.is_unicode else data
+
+
+def _cache_value(key, value, stale_key):
+    is_unicode = isinstance(value, unicode)
+    data = value.encode('utf-8') if is_unicode else value
+
+    if len(data) <= MAX_VALUE_SIZE:
+        entries = {key: value}
+    else:
+        data = zlib.compress(data)
+        prefix = '%s:%s' % (key, uuid.uuid4().hex)
+        chunks = [data[n:n + MAX_VALUE_SIZE] for n in range(0, len(data), MAX_VALUE_SIZE)]
+
+        if len(chunks) > MAX_CHUNKS:
+            memcache.set(key, NotCacheable(), time=LEASE_TTL)
+            return
+
+        entries = {'%s:%d' % (prefix, n): chunk for n, chunk in enumerate(chunks)}
+        entries[key] = Chunked(prefix, len(chunks), is_unicode)
+
+    memcache.set_multi(entries, time=CACHE_TTL)
+
+    if stale_key:
+        # Chunks outlive the stale copy, so it can refer to them too.
+        memcache.set(stale_key, entries[key], time=STALE_TTL)
@@ -0,0 +1,195 @@
+"""Helpers for storing file content gzipped in Cloud Storage, and for
+compressing responses.
+"""
+import gzip
+import io
+import struct
+import time
+import zipfile
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # Optional, responses are gzipped without it.
+    brotli = None
+
+
+GZIP = 'gzip'
+BROTLI = 'br'
+COMPRESS_LEVEL = 6
+BEST_COMPRESS_LEVEL = 9
+BROTLI_QUALITY = 5
+BEST_BROTLI_QUALITY = 11
+
+# Flags in the gzip header (RFC 1952).
+FHCRC, FEXTRA, FNAME, FCOMMENT = 2, 4, 8, 16
+#: A gzip header with no flags or timestamp, for an unknown OS.
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def gzip_bytes(data, level=COMPRESS_LEVEL):
+    """Returns the data compressed in gzip format. The header has no name
+    or timestamp, so the same data always gives the same bytes.
+    """
+    buf = io.BytesIO()
+
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=level, mtime=0) as fh:
+        fh.write(data)
+
+    return buf.getvalue()
+
+
+def gunzip_bytes(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def open_gzip(fh):
+    """Returns a file object which decompresses as it reads from fh. Closing
+    it closes fh too.
+    """
+    gzip_file = gzip.GzipFile(mode='rb', fileobj=fh)
+    # GzipFile closes myfileobj, normally the file it opened itself.
+    gzip_file.myfileobj = fh
+
+    return gzip_file
+
+
+def split_gzip(data):
+    """Returns (deflated, crc, size) for a single member gzip file: the raw
+    deflate stream, the CRC-32 and size of the uncompressed data.
+    """
+    if data[:3] != b'\x1f\x8b\x08':
+        raise ValueError('Not gzip data')
+
+    flags = ord(data[3:4])
+    offset = 10
+
+    if flags & FEXTRA:
+        extra_length, = struct.unpack('<H', data[offset:offset + 2])
+        offset += 2 + extra_length
+
+    for flag in (FNAME, FCOMMENT):
+        if flags & flag:
+            offset = data.index(b'\x00', offset) + 1
+
+    if flags & FHCRC:
+        offset += 2
+
+    crc, size = struct.unpack('<II', data[-8:])
+
+    return data[offset:-8], crc, size
+
+
+def deflate_fragment(data, level=BEST_COMPRESS_LEVEL):
+    """Returns the data as raw deflate blocks which can be put anywhere in a
+    deflate stream, see gzip_with_fragments(). The blocks end with a sync
+    flush rather than a final block, and refer to nothing before them.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def gzip_with_fragments(data, fragments, level=COMPRESS_LEVEL):
+    """Returns the data compressed in gzip format, using already deflated
+    copies of parts of it so only the rest is compressed here. fragments is
+    a list of (<bytes>, <deflate_fragment() of the bytes>), in the order they
+    appear in the data. Fragments not found in the data are skipped.
+    """
+    chunks = [GZIP_HEADER]
+    position = 0
+
+    for fragment, deflated in fragments:
+        start = data.find(fragment, position) if fragment else -1
+
+        if start == -1:
+            continue
+
+        chunks.append(deflate_fragment(data[position:start], level=level))
+        chunks.append(deflated)
+        position = start + len(fragment)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    chunks.append(compressor.compress(data[position:]) + compressor.flush())
+    chunks.append(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+
+    return b''.join(chunks)
+
+
+def write_deflated(archive, name, deflated, crc, size):
+    """Adds an entry to a ZipFile from an already deflated stream, avoiding
+    decompressing and compressing it again.
+    """
+    zinfo = zipfile.ZipInfo(filename=name, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = size
+    zinfo.compress_size = len(deflated)
+    zinfo.CRC = crc
+    zinfo.header_offset = archive.fp.tell()
+
+    archive._writecheck(zinfo)
+    archive._didModify = True
+
+    zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+    archive.fp.write(zinfo.FileHeader(zip64))
+    archive.fp.write(deflated)
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+
+
+def supported_encodings():
+    """Returns the encodings we can compress with, best first."""
+    return (BROTLI, GZIP) if brotli else (GZIP,)
+
+
+def parse_accept_encoding(header):
+    """Returns a dict of {<encoding>: <quality>} for an Accept-Encoding
+    header.
+    """
+    accepted = {}
+
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        params = params.strip()
+        quality = 1.0
+
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+
+        if name:
+            accepted[name] = quality
+
+    return accepted
+
+
+def accepts(header, encoding):
+    accepted = parse_accept_encoding(header)
+
+    return accepted.get(encoding, accepted.get('*', 0)) > 0
+
+
+def accepted_encoding(header):
+    """Returns the best encoding we support from an Accept-Encoding header,
+    or None if the client accepts none of them.
+    """
+    for encoding in supported_encodings():
+        if accepts(header, encoding):
+            return encoding
+
+
+def compress(data, encoding, best=False):
+    """Returns the data compressed with 'gzip' or 'br'. Use best for data
+    which is compressed once and cached.
+    """
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=BEST_BROTLI_QUALITY if best else BROTLI_QUALITY)
+    elif encoding == GZIP:
+        return gzip_bytes(data, level=BEST_COMPRESS_LEVEL if best else COMPRESS_LEVEL)
+    else:
+        raise ValueError('Unknown encoding %r' % encoding)
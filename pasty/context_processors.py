@@ -1,19 +1,62 @@
+from django.utils.functional import SimpleLazyObject
 from google.appengine.api import users
 
 from . import forms
+from . import middleware
 from . import models
 from . import utils
 
 
+#: Pairs of (<style name>, <CSS class>) for the style picker. They don't
+#: change while the process runs.
+style_options = sorted((name, value) for name, (value, _) in utils.highlight_css.items())
+
+
 def pasty(request):
+    """Adds values used by the base template. Each is worked out when a
+    template first uses it, and only once per request, so pages that don't
+    use them make no API calls for them.
+    """
+    context = getattr(request, '_pasty_context', None)
+
+    if context is None:
+        context = request._pasty_context = make_context(request)
+
+    return context
+
+
+def csrf(request):
+    """Adds the CSRF token, in place of session_csrf.context_processor.
+
+    A page which shows csrf_token isn't compressed, see
+    middleware.CompressionMiddleware. masked_csrf_token is different in
+    every response, so pages which only use that can be compressed.
+    """
+    return {
+        'csrf_token': SimpleLazyObject(lambda: middleware.use_csrf_token(request)),
+        'masked_csrf_token': SimpleLazyObject(lambda: middleware.mask_csrf_token(request)),
+    }
+
+
+def make_context(request):
     path = request.get_full_path()
-    style_options = sorted((name, value) for name, (value, _) in utils.highlight_css.items())
 
     return {
-        'starred_pastes': models.get_starred_pastes(request.user_email),
-        'login_url': users.create_login_url(path),
-        'logout_url': users.create_logout_url(path),
+        'starred_pastes': SimpleLazyObject(lambda: get_starred_pastes(request)),
+        'login_url': SimpleLazyObject(lambda: users.create_login_url(path)),
+        'logout_url': SimpleLazyObject(lambda: users.create_logout_url(path)),
         'highlight_styles': style_options,
-        'is_current_user_admin': users.is_current_user_admin(),
-        'search_form': forms.SearchForm(),
+        'is_current_user_admin': SimpleLazyObject(users.is_current_user_admin),
+        'search_form': SimpleLazyObject(forms.SearchForm),
     }
+
+
+def get_starred_pastes(request):
+    # Views can start fetching the starred pastes early, see
+    # views.prefetch_starred_pastes.
+    future = getattr(request, 'starred_pastes_future', None)
+
+    if future is None:
+        return models.get_starred_pastes(request.user_email)
+    else:
+        return future.get_result()
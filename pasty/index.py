@@ -1,18 +1,42 @@
+import base64
 import calendar
+import collections
+import hashlib
 import logging
 import os
+import time
 
 from django.conf import settings
 from django.utils import http
+from google.appengine.api import memcache
 from google.appengine.api import search
 from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 
-from .models import Paste
+from .models import Paste, get_recent_paste_keys, get_summaries, prefetch_forks, read_files
 
 
 logger = logging.getLogger(__name__)
 paste_index = search.Index(name='pastes')
 
+#: Seconds to keep pages of search results, and listings of them, in memcache.
+#: New pastes show up in searches once these expire.
+SEARCH_CACHE_TTL = 60
+#: Seconds to keep pages of the newest pastes in memcache.
+LISTING_CACHE_TTL = 300
+#: Memcache key for the version of the newest pastes, used in the cache keys.
+GENERATION_KEY = 'search-generation'
+#: Most results fetched for each sub-query when a search is split up. Searches
+#: with more results than this are not split.
+FANOUT_LIMIT = 500
+#: Distinguishes our merged cursors from the Search API's web-safe cursors.
+MERGED_CURSOR_PREFIX = 'm-'
+
+#: A page of search results, as stored in memcache.
+ResultPage = collections.namedtuple('ResultPage', 'doc_ids count cursor')
+#: A page of PasteSummary objects for a listing, as stored in memcache.
+ListingPage = collections.namedtuple('ListingPage', 'summaries count cursor')
+
 
 def datetime_to_timestamp(value):
     """Converts a datetime to a Unix timestamp."""
@@ -22,6 +46,27 @@ def datetime_to_timestamp(value):
 def add_paste(paste):
     doc = create_document_for_paste(paste)
     paste_index.put(doc)
+    bump_generation()
+
+
+def get_generation():
+    """Returns the current version of the index. It changes every time the
+    index changes, so cached pages of the newest pastes become stale. Pages
+    of search results aren't keyed by it, most searches don't match a new
+    paste so they expire after SEARCH_CACHE_TTL instead.
+    """
+    generation = memcache.get(GENERATION_KEY)
+
+    if generation is None:
+        # Start from the time so an evicted counter can't repeat old values.
+        memcache.add(GENERATION_KEY, int(time.time()))
+        generation = memcache.get(GENERATION_KEY)
+
+    return generation
+
+
+def bump_generation():
+    memcache.incr(GENERATION_KEY, initial_value=int(time.time()))
 
 
 def create_document_for_paste(paste):
@@ -37,13 +82,10 @@ def create_document_for_paste(paste):
     fields.append(search.DateField(name='created', value=created))
 
     # Then we need to get the paste's content.
-    for pasty_file in paste.files:
+    for pasty_file, value in zip(paste.files, read_files(paste.files)):
         name_field = search.TextField(name='filename', value=pasty_file.filename)
         type_field = search.TextField(name='content_type', value=pasty_file.content_type)
-
-        with pasty_file.open('r') as fh:
-            value = fh.read()
-            content_field = search.TextField(name='content', value=value)
+        content_field = search.TextField(name='content', value=value)
 
         fields.extend([name_field, type_field, content_field])
 
@@ -56,47 +98,313 @@ def create_document_for_paste(paste):
     return doc
 
 
-class SearchResults(list):
-    def __init__(self, results):
+class Results(list):
+    """A page of results with a cursor for the next page. count is the
+    number of matches, or None for listings from the datastore, where
+    counting every paste is slow.
+    """
+    def __init__(self, items, count, cursor):
+        self[:] = items
+        self.count = count
+        self._cursor = cursor
+
+    def has_next(self):
+        return bool(self._cursor)
+
+    def next_page_number(self):
+        return self._cursor if self.has_next() else None
+
+
+class SearchResults(Results):
+    """A page of pastes for a ResultPage of paste IDs. Use get_multi to load
+    something other than Paste entities for the keys, e.g. summaries.
+    """
+    def __init__(self, page, get_multi=ndb.get_multi):
         # Guard against search docs for pastes that have been deleted.
         pastes, bad_docs = [], []
+        keys = [ndb.Key(Paste, int(doc_id)) for doc_id in page.doc_ids]
 
-        for doc in results:
-            paste = Paste.get_by_id(int(doc.doc_id))
-
+        for doc_id, paste in zip(page.doc_ids, get_multi(keys)):
             if paste:
                 pastes.append(paste)
             else:
-                bad_docs.append(doc.doc_id)
+                bad_docs.append(doc_id)
 
-        self._results = results
-        self[:] = pastes
-        self.count = results.number_found
+        super(SearchResults, self).__init__(
+            pastes, page.count, page.cursor)
 
         # And schedule those search docs for deletion.
         if bad_docs:
             logger.debug('Bogus search results %r', bad_docs)
             deferred.defer(delete_docs_from_index, bad_docs, _queue='delete-docs')
 
-    def has_next(self):
-        return bool(self._results.cursor)
 
-    def next_page_number(self):
-        return self._results.cursor.web_safe_string if self.has_next() else None
+def make_cache_key(prefix, *parts):
+    """Returns a memcache key for the parts, which may be any length."""
+    value = u'\x00'.join(unicode(part) for part in parts).encode('utf-8')
+    digest = hashlib.sha1(value).hexdigest()
+
+    return '%s:%s' % (prefix, digest)
 
 
 def search_pastes(query, cursor_string, limit=None):
+    """Returns a page of pastes matching the query string."""
+    page = get_search_page(query, cursor_string, limit=limit)
+
+    return SearchResults(page)
+
+
+def get_search_page(query, cursor_string, limit=None):
+    """Returns a ResultPage for the query string. Pages of result ids are
+    cached for SEARCH_CACHE_TTL seconds.
+    """
+    if limit is None:
+        limit = settings.PAGE_SIZE
+
+    if cursor_string and cursor_string.startswith(MERGED_CURSOR_PREFIX):
+        # Left over from a split query, see get_terms_page(). Starting again
+        # would show the first page with a next link back to here.
+        return ResultPage([], None, None)
+
+    key = make_cache_key('search', query.decode('utf-8'), cursor_string, limit)
+    page = memcache.get(key)
+
+    if page is None:
+        cursor = search.Cursor(web_safe_string=cursor_string)
+        options = search.QueryOptions(cursor=cursor, ids_only=True, limit=limit)
+        query = search.Query(query_string=query, options=options)
+
+        results = paste_index.search(query)
+        next_cursor = results.cursor.web_safe_string if results.cursor else None
+        doc_ids = [doc.doc_id for doc in results]
+        page = ResultPage(doc_ids, results.number_found, next_cursor)
+        memcache.set(key, page, time=SEARCH_CACHE_TTL)
+
+    return page
+
+
+def search_terms(terms, cursor_string, limit=None):
+    """Returns a page of pastes matching all the (term, label, param) tuples
+    from build_query().
+    """
+    page = get_terms_page(terms, cursor_string, limit=limit)
+
+    return SearchResults(page)
+
+
+def get_terms_page(terms, cursor_string, limit=None):
+    """Returns a ResultPage for the search terms from build_query().
+
+    The terms are searched with a single query. If that has more than one
+    page of results, but no more than FANOUT_LIMIT, each term is searched
+    separately and in parallel and the results merged, so later pages come
+    from the cached merged results with a cursor which is stable when
+    pastes are added. If any sub-query has too many results to merge we
+    keep to the single query.
+
+    A merged cursor can outlive the cached results, and the search may no
+    longer split, e.g. a term now has too many results. Then the single
+    query's results are paged from the cursor's position instead. If there
+    are too many of those too, the results end there.
+    """
+    if limit is None:
+        limit = settings.PAGE_SIZE
+
+    queries = sorted(set(term for term, label, param in terms))
+    query = u' '.join(queries)
+
+    if cursor_string and cursor_string.startswith(MERGED_CURSOR_PREFIX):
+        merged = get_merged_results(queries) if len(queries) > 1 else None
+
+        if merged is None:
+            merged = get_merged_results([query])
+
+        if merged is None:
+            return ResultPage([], None, None)
+
+        return page_merged_results(merged, cursor_string, limit)
+
+    page = get_search_page(query.encode('utf-8'), cursor_string, limit=limit)
+
+    # The single query's count is the probe for whether splitting is worth
+    # it: most searches have one page of results.
+    if len(queries) > 1 and not cursor_string and page.cursor and page.count <= FANOUT_LIMIT:
+        merged = get_merged_results(queries)
+
+        if merged is not None:
+            return page_merged_results(merged, None, limit)
+
+    return page
+
+
+def recent_pastes(cursor_string, limit=None):
+    """Returns a page of the newest pastes, without using the Search API."""
+    page = get_recent_page(cursor_string, limit=limit)
+
+    return SearchResults(page)
+
+
+def get_recent_page(cursor_string, limit=None):
+    """Returns a ResultPage of the newest paste IDs from the datastore. The
+    count is None because counting every paste is slow.
+    """
     if limit is None:
         limit = settings.PAGE_SIZE
 
-    cursor = search.Cursor(web_safe_string=cursor_string)
-    options = search.QueryOptions(cursor=cursor, ids_only=True, limit=limit)
-    query = search.Query(query_string=query, options=options)
+    keys, cursor = get_recent_paste_keys(cursor_string, limit=limit)
+    doc_ids = [unicode(key.id()) for key in keys]
+
+    return ResultPage(doc_ids, None, cursor)
+
+
+def get_pastes(terms, cursor_string, limit=None):
+    """Returns a page of PasteSummary objects for the search terms from
+    build_query(). Summaries have the file details without their content.
+    """
+    page = get_page(terms, cursor_string, limit=limit)
+
+    return SearchResults(page, get_multi=get_summaries)
+
+
+def get_page(terms, cursor_string, limit=None):
+    """Returns a ResultPage for the search terms from build_query(). With no
+    terms the newest pastes come straight from the datastore.
+    """
+    if terms:
+        return get_terms_page(terms, cursor_string, limit=limit)
+    else:
+        return get_recent_page(cursor_string, limit=limit)
+
+
+def list_pastes(terms, cursor_string, limit=None):
+    """Returns a page of PasteSummary objects for the search terms from
+    build_query(), for showing in a listing.
+
+    Pages of the newest pastes are cached until the index changes, so busy
+    listings such as /recent/ don't need the datastore. Pages of search
+    results are cached for SEARCH_CACHE_TTL, so adding a paste doesn't
+    clear every cached search.
+    """
+    if limit is None:
+        limit = settings.PAGE_SIZE
+
+    if terms:
+        query = u' '.join(sorted(set(term for term, label, param in terms)))
+        key = make_cache_key('search-listing', query, cursor_string, limit)
+        ttl = SEARCH_CACHE_TTL
+    else:
+        key = make_cache_key('listing', get_generation(), cursor_string, limit)
+        ttl = LISTING_CACHE_TTL
+
+    page = memcache.get(key)
+
+    if page is None:
+        result_page = get_page(terms, cursor_string, limit=limit)
+        summaries = SearchResults(result_page, get_multi=get_summaries)
+        prefetch_forks(summaries)
+        page = ListingPage(list(summaries), result_page.count, result_page.cursor)
+        memcache.set(key, page, time=ttl)
+
+    return Results(page.summaries, page.count, page.cursor)
+
+
+def get_merged_results(queries):
+    """Returns a list of (rank, doc_id) pairs for docs matching every query,
+    highest rank first. Returns None if the queries can't be merged, because
+    one has more than FANOUT_LIMIT results.
+    """
+    key = make_cache_key('merged', *queries)
+    cached = memcache.get(key)
+
+    if cached is not None:
+        mergeable, merged = cached
+    else:
+        futures = []
+
+        for query in queries:
+            options = search.QueryOptions(ids_only=True, limit=FANOUT_LIMIT)
+            query = search.Query(query_string=query.encode('utf-8'), options=options)
+            futures.append(paste_index.search_async(query))
+
+        result_sets = [future.get_result() for future in futures]
+        mergeable = not any(is_truncated(results) for results in result_sets)
+        merged = merge_by_rank(result_sets) if mergeable else None
+        memcache.set(key, (mergeable, merged), time=SEARCH_CACHE_TTL)
+
+    return merged
 
-    results = paste_index.search(query)
-    search_results = SearchResults(results)
 
-    return search_results
+def is_truncated(results):
+    """True if a search did not return all the matching documents."""
+    found = len(results.results)
+
+    return found >= FANOUT_LIMIT or results.number_found > found
+
+
+def merge_by_rank(result_sets):
+    """Returns (rank, doc_id) pairs for the docs found in every set of search
+    results, highest rank first. The doc ID breaks ties between ranks.
+    """
+    first, rest = result_sets[0], result_sets[1:]
+    common = set(doc.doc_id for doc in first)
+
+    for results in rest:
+        common.intersection_update(doc.doc_id for doc in results)
+
+    merged = [(doc.rank, doc.doc_id) for doc in first if doc.doc_id in common]
+    merged.sort(key=merged_sort_key, reverse=True)
+
+    return merged
+
+
+def merged_sort_key(pair):
+    rank, doc_id = pair
+
+    return (rank, int(doc_id))
+
+
+def encode_merged_cursor(pair):
+    """Returns a web-safe cursor for the position after (rank, doc_id)."""
+    value = '%d:%s' % merged_sort_key(pair)
+
+    return MERGED_CURSOR_PREFIX + base64.urlsafe_b64encode(value)
+
+
+def decode_merged_cursor(cursor_string):
+    """Returns the (rank, doc_id) sort key for a cursor, or None if the cursor
+    is missing or invalid.
+    """
+    if not (cursor_string and cursor_string.startswith(MERGED_CURSOR_PREFIX)):
+        return None
+
+    value = cursor_string[len(MERGED_CURSOR_PREFIX):]
+
+    try:
+        value = base64.urlsafe_b64decode(value.encode('ascii'))
+        rank, doc_id = value.split(':')
+        return (int(rank), int(doc_id))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+def page_merged_results(merged, cursor_string, limit):
+    """Returns a ResultPage of merged results after the cursor position.
+
+    The cursor records the last result on the previous page rather than an
+    offset, so pastes added between requests don't shift the pages.
+    """
+    position = decode_merged_cursor(cursor_string)
+
+    if position is not None:
+        remaining = [pair for pair in merged if merged_sort_key(pair) < position]
+    else:
+        remaining = merged
+
+    page = remaining[:limit]
+    cursor = encode_merged_cursor(page[-1]) if len(remaining) > limit else None
+    doc_ids = [doc_id for rank, doc_id in page]
+
+    return ResultPage(doc_ids, len(merged), cursor)
 
 
 def build_query(qdict):
@@ -130,6 +438,8 @@ def delete_docs_from_index(doc_ids):
         paste_index.delete(doc_ids)
     except (search.DeleteError, ValueError):
         logger.exception('Error deleting stale search results.')
+    else:
+        bump_generation()
 
 
 def index_directory(path):
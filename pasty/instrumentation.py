@@ -0,0 +1,183 @@
+import collections
+import contextlib
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import quota
+
+
+HOOK_NAME = 'pasty-instrumentation'
+
+#: Maps App Engine API services to the names we report them as.
+SERVICE_NAMES = {
+    'datastore_v3': 'datastore',
+    'memcache': 'memcache',
+    'search': 'search',
+    'urlfetch': 'urlfetch',
+    'user': 'users',
+}
+
+#: URL fragments for Cloud Storage requests made by the cloudstorage library.
+GCS_URL_MARKERS = ('storage.googleapis.com', '/_ah/gcs/')
+
+#: URLFetchRequest methods which send a payload.
+URLFETCH_WRITE_METHODS = (2, 4)   # POST, PUT
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """Counts API calls and timings for a block of code, usually a request.
+    Durations are in milliseconds. Calls are also recorded in the parent
+    stats, if any, so collectors can be nested.
+    """
+    def __init__(self, parent=None):
+        self._lock = threading.Lock()
+        self.parent = parent
+        self.calls = collections.Counter()
+        self.durations = collections.Counter()
+        self.counters = collections.Counter()
+        self.started = time.time()
+        self.cpu_started = quota.get_request_cpu_usage()
+        self.wall_ms = 0.0
+        self.cpu_ms = 0.0
+
+    def record(self, name, duration=0.0, calls=1, **counters):
+        with self._lock:
+            self.calls[name] += calls
+            self.durations[name] += duration
+
+            for counter, value in counters.items():
+                self.counters[name, counter] += value
+
+        if self.parent is not None:
+            self.parent.record(name, duration, calls, **counters)
+
+    def finish(self):
+        self.wall_ms = (time.time() - self.started) * 1000
+        megacycles = quota.get_request_cpu_usage() - self.cpu_started
+        self.cpu_ms = quota.megacycles_to_cpu_seconds(megacycles) * 1000
+
+    def as_dict(self):
+        """Returns the numbers as a dict, suitable for logging as JSON."""
+        result = {'wall_ms': round(self.wall_ms, 1), 'cpu_ms': round(self.cpu_ms, 1)}
+
+        for name in self.calls:
+            result[name] = {
+                'calls': self.calls[name],
+                'ms': round(self.durations[name], 1),
+            }
+
+        for (name, counter), value in self.counters.items():
+            result.setdefault(name, {})[counter] = value
+
+        return result
+
+    def server_timing(self):
+        """Returns a value for the Server-Timing header."""
+        metrics = [
+            'total;dur=%.1f' % self.wall_ms,
+            'cpu;dur=%.1f' % self.cpu_ms,
+        ]
+
+        for name in sorted(self.calls):
+            counters = sorted(
+                (counter, value) for (n, counter), value in self.counters.items()
+                if n == name)
+            desc = [u'%d calls' % self.calls[name]]
+            desc.extend(u'%d %s' % (value, counter) for counter, value in counters)
+            metrics.append('%s;dur=%.1f;desc="%s"' % (name, self.durations[name], ', '.join(desc)))
+
+        return ', '.join(metrics)
+
+
+def current():
+    """Returns the RequestStats being collected for this thread, or None."""
+    return getattr(_local, 'stats', None)
+
+
+@contextlib.contextmanager
+def bind(stats):
+    """Collects into an existing RequestStats, e.g. from a worker thread."""
+    previous = current()
+    _local.stats = stats
+
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+@contextlib.contextmanager
+def collect():
+    """Collects API calls made inside the block into a new RequestStats."""
+    install_hooks()
+    stats = RequestStats(parent=current())
+
+    with bind(stats):
+        try:
+            yield stats
+        finally:
+            stats.finish()
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Records the time spent in the block, if we are collecting stats."""
+    stats = current()
+
+    if stats is None:
+        yield
+        return
+
+    started = time.time()
+
+    try:
+        yield
+    finally:
+        stats.record(name, (time.time() - started) * 1000)
+
+
+def install_hooks():
+    """Adds our hooks to the API proxy. Safe to call more than once, and
+    needed again whenever the proxy is replaced (e.g. by the testbed).
+    """
+    proxy = apiproxy_stub_map.apiproxy
+    proxy.GetPreCallHooks().Append(HOOK_NAME, _pre_call_hook)
+    proxy.GetPostCallHooks().Append(HOOK_NAME, _post_call_hook)
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    if rpc is not None and current() is not None:
+        rpc._pasty_started = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    stats = current()
+
+    if stats is None:
+        return
+
+    started = getattr(rpc, '_pasty_started', None)
+    duration = (time.time() - started) * 1000 if started else 0.0
+    name = SERVICE_NAMES.get(service, service)
+    counters = {}
+
+    if error is None and service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        counters = {'hits': hits, 'misses': request.key_size() - hits}
+
+    elif service == 'urlfetch' and call == 'Fetch':
+        url = request.url()
+
+        if any(marker in url for marker in GCS_URL_MARKERS):
+            name = 'gcs'
+
+            if request.method() in URLFETCH_WRITE_METHODS:
+                counters = {'writes': 1, 'write_bytes': len(request.payload())}
+            else:
+                read_bytes = len(response.content()) if error is None else 0
+                counters = {'reads': 1, 'read_bytes': read_bytes}
+
+    stats.record(name, duration, **counters)
@@ -0,0 +1,268 @@
+"""Generates a mix of traffic against the app running on the App Engine service
+stubs, and reports throughput and latency for each endpoint.
+
+Run it with `./manage.py loadtest`.
+"""
+import bisect
+import collections
+import json
+import logging
+import random
+import threading
+import time
+
+from django.test import Client
+from django.urls import reverse
+
+from . import index
+from .benchmarks import SAMPLES, make_content
+from .models import Paste
+
+
+#: Relative weights for each kind of request.
+DEFAULT_MIX = collections.OrderedDict([
+    ('detail', 60),
+    ('search', 20),
+    ('star', 15),
+    ('create', 5),
+])
+
+#: Words used for descriptions and search terms.
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel']
+
+#: Percentiles in the report.
+PERCENTILES = [50, 90, 99]
+
+#: The status recorded for a request which raised an exception, e.g. the test
+#: client re-raising an error from a view.
+ERROR_STATUS = 500
+
+Result = collections.namedtuple('Result', 'endpoint status latency')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_mix(value):
+    """Parses a mix like 'detail=60,search=20' into an ordered dict."""
+    mix = collections.OrderedDict()
+
+    for part in value.split(','):
+        name, weight = part.split('=')
+        name = name.strip()
+
+        if name not in DEFAULT_MIX:
+            raise ValueError('Unknown request type %r' % name)
+
+        mix[name] = int(weight)
+
+    return mix
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a sorted list of values."""
+    if not values:
+        return None
+
+    rank = int(round(pct / 100.0 * len(values) + 0.5))
+    rank = min(max(rank, 1), len(values))
+
+    return values[rank - 1]
+
+
+class WeightedChoice(object):
+    """Chooses items at random, in proportion to their weights."""
+    def __init__(self, items, weights):
+        self.items = list(items)
+        self.totals = []
+        total = 0
+
+        for weight in weights:
+            total += weight
+            self.totals.append(total)
+
+    def __call__(self, rng):
+        value = rng.random() * self.totals[-1]
+
+        return self.items[bisect.bisect_right(self.totals, value)]
+
+
+def zipf_weights(count, skew=1.1):
+    """Weights for a popularity skew, the first item being the most popular."""
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+class LoadTest(object):
+    """Makes requests with the Django test client from several threads.
+
+    Call setup() to create pastes to read, then run().
+    """
+    def __init__(self, mix=None, num_pastes=100, skew=1.1, seed=None, replay=None):
+        self.mix = mix or DEFAULT_MIX
+        self.num_pastes = num_pastes
+        self.skew = skew
+        self.seed = seed
+        self.replay = replay or []
+        self.paste_ids = []
+        self.results = []
+        self._lock = threading.Lock()
+        self._sent = 0
+
+    def setup(self):
+        rng = random.Random(self.seed)
+        filenames = sorted(SAMPLES)
+
+        for n in range(self.num_pastes):
+            filename = rng.choice(filenames)
+            content = make_content(filename, rng.randint(100, 10 * 1024))
+            description = u' '.join(rng.sample(WORDS, 3))
+            paste = Paste.create_with_files(
+                description=description, files=[(filename, content)])
+            index.add_paste(paste)
+            self.paste_ids.append(paste.key.id())
+
+        self.choose_paste = WeightedChoice(self.paste_ids, zipf_weights(len(self.paste_ids), self.skew))
+        self.choose_request = WeightedChoice(self.mix.keys(), self.mix.values())
+
+    def run(self, num_requests, concurrency=4):
+        """Makes num_requests requests using concurrency threads. Returns the
+        time taken in seconds.
+        """
+        self._sent = 0
+        threads = []
+
+        for n in range(concurrency):
+            seed = None if self.seed is None else (self.seed + n)
+            thread = threading.Thread(target=self.worker, args=(num_requests, seed))
+            threads.append(thread)
+
+        started = time.time()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return time.time() - started
+
+    def next_request_number(self, num_requests):
+        """Returns the number of the next request to send, or None if done."""
+        with self._lock:
+            if self._sent >= num_requests:
+                return None
+
+            self._sent += 1
+
+            return self._sent - 1
+
+    def worker(self, num_requests, seed):
+        rng = random.Random(seed)
+        client = Client()
+
+        while True:
+            number = self.next_request_number(num_requests)
+
+            if number is None:
+                return
+
+            if self.replay:
+                method, path = self.replay[number % len(self.replay)]
+                endpoint = method + ' ' + path.split('?')[0]
+                send = lambda: client.generic(method, path)
+            else:
+                endpoint = self.choose_request(rng)
+                send = getattr(self, 'request_' + endpoint)(client, rng)
+
+            started = time.time()
+
+            try:
+                status = send().status_code
+            except Exception:
+                # Count it as an error rather than letting it end the thread.
+                logger.exception('Request to %s failed', endpoint)
+                status = ERROR_STATUS
+
+            latency = (time.time() - started) * 1000
+
+            self.results.append(Result(endpoint, status, latency))
+
+    def request_detail(self, client, rng):
+        url = reverse('paste_detail', args=[self.choose_paste(rng)])
+
+        return lambda: client.get(url)
+
+    def request_search(self, client, rng):
+        url = reverse('paste_search')
+        params = {'q': rng.choice(WORDS)}
+
+        # Some searches have two terms, which are split into sub-queries.
+        if rng.random() < 0.3:
+            params['filename'] = rng.choice(sorted(SAMPLES))
+
+        return lambda: client.get(url, params)
+
+    def request_star(self, client, rng):
+        name = rng.choice(['api_star_create', 'api_star_delete'])
+        data = {'paste': self.choose_paste(rng)}
+
+        return lambda: client.post(reverse(name), data)
+
+    def request_create(self, client, rng):
+        filename = rng.choice(sorted(SAMPLES))
+        data = {
+            'description': u' '.join(rng.sample(WORDS, 3)),
+            'files': [{'filename': filename, 'content': make_content(filename, 2048)}],
+        }
+        data = json.dumps(data)
+        url = reverse('api_paste_list')
+
+        return lambda: client.post(url, data, content_type='application/json')
+
+    def report(self, elapsed):
+        """Returns a dict of {<endpoint>: <stats dict>}, including 'all'."""
+        by_endpoint = collections.defaultdict(list)
+
+        for result in self.results:
+            by_endpoint[result.endpoint].append(result)
+            by_endpoint['all'].append(result)
+
+        report = collections.OrderedDict()
+
+        for endpoint in sorted(by_endpoint):
+            results = by_endpoint[endpoint]
+            latencies = sorted(r.latency for r in results)
+            stats = collections.OrderedDict([
+                ('requests', len(results)),
+                ('errors', sum(1 for r in results if r.status >= 500)),
+                ('rps', round(len(results) / elapsed, 2) if elapsed else None),
+            ])
+
+            for pct in PERCENTILES:
+                stats['p%d_ms' % pct] = round(percentile(latencies, pct), 2)
+
+            stats['max_ms'] = round(latencies[-1], 2)
+            report[endpoint] = stats
+
+        return report
+
+
+def read_replay_file(fh):
+    """Returns a list of (method, path) from lines like 'GET /recent/'. Lines
+    with just a path are GET requests. Blank lines and comments are skipped.
+    """
+    requests = []
+
+    for line in fh:
+        line = line.strip()
+
+        if not line or line.startswith('#'):
+            continue
+
+        parts = line.split(None, 1)
+
+        if len(parts) == 1:
+            requests.append(('GET', parts[0]))
+        else:
+            requests.append((parts[0].upper(), parts[1]))
+
+    return requests
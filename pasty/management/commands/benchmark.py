@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pasty import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Run benchmarks, optionally comparing the results with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*',
+            help='Run benchmarks starting with these names (default is all)')
+        parser.add_argument(
+            '--list', action='store_true', help='List the benchmarks and exit')
+        parser.add_argument(
+            '--repeat', type=int, default=5, help='Timed runs per benchmark')
+        parser.add_argument(
+            '--output', help='Save the results as JSON, e.g. to use as a baseline')
+        parser.add_argument(
+            '--baseline', help='Compare with results saved by a previous run')
+        parser.add_argument(
+            '--threshold', type=float, default=0.2,
+            help='Fail if a median is this much slower than the baseline')
+
+    def handle(self, *args, **options):
+        names = [
+            name for name in benchmarks.BENCHMARKS
+            if not options['names'] or name.startswith(tuple(options['names']))
+        ]
+
+        if not names:
+            raise CommandError('No benchmarks match %s' % ', '.join(options['names']))
+
+        if options['list']:
+            for name in names:
+                self.stdout.write(name)
+            return
+
+        results = benchmarks.run_benchmarks(names, repeat=options['repeat'])
+
+        for name, result in results['benchmarks'].items():
+            self.stdout.write('%-50s %10.3f ms' % (name, result['median_ms']))
+
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(results, fh, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as fh:
+                baseline = json.load(fh)
+
+            regressions = benchmarks.compare(results, baseline, threshold=options['threshold'])
+
+            for name, before, after, ratio in regressions:
+                msg = '%s: %.3f ms -> %.3f ms (%.0f%% slower)'
+                self.stderr.write(msg % (name, before, after, (ratio - 1) * 100))
+
+            if regressions:
+                raise CommandError('%d benchmarks are slower than the baseline' % len(regressions))
@@ -1,4 +1,4 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from pasty import utils
 
@@ -6,6 +6,14 @@ from pasty import utils
 class Command(BaseCommand):
     help = 'Output the CSS for syntax highlighting'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--style', help='Output just this style, e.g. %s' % utils.PYGMENTS_STYLE)
+
     def handle(self, *args, **options):
-        text = utils.highlight_styles()
+        name = options['style']
+
+        if name and name not in utils.highlight_css:
+            raise CommandError('Unknown style %r' % name)
+
+        text = utils.highlight_styles(name)
         self.stdout.write(text)
@@ -0,0 +1,71 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pasty import loadtest
+
+
+class Command(BaseCommand):
+    help = 'Run a mix of requests against the app on the service stubs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests', type=int, default=1000, help='Total requests to make')
+        parser.add_argument(
+            '--concurrency', type=int, default=4, help='Number of threads')
+        parser.add_argument(
+            '--pastes', type=int, default=100, help='Pastes to create first')
+        parser.add_argument(
+            '--mix', help='Weights for request types, e.g. "detail=60,search=20,star=15,create=5"')
+        parser.add_argument(
+            '--skew', type=float, default=1.1, help='Zipf skew for paste popularity')
+        parser.add_argument(
+            '--seed', type=int, help='Seed for repeatable runs')
+        parser.add_argument(
+            '--replay', help='Replay requests from a file of "METHOD /path" lines')
+        parser.add_argument(
+            '--user', default='loadtest@example.com', help='Signed-in user email')
+        parser.add_argument(
+            '--json', action='store_true', help='Write the report as JSON')
+
+    def handle(self, *args, **options):
+        # Imported here because the tests package imports test-only libraries.
+        from pasty.tests import activate_testbed
+
+        try:
+            mix = loadtest.parse_mix(options['mix']) if options['mix'] else None
+        except ValueError as err:
+            raise CommandError(str(err))
+
+        replay = None
+
+        if options['replay']:
+            with open(options['replay']) as fh:
+                replay = loadtest.read_replay_file(fh)
+
+        bed = activate_testbed()
+
+        try:
+            os.environ['USER_EMAIL'] = options['user']
+            os.environ['USER_ID'] = options['user'].split('@', 1)[0]
+
+            test = loadtest.LoadTest(
+                mix=mix, num_pastes=options['pastes'], skew=options['skew'],
+                seed=options['seed'], replay=replay)
+            test.setup()
+            elapsed = test.run(options['requests'], concurrency=options['concurrency'])
+            report = test.report(elapsed)
+        finally:
+            bed.deactivate()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        columns = list(report['all'])
+        self.stdout.write(('%-30s' % 'endpoint') + ''.join('%10s' % c for c in columns))
+
+        for endpoint, stats in report.items():
+            values = ''.join('%10s' % stats[c] for c in columns)
+            self.stdout.write(('%-30s' % endpoint) + values)
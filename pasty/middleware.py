@@ -1,11 +1,133 @@
+import cProfile
+import json
+import logging
+import random
+
+import session_csrf
+from djangae import environment
+from django.conf import settings
+from django.contrib.messages.middleware import MessageMiddleware as BaseMessageMiddleware
+from django.contrib.sessions.middleware import SessionMiddleware as BaseSessionMiddleware
+from django.middleware.csrf import CSRF_TOKEN_LENGTH, _salt_cipher_secret, _unsalt_cipher_token
+from django.urls import Resolver404, resolve, reverse
+from django.utils.cache import patch_vary_headers
+from google.appengine.api import memcache
 from google.appengine.api import modules
 
+from . import cache
+from . import compression
+from . import instrumentation
+from . import profiling
 from . import utils
 
 
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def sessionless(view):
+    """Marks a view as never using the session, CSRF tokens or messages for
+    GET requests. SessionMiddleware, CsrfMiddleware and MessageMiddleware
+    below skip those requests, so they make no cache calls and set no
+    cookies.
+    """
+    view.sessionless = True
+
+    return view
+
+
+def is_sessionless(request):
+    """Returns True for a safe request to a view marked sessionless."""
+    if request.method not in SAFE_METHODS:
+        return False
+
+    try:
+        return request._sessionless
+    except AttributeError:
+        pass
+
+    # Middleware runs before the URL is resolved for the view.
+    try:
+        match = resolve(request.path_info, getattr(request, 'urlconf', None))
+    except Resolver404:
+        request._sessionless = False
+    else:
+        request._sessionless = getattr(match.func, 'sessionless', False)
+
+    return request._sessionless
+
+
+class SessionlessMixin(object):
+    """For middleware which does nothing on sessionless requests."""
+    def __call__(self, request):
+        if is_sessionless(request):
+            return self.get_response(request)
+
+        return super(SessionlessMixin, self).__call__(request)
+
+
+class SessionMiddleware(SessionlessMixin, BaseSessionMiddleware):
+    pass
+
+
+class MessageMiddleware(SessionlessMixin, BaseMessageMiddleware):
+    pass
+
+
+class CsrfMiddleware(SessionlessMixin, session_csrf.CsrfMiddleware):
+    """Accepts masked tokens from mask_csrf_token() in the X-CSRFToken
+    header, as well as plain tokens.
+    """
+    def process_view(self, request, view_func, args, kwargs):
+        # Called by the handler rather than from __call__.
+        if is_sessionless(request):
+            return None
+
+        token = request.META.get('HTTP_X_CSRFTOKEN', '')
+
+        if len(token) == CSRF_TOKEN_LENGTH:
+            try:
+                request.META['HTTP_X_CSRFTOKEN'] = _unsalt_cipher_token(token)
+            except ValueError:
+                # Not a masked token, so it won't match.
+                pass
+
+        return super(CsrfMiddleware, self).process_view(request, view_func, args, kwargs)
+
+
+def use_csrf_token(request):
+    """Returns the request's CSRF token for a page, and marks the response as
+    including it so it isn't compressed, see CompressionMiddleware.
+    """
+    token = getattr(request, 'csrf_token', '')
+
+    if not token:
+        # Django warns about an empty token unless you call it NOTPROVIDED.
+        return 'NOTPROVIDED'
+
+    request.META['CSRF_COOKIE_USED'] = True
+
+    return token
+
+
+def mask_csrf_token(request):
+    """Returns the request's CSRF token mixed with a random salt, as Django
+    does. It is different in every response, so the response can be
+    compressed without giving the token away.
+    """
+    token = getattr(request, 'csrf_token', '')
+
+    return _salt_cipher_secret(token) if token else ''
+
+
 class GoogleUserMiddleware(object):
     """Sets a user_email attribute on the request object, which is the
     currently logged in Google Auth user email (if any).
+
+    This is cheap, App Engine passes the user in environment variables
+    rather than needing an API call. It is a plain string because views
+    save it on entities.
     """
     def __init__(self, get_response):
         self.get_response = get_response
@@ -47,6 +169,121 @@ class CSPHostnameMiddleware(object):
         return response
 
 
+class CompressionMiddleware(object):
+    """Compresses responses with brotli (if installed) or gzip, whichever
+    the client accepts.
+
+    Responses which are streamed, already encoded, smaller than MIN_SIZE
+    bytes or not a text-like content type (e.g. zip files) are left alone.
+    Views can send content compressed ahead of time by setting the
+    Content-Encoding header themselves.
+
+    Views can also set request.deflated_fragments to a list of (<bytes>,
+    <memcache key>) for large parts of the response which don't change, such
+    as highlighted files. The compression.deflate_fragment() of each is
+    cached at the key, and gzip responses use it rather than compressing
+    that part again.
+
+    Responses which include a plain CSRF token are not compressed either.
+    The page may have the token next to text from the request, which lets an
+    attacker guess the token from the compressed size (BREACH). Pages can
+    use a masked token instead, see mask_csrf_token().
+    """
+    MIN_SIZE = 1024
+    CONTENT_TYPES = (
+        'text/', 'application/json', 'application/javascript', 'application/xml',
+        'image/svg+xml',
+    )
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        if not self.should_compress(request, response):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        encoding = compression.accepted_encoding(accept_encoding)
+
+        if encoding is None:
+            return response
+
+        fragments = getattr(request, 'deflated_fragments', None)
+
+        # Cached fragments are only in gzip, which is worth it over brotli
+        # for the part of the work it saves.
+        if fragments and compression.accepts(accept_encoding, compression.GZIP):
+            encoding = compression.GZIP
+            content = compression.gzip_with_fragments(
+                response.content, get_deflated_fragments(fragments))
+        else:
+            content = compression.compress(response.content, encoding)
+
+        if len(content) >= len(response.content):
+            return response
+
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = encoding
+
+        # The compressed bytes differ, so a strong ETag would be wrong.
+        etag = response.get('ETag')
+
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+
+        return response
+
+    def should_compress(self, request, response):
+        if has_csrf_token(request):
+            return False
+
+        if response.streaming or response.has_header('Content-Encoding'):
+            return False
+
+        if response.status_code != 200 or len(response.content) < self.MIN_SIZE:
+            return False
+
+        content_type = response.get('Content-Type', '').lower()
+
+        return content_type.startswith(self.CONTENT_TYPES)
+
+
+def has_csrf_token(request):
+    """Returns True if the response includes a plain CSRF token. It is set
+    by use_csrf_token(), or by Django's get_token().
+    """
+    return bool(request.META.get('CSRF_COOKIE_USED'))
+
+
+def get_deflated_fragments(fragments):
+    """Returns (<bytes>, <deflated>) for each (<bytes>, <memcache key>) pair.
+    Fragments which aren't cached are deflated and cached.
+    """
+    cached = memcache.get_multi([key for _, key in fragments])
+    missing = {}
+    result = []
+
+    for data, key in fragments:
+        deflated = cached.get(key)
+
+        if deflated is None:
+            deflated = compression.deflate_fragment(data)
+
+            if len(deflated) <= cache.MAX_VALUE_SIZE:
+                missing[key] = deflated
+
+        result.append((data, deflated))
+
+    if missing:
+        memcache.set_multi(missing, time=cache.CACHE_TTL)
+
+    return result
+
+
 class PastyVersionMiddleware(object):
     """Adds a X-Pasty-Version header to the response."""
     key = 'X-Pasty-Version'
@@ -60,3 +297,67 @@ class PastyVersionMiddleware(object):
         response[self.key] = self.version
 
         return response
+
+
+class RequestStatsMiddleware(object):
+    """Records wall time, CPU time and App Engine API calls (datastore,
+    memcache, Cloud Storage, search) plus time spent highlighting, for a
+    sample of requests. Adds a Server-Timing header and logs the numbers.
+
+    settings.PASTY_STATS_SAMPLE_RATE is the fraction of requests to sample,
+    from 0 to 1. Requests not sampled have next to no overhead.
+
+    N.B. This should come first, so it measures the other middleware too.
+    """
+    key = 'Server-Timing'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sample_rate = getattr(settings, 'PASTY_STATS_SAMPLE_RATE', 0)
+
+        if random.random() >= sample_rate:
+            return self.get_response(request)
+
+        with instrumentation.collect() as stats:
+            response = self.get_response(request)
+
+        response[self.key] = stats.server_timing()
+
+        record = stats.as_dict()
+        record.update(path=request.path, status=response.status_code)
+        logger.info('Request stats %s', json.dumps(record, sort_keys=True))
+
+        return response
+
+
+class ProfilerMiddleware(object):
+    """Runs the request under cProfile when an admin adds ?_profile=1 to the
+    URL or sends an X-Pasty-Profile header. The profile is saved for download
+    from the admin pages, and the response has a X-Pasty-Profile header with
+    the URL for the pstats file.
+
+    Other users asking for a profile get a 403, the same as for views.admin.
+    """
+    param = '_profile'
+    header = 'HTTP_X_PASTY_PROFILE'
+    key = 'X-Pasty-Profile'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.profile_response = environment.task_or_admin_only(self._profile_response)
+
+    def __call__(self, request):
+        if (self.param in request.GET) or (self.header in request.META):
+            return self.profile_response(request)
+
+        return self.get_response(request)
+
+    def _profile_response(self, request):
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        name = profiling.save_profile(profiler, request.get_full_path())
+        response[self.key] = reverse('admin_profile_download', args=[name + profiling.PSTATS_EXT])
+
+        return response
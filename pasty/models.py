@@ -1,19 +1,33 @@
+import hashlib
+import io
+import json
 import mimetypes
 import os.path
 import re
 
-import cloudstorage
+from django.conf import settings
 from django.http import Http404
 from django.urls import reverse
 from django.utils import safestring
 from django.utils import text
 from django.utils import timezone
-from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
+from pygments import lexers
+from . import analysis
+from . import cache
+from . import compression
+from . import renderers
+from . import storage
 from . import utils
 
 
 BUCKET_KEY = 'CLOUD_STORAGE_BUCKET'
+
+#: Change this when rendering changes, so cached markup isn't used. Each
+#: renderer has its own version too.
+RENDER_VERSION = 1
+
 language_choices = [(name, name) for name in utils.get_language_names()]
 
 
@@ -33,10 +47,15 @@ class LexerConfig(ndb.Model):
     @classmethod
     def get_config(cls):
         """Singleton method to get a map of extensions to languages."""
-        config = cls.get()
+        return cls.get_config_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_config_async(cls):
+        config = yield cls.get_or_insert_async('config', lexers=[])
         mapping = {obj.extension: obj.language for obj in config.lexers}
 
-        return mapping
+        raise ndb.Return(mapping)
 
 
 def make_name_for_storage(paste_id, filename, n, dt):
@@ -76,34 +95,143 @@ class PastyFile(ndb.Model):
     path = ndb.StringProperty()
     relative_path = ndb.StringProperty()
     num_lines = ndb.IntegerProperty(default=0)
+    # How the content is stored, 'gzip' or None for uncompressed.
+    encoding = ndb.StringProperty(indexed=False)
+    # Small files are kept here instead of in Cloud Storage.
+    inline_content = ndb.BlobProperty()
+    # From analysis.analyze(), when the file was created. size is in bytes,
+    # before compression.
+    size = ndb.IntegerProperty(indexed=False)
+    content_hash = ndb.StringProperty(indexed=False)
+    is_binary = ndb.BooleanProperty(indexed=False)
+
+    def content_highlight(self, config=None):
+        """Returns the file content as HTML, highlighted or rendered by the
+        renderer for the file type, see the renderers module. Pass the
+        LexerConfig mapping when highlighting several files.
+        """
+        if config is None:
+            config = LexerConfig.get_config()
+
+        def render():
+            with self.open() as fh:
+                text = fh.read()
+
+            return renderers.render(
+                text, filename=self.filename, config=config, digest=self.content_hash,
+                is_binary=self.is_binary)
+
+        key, stale_key = self.render_cache_keys(config)
+        markup = cache.get_or_set(key, render, stale_key=stale_key)
 
-    def content_highlight(self):
-        """Returns the file content with syntax highlighting."""
-        with self.open('r') as fh:
-            text = fh.read()
+        return safestring.mark_safe(markup)
 
-        config = LexerConfig.get_config()
-        _, markup = utils.highlight_content(text, filename=self.filename, config=config)
+    def content_tokens(self, config=None, encoding=None):
+        """Returns the file's highlighting tokens as a JSON string, see
+        utils.tokenize_content(). With encoding ('gzip' or 'br') the JSON is
+        compressed, and that is cached too.
+        """
+        if config is None:
+            config = LexerConfig.get_config()
 
-        return safestring.mark_safe(markup)
+        def tokenize():
+            with self.open() as fh:
+                text = fh.read()
+
+            # Binary content is not worth choosing a lexer for.
+            lexer = lexers.TextLexer() if self.is_binary else None
+            lexer, tokens = utils.tokenize_content(
+                text, filename=self.filename, config=config, digest=self.content_hash,
+                lexer=lexer)
+            tokens['lexer'] = lexer.name
+            tokens['cssclass'] = utils.highlight_cssclass()
+
+            return json.dumps(tokens, separators=(',', ':'))
+
+        key = 'tokens:' + self.render_version(config)
+
+        if encoding:
+            def compress():
+                return compression.compress(self.content_tokens(config), encoding, best=True)
+
+            return cache.get_or_set(key + ':' + encoding, compress)
+
+        return cache.get_or_set(key, tokenize)
+
+    def render_version(self, config):
+        """Returns a string which changes when the file's highlighting would,
+        because of the RENDER_VERSION, the renderer's version or the lexer
+        config.
+        """
+        renderer = renderers.get_renderer(self.filename, config)
+        name = '%d:%s:%d:%s:%r' % (
+            RENDER_VERSION, renderer.name, renderer.version, self._path_bytes(),
+            sorted(config.items()))
 
-    def bucket_path(self):
-        bucket = app_identity.get_default_gcs_bucket_name()
+        return hashlib.sha1(name).hexdigest()
 
-        return '/%s/%s' % (bucket, self.path)
+    def render_cache_keys(self, config):
+        """Returns keys for the highlighted content, and for a stale copy
+        which may be from an older render version or lexer config.
+        """
+        key = 'render:' + self.render_version(config)
+        stale_key = 'render-stale:' + hashlib.sha1(self._path_bytes()).hexdigest()
+
+        return key, stale_key
+
+    def deflated_cache_key(self, config):
+        """Returns the key for a compression.deflate_fragment() of the
+        highlighted content, next to the highlighted content's key.
+        """
+        key, _ = self.render_cache_keys(config)
+
+        return key + ':deflate'
+
+    def _path_bytes(self):
+        path = self.path
+
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+
+        return path
+
+    @property
+    def is_inline(self):
+        return self.inline_content is not None
 
     @classmethod
-    def create(cls, filename, content, path, relative_path, num_lines):
-        """Save the content to cloud storage and return a new PastyFile."""
-        if isinstance(content, unicode):
-            content = content.encode('utf-8')
+    def create(cls, filename, content, path, relative_path, num_lines=None, inline_limit=0, info=None):
+        """Returns a new PastyFile for the content. The content is kept on the
+        PastyFile if it is no more than inline_limit bytes once compressed,
+        otherwise it is saved to Cloud Storage. info is the content's
+        analysis.Analysis, if you already have it.
+        """
+        if info is None:
+            info = analysis.analyze(content)
+
+        content = info.data
+
+        if num_lines is None:
+            num_lines = info.num_lines
 
         pfile = cls(
             filename=filename, path=path, relative_path=relative_path,
-            num_lines=num_lines)
+            num_lines=num_lines, size=info.size, content_hash=info.content_hash,
+            is_binary=info.is_binary)
 
-        with pfile.open('w') as fh:
-            fh.write(content)
+        # Text compresses well. Very short content does not, so it is left
+        # as it is.
+        compressed = compression.gzip_bytes(content)
+
+        if len(compressed) < len(content):
+            content = compressed
+            pfile.encoding = compression.GZIP
+
+        if len(content) <= inline_limit:
+            pfile.inline_content = content
+        else:
+            storage.get_storage().write(
+                path, content, content_type=pfile.content_type, encoding=pfile.encoding)
 
         return pfile
 
@@ -114,10 +242,36 @@ class PastyFile(ndb.Model):
 
         return content_type or self.DEFAULT_CONTENT_TYPE
 
-    def open(self, mode='r'):
-        path = self.bucket_path()
+    def open(self, raw=False):
+        """Opens the file content for reading, wherever it is stored. The
+        content is decompressed, unless raw is True.
+        """
+        if self.is_inline:
+            fh = io.BytesIO(self.inline_content)
+        else:
+            fh = storage.get_storage().open(self.path)
+
+        if self.encoding == compression.GZIP and not raw:
+            fh = compression.open_gzip(fh)
 
-        return cloudstorage.open(path, mode)
+        return fh
+
+    def to_summary(self):
+        """Returns a copy with the file details but not the content, for a
+        PasteSummary.
+        """
+        return PastyFile(
+            created=self.created, filename=self.filename, path=self.path,
+            relative_path=self.relative_path, num_lines=self.num_lines)
+
+    def _to_dict(self, include=None, exclude=None):
+        # How the content is stored isn't part of the API.
+        exclude = list(exclude or []) + [
+            'encoding', 'inline_content', 'size', 'content_hash', 'is_binary']
+
+        return super(PastyFile, self)._to_dict(include=include, exclude=exclude)
+
+    to_dict = _to_dict
 
 
 class Paste(ndb.Model):
@@ -126,6 +280,7 @@ class Paste(ndb.Model):
     filename = ndb.StringProperty(required=True, default=PastyFile.DEFAULT_FILENAME)
     description = ndb.StringProperty()
     fork = ndb.KeyProperty(kind='Paste')
+    fork_title = ndb.StringProperty(indexed=False)
     files = ndb.LocalStructuredProperty(PastyFile, repeated=True)
     preview = ndb.TextProperty()
 
@@ -139,8 +294,11 @@ class Paste(ndb.Model):
         """Creates a new Paste and saves files in storage."""
         fork = kwargs.get('fork')
 
-        if fork:
+        # fork can be a Paste or a key. Keep the forked paste's title so
+        # listings don't have to fetch it.
+        if isinstance(fork, Paste):
             kwargs['fork'] = fork.key
+            kwargs['fork_title'] = unicode(fork)
 
         # OK. We need to create the Paste, then we can save the files to storage
         # (because the storage name includes the paste's ID), then we update
@@ -151,28 +309,36 @@ class Paste(ndb.Model):
         right_now = timezone.now()
         paste_id = paste.key.id()
         config = LexerConfig.get_config()
+        # Inline files are limited in total, to keep the paste well under
+        # the datastore's entity size limit.
+        inline_remaining = settings.PASTY_INLINE_PASTE_MAX_BYTES
 
         # files is a sequence of (filename, content) pairs. But filename can
         # be '', in which case we choose a name based on the content's format
         # (e.g. if it looks like CSS, we choose 'untitled.css').
         for n, filename_content in enumerate(files, 1):
             filename, content = filename_content
+            info = analysis.analyze(content)
 
-            # If no filename, we pick one.
+            # If no filename, we pick one. The language is guessed from the
+            # first few lines, rather than the whole file.
             if not filename:
-                lexer = utils.choose_lexer(content)
+                lexer = utils.choose_lexer(info.head)
                 ext = utils.ext_for_lexer(lexer)
                 filename = PastyFile.DEFAULT_FILENAME.replace('.txt', ext)
 
-            num_lines = utils.count_lines(content)
             path = make_name_for_storage(paste_id, filename, n, right_now)
             relative_path = make_relative_path(path)
 
+            inline_limit = min(settings.PASTY_INLINE_MAX_BYTES, inline_remaining)
             pfile = PastyFile.create(
                 filename=filename, content=content, path=path,
-                num_lines=num_lines, relative_path=relative_path)
+                relative_path=relative_path, inline_limit=inline_limit, info=info)
             paste.files.append(pfile)
 
+            if pfile.is_inline:
+                inline_remaining -= len(pfile.inline_content)
+
         if files:
             # The first file is used to set the paste's own filename and
             # preview.
@@ -182,7 +348,8 @@ class Paste(ndb.Model):
             paste.preview = preview
             paste.filename = fname
 
-        paste.put()
+        # The summary is what listings load instead of the whole paste.
+        ndb.put_multi([paste, paste.to_summary()])
 
         return paste
 
@@ -190,17 +357,22 @@ class Paste(ndb.Model):
     @classmethod
     def get_or_404(cls, paste_id):
         """Returns a paste object. Raises Http404 if the paste_id is invalid."""
+        return cls.get_or_404_async(paste_id).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_or_404_async(cls, paste_id):
         try:
             paste_id = int(paste_id)
         except (ValueError, TypeError):
             raise Http404
 
-        paste = cls.get_by_id(paste_id)
+        paste = yield cls.get_by_id_async(paste_id)
 
         if not paste:
             raise Http404
 
-        return paste
+        raise ndb.Return(paste)
 
     @ndb.ComputedProperty
     def num_files(self):
@@ -218,7 +390,7 @@ class Paste(ndb.Model):
 
     def to_dict(self):
         # Avoid problems when JSON-ifying a forked paste.
-        obj = super(Paste, self).to_dict()
+        obj = super(Paste, self).to_dict(exclude=['fork_title'])
         obj['id'] = self.key.id()
         obj['url'] = self.url
 
@@ -231,6 +403,73 @@ class Paste(ndb.Model):
         """Helper to get/create a Star for this paste."""
         return Star.create(author, self)
 
+    def to_summary(self):
+        """Returns a PasteSummary with just the fields for listing pages."""
+        return PasteSummary(
+            id=self.key.id(),
+            created=self.created,
+            author=self.author,
+            filename=self.filename,
+            description=self.description,
+            fork=self.fork,
+            fork_title=self.fork_title,
+            preview=self.preview,
+            num_lines=self.num_lines,
+            num_files=self.num_files,
+            files=[pasty_file.to_summary() for pasty_file in self.files],
+        )
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        # Listings load the summary rather than the paste, so it has to go
+        # too. Then search results for the paste find nothing, and its
+        # search document is removed, see index.SearchResults.
+        ndb.Key(PasteSummary, key.id()).delete()
+
+
+class PasteSummary(ndb.Model):
+    """The parts of a paste shown in listings, without the files' content. It
+    has the same ID as the paste.
+    """
+    created = ndb.DateTimeProperty(indexed=False)
+    author = ndb.StringProperty(indexed=False)
+    filename = ndb.StringProperty(indexed=False)
+    description = ndb.StringProperty(indexed=False)
+    fork = ndb.KeyProperty(kind='Paste', indexed=False)
+    fork_title = ndb.StringProperty(indexed=False)
+    preview = ndb.TextProperty()
+    num_lines = ndb.IntegerProperty(indexed=False)
+    num_files = ndb.IntegerProperty(indexed=False)
+    # Details of each file, without the content. See PastyFile.to_summary().
+    files = ndb.LocalStructuredProperty(PastyFile, repeated=True)
+
+    def __unicode__(self):
+        author = self.author if self.author else u'anonymous'
+
+        return u'%s / %s' % (author, self.filename)
+
+    @property
+    def url(self):
+        url = reverse('paste_detail', args=[self.key.id()])
+
+        return url
+
+    @property
+    def is_outdated(self):
+        # Summaries saved before they had the file details.
+        return bool(self.num_files) and not self.files
+
+    def to_dict(self):
+        # The same as Paste.to_dict(), for the API.
+        obj = super(PasteSummary, self).to_dict(exclude=['fork_title'])
+        obj['id'] = self.key.id()
+        obj['url'] = self.url
+
+        if obj['fork']:
+            obj['fork'] = obj['fork'].id()
+
+        return obj
+
 
 class Star(ndb.Model):
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -241,11 +480,26 @@ class Star(ndb.Model):
     def create(self, author, paste):
         # We construct the star id ourselves so that if you star something
         # twice it doesn't create multiple stars for the same paste.
-        star_id = u'%s/%s' % (author, paste.key.id())
+        star_id = Star.make_id(author, paste.key.id())
         star = Star.get_or_insert(star_id, author=author, paste=paste.key)
 
         return star
 
+    @staticmethod
+    def make_id(author, paste_id):
+        return u'%s/%s' % (author, paste_id)
+
+    @classmethod
+    @ndb.tasklet
+    def get_for_author_async(cls, author, paste_id):
+        """Gets the author's star for the paste, or None."""
+        star = None
+
+        if author:
+            star = yield ndb.Key(cls, cls.make_id(author, paste_id)).get_async()
+
+        raise ndb.Return(star)
+
 
 class Peeling(ndb.Model):
     """Legacy model for converting old peelings to new pastes."""
@@ -255,10 +509,120 @@ class Peeling(ndb.Model):
 
 
 def get_starred_pastes(email):
-    """Returns pastes starred by a user, ordered by when the paste was starred."""
-    stars = Star.query().filter(Star.author==email).order(-Star.created).fetch(100)
-    keys = [star.paste for star in stars]
-    pastes = [key.get() for key in keys]
-    pastes.sort(key=lambda x: keys.index(x.key))
+    """Returns PasteSummary objects for the pastes starred by a user, ordered
+    by when the paste was starred.
+    """
+    return get_starred_pastes_async(email).get_result()
+
+
+@ndb.tasklet
+def get_starred_pastes_async(email):
+    query = Star.query().filter(Star.author==email).order(-Star.created)
+    stars = yield query.fetch_async(100)
+    # Summaries, so the pastes' inline file content isn't loaded.
+    pastes = yield get_summaries_async([star.paste for star in stars])
+
+    # Skip stars for pastes which have since been deleted.
+    raise ndb.Return([paste for paste in pastes if paste])
+
+
+def highlight_files(pasty_files, config):
+    """Returns the highlighted content of each PastyFile. Files are read and
+    highlighted in worker threads, so reads from storage overlap.
+    """
+    def highlight(pasty_file):
+        return pasty_file.content_highlight(config)
+
+    return utils.map_threaded(highlight, pasty_files, max_workers=settings.PASTY_WORKER_THREADS)
+
+
+def read_files(pasty_files):
+    """Returns the content of each PastyFile. Files in storage are fetched
+    together.
+    """
+    paths = [pasty_file.path for pasty_file in pasty_files if not pasty_file.is_inline]
+    stored = iter(storage.get_storage().read_multi(paths))
+    contents = []
+
+    for pasty_file in pasty_files:
+        if pasty_file.is_inline:
+            content = pasty_file.inline_content
+        else:
+            content = next(stored)
+
+        if pasty_file.encoding == compression.GZIP:
+            content = compression.gunzip_bytes(content)
+
+        contents.append(content)
+
+    return contents
+
+
+def prefetch_forks(pastes):
+    """Sets fork_title for pastes (or summaries) that were forked before the
+    title was saved with the paste, fetching all the forks at once.
+    """
+    pastes = [paste for paste in pastes if paste.fork and not paste.fork_title]
+
+    if not pastes:
+        return
+
+    forks = ndb.get_multi(set(paste.fork for paste in pastes))
+    titles = {fork.key: unicode(fork) for fork in forks if fork}
+
+    for paste in pastes:
+        paste.fork_title = titles.get(paste.fork)
+
+
+def get_recent_paste_keys(cursor_string=None, limit=10):
+    """Returns a pair of (keys, cursor_string) for a page of pastes, newest
+    first. The cursor is None when there are no more pages.
+    """
+    query = Paste.query().order(-Paste.created)
+    bad_cursor_errors = (
+        datastore_errors.BadArgumentError,
+        datastore_errors.BadRequestError,
+        datastore_errors.BadValueError,
+    )
+
+    try:
+        cursor = ndb.Cursor(urlsafe=cursor_string) if cursor_string else None
+        keys, cursor, more = query.fetch_page(limit, start_cursor=cursor, keys_only=True)
+    except bad_cursor_errors:
+        # A bogus cursor, or one from a search. Start at the beginning.
+        keys, cursor, more = query.fetch_page(limit, keys_only=True)
+
+    cursor_string = cursor.urlsafe() if (more and cursor) else None
+
+    return keys, cursor_string
+
+
+def get_summaries(paste_keys):
+    """Returns a list of PasteSummary objects for the paste keys, with None
+    where the paste does not exist.
+
+    Pastes saved before summaries existed get one made and saved now, as do
+    summaries saved before they had the file details.
+    """
+    return get_summaries_async(paste_keys).get_result()
+
+
+@ndb.tasklet
+def get_summaries_async(paste_keys):
+    summary_keys = [ndb.Key(PasteSummary, key.id()) for key in paste_keys]
+    summaries = yield ndb.get_multi_async(summary_keys)
+    missing = [
+        key for key, obj in zip(paste_keys, summaries) if (obj is None) or obj.is_outdated]
+
+    if missing:
+        made = {}
+        pastes = yield ndb.get_multi_async(missing)
+
+        for paste in pastes:
+            if paste:
+                made[paste.key.id()] = paste.to_summary()
+
+        yield ndb.put_multi_async(made.values())
+        summaries = [made.get(key.id(), obj) for key, obj in zip(paste_keys, summaries)]
 
-    return pastes
+    raise ndb.Return(summaries)
@@ -0,0 +1,122 @@
+import collections
+import datetime
+import itertools
+import marshal
+import os.path
+import uuid
+
+from . import storage
+
+
+PROFILES_PREFIX = 'profiles/'
+PSTATS_EXT = '.pstats'
+COLLAPSED_EXT = '.collapsed'
+#: Deepest stack to follow when writing collapsed stacks.
+MAX_DEPTH = 64
+#: Most collapsed stacks to write. The number of paths through the call graph
+#: can grow exponentially with depth.
+MAX_STACKS = 20000
+
+
+def make_profile_name(dt=None):
+    """Returns a unique name for a profile, which sorts by date."""
+    dt = dt or datetime.datetime.utcnow()
+
+    return '{:%Y%m%d-%H%M%S}-{}'.format(dt, uuid.uuid4().hex[:8])
+
+
+def save_profile(profiler, path):
+    """Saves the profile in pstats format and as collapsed stacks (for
+    flamegraph.pl and friends). Returns the profile name.
+    """
+    profiler.create_stats()
+    name = make_profile_name()
+    metadata = {'path': path.encode('utf-8')}
+    store = storage.get_storage()
+
+    with store.open_write(PROFILES_PREFIX + name + PSTATS_EXT, metadata=metadata) as fh:
+        fh.write(marshal.dumps(profiler.stats))
+
+    lines = collapsed_stacks(profiler.stats)
+    content = u''.join(u'%s %d\n' % (stack, value) for stack, value in lines)
+
+    with store.open_write(PROFILES_PREFIX + name + COLLAPSED_EXT, metadata=metadata) as fh:
+        fh.write(content.encode('utf-8'))
+
+    return name
+
+
+def list_profiles():
+    """Returns a list of StoredFile for saved profiles, newest first. Names
+    are without PROFILES_PREFIX.
+    """
+    files = storage.get_storage().listdir(PROFILES_PREFIX)
+
+    return [
+        storage.StoredFile(obj.name[len(PROFILES_PREFIX):], obj.size)
+        for obj in reversed(files)]
+
+
+def open_profile(name):
+    """Returns a file object for a saved profile. Raises IOError if it
+    does not exist.
+    """
+    return storage.get_storage().open(PROFILES_PREFIX + name)
+
+
+def frame_name(func):
+    filename, lineno, funcname = func
+    # Semi-colons separate frames in the collapsed format.
+    name = u'%s:%d:%s' % (os.path.basename(filename), lineno, funcname)
+
+    return name.replace(u';', u':')
+
+
+def collapsed_stacks(stats):
+    """Yields pairs of (stack, microseconds) from a cProfile stats dict.
+
+    cProfile only records caller / callee pairs, not whole stacks. So time
+    for a function called from several places is shared out by the number of
+    calls from each place, which is a good approximation.
+
+    Paths with less than a microsecond of time in them are not followed, and
+    no more than MAX_STACKS are returned.
+    """
+    callees = collections.defaultdict(dict)
+
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    roots = [func for func, value in stats.items() if not value[4]]
+
+    def walk(func, path, calls_fraction):
+        # calls_fraction is the share of this function's calls on this path.
+        cc, nc, tt, ct, callers = stats[func]
+
+        if int(ct * calls_fraction * 1e6) == 0:
+            return
+
+        path = path + [frame_name(func)]
+        value = int(tt * calls_fraction * 1e6)
+
+        if value:
+            yield u';'.join(path), value
+
+        if len(path) >= MAX_DEPTH:
+            return
+
+        # Caller edges are (nc, cc, tt, ct), unlike the stats themselves.
+        for callee, (nc, cc, tt, ct) in callees[func].items():
+            if frame_name(callee) in path:
+                continue
+
+            total_calls = stats[callee][1] or 1
+            callee_calls_fraction = calls_fraction * (float(nc) / total_calls)
+
+            for line in walk(callee, path, callee_calls_fraction):
+                yield line
+
+    lines = itertools.chain.from_iterable(walk(root, [], 1.0) for root in roots)
+
+    return itertools.islice(lines, MAX_STACKS)
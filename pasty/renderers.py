@@ -0,0 +1,133 @@
+"""Renderers turn a file's content into HTML for the paste page.
+
+Most files are highlighted with Pygments. Markdown files are rendered as
+Markdown, unless the lexer config says how to highlight the extension.
+Content over a renderer's size limit, and binary content, is shown as plain
+text.
+"""
+import collections
+import os.path
+
+import mistune
+from django.conf import settings
+from pygments import lexers
+
+from . import instrumentation
+from . import utils
+
+
+#: Mapping of {<name>: <renderer>}.
+RENDERERS = collections.OrderedDict()
+
+#: Mapping of {<extension>: <renderer name>}, for files not highlighted.
+EXTENSIONS = {
+    'markdown': 'markdown',
+    'md': 'markdown',
+}
+
+DEFAULT_RENDERER = 'pygments'
+FALLBACK_RENDERER = 'plain'
+
+
+def register(cls):
+    """Class decorator to add a renderer to the registry."""
+    RENDERERS[cls.name] = cls()
+
+    return cls
+
+
+class Renderer(object):
+    """Base class for renderers. Change the version when a renderer's output
+    changes, so markup cached for the old version isn't used.
+    """
+    name = None
+    version = 1
+    #: The setting for the most characters the renderer will take, or None.
+    max_chars_setting = None
+
+    @property
+    def max_chars(self):
+        if self.max_chars_setting:
+            return getattr(settings, self.max_chars_setting)
+
+    def accepts(self, content):
+        """Returns False if the content is too costly to render."""
+        max_chars = self.max_chars
+
+        return max_chars is None or len(content) <= max_chars
+
+    def render(self, content, filename=None, config=None, digest=None):
+        """Returns the content as HTML. digest is the content's
+        tokens.content_hash(), if known.
+        """
+        raise NotImplementedError
+
+
+@register
+class PygmentsRenderer(Renderer):
+    name = 'pygments'
+    max_chars_setting = 'PASTY_HIGHLIGHT_MAX_CHARS'
+
+    def render(self, content, filename=None, config=None, digest=None):
+        _, markup = utils.highlight_content(
+            content, filename=filename, config=config, digest=digest)
+
+        return markup
+
+
+@register
+class MarkdownRenderer(Renderer):
+    name = 'markdown'
+    max_chars_setting = 'PASTY_MARKDOWN_MAX_CHARS'
+
+    def render(self, content, filename=None, config=None, digest=None):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+
+        # HTML in the content is escaped. A Markdown object keeps state
+        # while parsing, so each call gets its own.
+        markdown = mistune.Markdown(renderer=mistune.Renderer(escape=True))
+
+        with instrumentation.timer('markdown'):
+            markup = markdown(content)
+
+        return u'<div class="content markdown">%s</div>\n' % markup
+
+
+@register
+class PlainRenderer(Renderer):
+    name = 'plain'
+
+    def render(self, content, filename=None, config=None, digest=None):
+        # The same markup as highlighting with the text lexer, but without
+        # guessing the language.
+        tokens = lexers.TextLexer().get_tokens(content)
+
+        return utils.format_html(tokens)
+
+
+def get_renderer(filename, config=None):
+    """Returns the renderer for a file name. config is the LexerConfig
+    mapping, which takes precedence over the registry.
+    """
+    _, ext = os.path.splitext((filename or u'').lower())
+    ext = ext.lstrip('.')
+
+    if config and (ext in config):
+        name = DEFAULT_RENDERER
+    else:
+        name = EXTENSIONS.get(ext, DEFAULT_RENDERER)
+
+    return RENDERERS[name]
+
+
+def render(content, filename=None, config=None, digest=None, is_binary=False):
+    """Returns the content as HTML, using the renderer for the file name.
+    Binary content is not highlighted.
+    """
+    renderer = get_renderer(filename, config=config)
+
+    if is_binary or not renderer.accepts(content):
+        renderer = RENDERERS[FALLBACK_RENDERER]
+
+    return renderer.render(content, filename=filename, config=config, digest=digest)
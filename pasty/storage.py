@@ -0,0 +1,231 @@
+"""Where paste file content is kept.
+
+Storage backends work with names relative to the storage root, the same as
+PastyFile.path. Choose the backend with the PASTY_STORAGE setting.
+"""
+import collections
+import errno
+import mmap
+import os
+
+import cloudstorage
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.module_loading import import_string
+from google.appengine.api import app_identity
+from google.appengine.ext import blobstore
+
+from . import utils
+
+
+_backends = {}
+
+#: A stored file, as returned by Storage.listdir().
+StoredFile = collections.namedtuple('StoredFile', ['name', 'size'])
+
+
+def get_storage():
+    """Returns the storage backend from the PASTY_STORAGE setting."""
+    path = settings.PASTY_STORAGE
+
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+
+    return _backends[path]
+
+
+class Storage(object):
+    """Base class for storage backends. Subclasses must implement open(),
+    open_write(), delete(), exists(), listdir() and serve(). The rest can be
+    overridden where the backend can do better.
+    """
+    def open(self, name):
+        """Returns a file object for reading. Raises IOError if the file
+        does not exist.
+        """
+        raise NotImplementedError
+
+    def open_write(self, name, content_type=None, encoding=None, metadata=None):
+        """Returns a file object for writing. The content_type, encoding
+        (e.g. 'gzip') and metadata dict are saved with the file where the
+        backend supports it.
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Deletes the file. Does nothing if it does not exist."""
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def listdir(self, prefix):
+        """Returns a list of StoredFile for the files with names starting
+        with prefix, sorted by name.
+        """
+        raise NotImplementedError
+
+    def serve(self, name, content_type):
+        """Returns an HttpResponse for the file's stored bytes."""
+        raise NotImplementedError
+
+    def read(self, name):
+        with self.open(name) as fh:
+            return fh.read()
+
+    def read_range(self, name, start, end):
+        """Returns the bytes from start up to (not including) end."""
+        with self.open(name) as fh:
+            fh.seek(start)
+
+            return fh.read(end - start)
+
+    def write(self, name, data, content_type=None, encoding=None, metadata=None):
+        with self.open_write(name, content_type=content_type, encoding=encoding,
+                             metadata=metadata) as fh:
+            fh.write(data)
+
+    def read_multi(self, names):
+        """Returns a list with the content of each file."""
+        return [self.read(name) for name in names]
+
+    def delete_multi(self, names):
+        for name in names:
+            self.delete(name)
+
+
+class GCSStorage(Storage):
+    """Files in the app's default Google Cloud Storage bucket."""
+    def bucket_path(self, name):
+        bucket = app_identity.get_default_gcs_bucket_name()
+
+        return '/%s/%s' % (bucket, name)
+
+    def open(self, name):
+        try:
+            return cloudstorage.open(self.bucket_path(name))
+        except cloudstorage.NotFoundError as err:
+            raise IOError(errno.ENOENT, str(err), name)
+
+    def open_write(self, name, content_type=None, encoding=None, metadata=None):
+        options = {'x-goog-meta-%s' % key: value for key, value in (metadata or {}).items()}
+
+        if encoding:
+            options['content-encoding'] = encoding
+
+        return cloudstorage.open(
+            self.bucket_path(name), 'w', content_type=content_type, options=options or None)
+
+    def read_multi(self, names):
+        # Opening a file waits for the first part of it, so files are read
+        # from several threads.
+        return utils.map_threaded(self.read, names, max_workers=settings.PASTY_WORKER_THREADS)
+
+    def delete(self, name):
+        try:
+            cloudstorage.delete(self.bucket_path(name))
+        except cloudstorage.NotFoundError:
+            pass
+
+    def exists(self, name):
+        try:
+            cloudstorage.stat(self.bucket_path(name))
+        except cloudstorage.NotFoundError:
+            return False
+
+        return True
+
+    def listdir(self, prefix):
+        root = self.bucket_path('')
+        files = [
+            StoredFile(obj.filename[len(root):], obj.st_size)
+            for obj in cloudstorage.listbucket(self.bucket_path(prefix))]
+
+        return sorted(files)
+
+    def serve(self, name, content_type):
+        # App Engine serves the file itself when it sees the blob key header.
+        blob_key = blobstore.create_gs_key('/gs' + self.bucket_path(name))
+        response = HttpResponse(content_type=content_type)
+        response[blobstore.BLOB_KEY_HEADER] = str(blob_key)
+
+        return response
+
+
+class LocalStorage(Storage):
+    """Files in a directory on the local filesystem, for development and
+    benchmarks. The directory is the PASTY_LOCAL_STORAGE_ROOT setting,
+    unless you give one.
+    """
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root or settings.PASTY_LOCAL_STORAGE_ROOT
+
+    def path(self, name):
+        path = os.path.normpath(os.path.join(self.root, name))
+
+        if not path.startswith(os.path.join(self.root, '')):
+            raise ValueError('Invalid file name %r' % name)
+
+        return path
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def open_write(self, name, content_type=None, encoding=None, metadata=None):
+        path = self.path(name)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        return open(path, 'wb')
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def listdir(self, prefix):
+        # Only walk the directory the prefix is in, not the whole root.
+        directory = prefix.rpartition('/')[0]
+        top = self.path(directory) if directory else self.root
+        files = []
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+
+                if name.startswith(prefix):
+                    files.append(StoredFile(name, os.path.getsize(path)))
+
+        return sorted(files)
+
+    def read_range(self, name, start, end):
+        # Map the file rather than reading it, so only the pages for the
+        # range are loaded.
+        with self.open(name) as fh:
+            if not os.fstat(fh.fileno()).st_size:
+                return b''
+
+            mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                return mapped[start:end]
+            finally:
+                mapped.close()
+
+    def serve(self, name, content_type):
+        # FileResponse lets the WSGI server send the file with sendfile().
+        return FileResponse(self.open(name), content_type=content_type)
@@ -45,6 +45,8 @@ def resave_paste(entity):
     if dirty:
         paste.put()
 
+    # Keep the listing summary in step with the paste.
+    paste.to_summary().put()
     index.add_paste(paste)
 
 
@@ -80,9 +82,9 @@ def convert_peeling(entity):
     peeling = entity_to_instance(entity)
     data = peeling.to_dict()
     paste_id = peeling.key.id()
-    forked_from = ndb.Key(Paste, data['fork_of_id']) if data['fork_of_id'] else None
+    fork = ndb.Key(Paste, data['fork_of_id']) if data['fork_of_id'] else None
     filename = make_peeling_filename(data)
 
     Paste.create_with_files(
         files=[(filename, data['content'])], id=paste_id, created=data['created'],
-        author=None, description=data['title'], forked_from=forked_from)
+        author=None, description=data['title'], fork=fork)
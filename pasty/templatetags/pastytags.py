@@ -2,6 +2,9 @@ import datetime
 
 from django import template
 from django.template import defaultfilters
+from django.urls import reverse
+
+from pasty import utils
 
 
 register = template.Library()
@@ -88,3 +91,14 @@ def params(qdict, **kwargs):
             qdict[name] = value
 
     return qdict.urlencode()
+
+
+@register.simple_tag
+def highlight_css_url(name=None):
+    """Returns the URL for a highlighting style's CSS, by default the one
+    used for pastes. The URL changes when the CSS does.
+    """
+    name = name or utils.PYGMENTS_STYLE
+    fingerprint = utils.highlight_css_fingerprints[name]
+
+    return reverse('highlight_css', args=[name, fingerprint])
@@ -11,27 +11,38 @@ from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 
+from pasty import instrumentation
+
+
+def activate_testbed():
+    """Returns an active testbed with the App Engine service stubs. Call
+    deactivate() on it when you are done.
+    """
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_app_identity_stub()
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    bed.init_urlfetch_stub()
+    bed.init_user_stub()
+    bed.init_search_stub()
+
+    ndb_context = ndb.get_context()
+    ndb_context.clear_cache()
+    ndb_context.set_cache_policy(False)
+    ndb_context.set_memcache_policy(False)
+
+    return bed
+
 
 class AppEngineTestCase(TestCase):
     def setUp(self):
         super(AppEngineTestCase, self).setUp()
 
-        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
-
-        self.testbed = testbed.Testbed()
-        self.testbed.activate()
-        self.testbed.init_app_identity_stub()
-        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
-        self.testbed.init_memcache_stub()
-        self.testbed.init_taskqueue_stub()
-        self.testbed.init_urlfetch_stub()
-        self.testbed.init_user_stub()
-        self.testbed.init_search_stub()
-
-        ndb_context = ndb.get_context()
-        ndb_context.clear_cache()
-        ndb_context.set_cache_policy(False)
-        ndb_context.set_memcache_policy(False)
+        self.testbed = activate_testbed()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -47,6 +58,29 @@ class AppEngineTestCase(TestCase):
         os.environ['USER_ID'] = user_id
         os.environ['USER_IS_ADMIN'] = '1' if is_admin else '0'
 
+    @contextlib.contextmanager
+    def assertRPCs(self, **budgets):
+        """Fails if the block makes more API calls to a service than its
+        budget, e.g. assertRPCs(datastore=2, gcs=1). Service names are the
+        ones used by pasty.instrumentation.
+        """
+        with count_rpcs() as stats:
+            yield stats
+
+        for name, budget in sorted(budgets.items()):
+            calls = stats.calls[name]
+
+            if calls > budget:
+                msg = '%d %s calls, expected at most %d' % (calls, name, budget)
+                self.fail(msg)
+
+
+def count_rpcs():
+    """Counts API calls made inside the block. Use it as a context manager,
+    it yields a pasty.instrumentation.RequestStats.
+    """
+    return instrumentation.collect()
+
 
 @contextlib.contextmanager
 def freeze_time(*args, **kwargs):
@@ -0,0 +1,29 @@
+import io
+import unittest
+
+from pasty import analysis
+
+
+class AnalyzeTestCase(unittest.TestCase):
+    def test_counts_lines_like_count_lines(self):
+        for content in [u'', u'foo', u'foo\n', u'foo\nbar', u'\n\n', u'caf\xe9\n' * 3]:
+            expected = sum(1 for _ in io.StringIO(content))
+
+            self.assertEqual(analysis.analyze(content).num_lines, expected)
+
+    def test_size_and_hash_are_for_utf8(self):
+        info = analysis.analyze(u'caf\xe9\n')
+
+        self.assertEqual(info.data, b'caf\xc3\xa9\n')
+        self.assertEqual(info.size, 6)
+        self.assertEqual(info.content_hash, '6faf166142e6fa460e85841f3986681f91bd0ac2')
+
+    def test_binary(self):
+        self.assertFalse(analysis.analyze(u'foo\n').is_binary)
+        self.assertTrue(analysis.analyze(b'foo\x00bar').is_binary)
+
+    def test_head(self):
+        info = analysis.analyze(u'x\n' * 100)
+
+        self.assertEqual(info.head, u'x\n' * analysis.HEAD_LINES)
+        self.assertEqual(analysis.analyze(u'foo').head, u'foo')
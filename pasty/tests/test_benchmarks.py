@@ -0,0 +1,69 @@
+import unittest
+
+import mock
+from django.core.management import CommandError, call_command
+
+from pasty import benchmarks
+
+
+class CompareTestCase(unittest.TestCase):
+    def make_results(self, **medians):
+        return {
+            'benchmarks': {name: {'median_ms': ms} for name, ms in medians.items()},
+        }
+
+    def test_finds_regressions(self):
+        baseline = self.make_results(a=10.0, b=10.0, c=10.0)
+        results = self.make_results(a=11.0, b=13.0, d=50.0)
+
+        regressions = benchmarks.compare(results, baseline, threshold=0.2)
+
+        self.assertEqual(regressions, [('b', 10.0, 13.0, 1.3)])
+
+    def test_median(self):
+        self.assertEqual(benchmarks.median([3, 1, 2]), 2)
+        self.assertEqual(benchmarks.median([4, 1, 2, 3]), 2.5)
+
+
+class TimeFunctionTestCase(unittest.TestCase):
+    def test_calls_before_each_run(self):
+        calls = []
+
+        timings = benchmarks.time_function(
+            lambda: calls.append('run'), 2, before=lambda: calls.append('before'))
+
+        self.assertEqual(len(timings), 2)
+        self.assertEqual(calls, ['before', 'run', 'before', 'run'])
+
+
+class MakeContentTestCase(unittest.TestCase):
+    def test_content_is_requested_size(self):
+        content = benchmarks.make_content('example.py', 1000)
+
+        self.assertEqual(len(content), 1000)
+
+
+class RunBenchmarksTestCase(unittest.TestCase):
+    def test_runs_named_benchmarks(self):
+        results = benchmarks.run_benchmarks(['count_lines[1k]'], repeat=2)
+
+        self.assertEqual(list(results['benchmarks']), ['count_lines[1k]'])
+        self.assertEqual(results['benchmarks']['count_lines[1k]']['runs'], 2)
+
+    def test_flushes_memcache_before_timed_runs(self):
+        with mock.patch.object(benchmarks.memcache, 'flush_all') as flush_all:
+            benchmarks.run_benchmarks(['count_lines[1k]'], repeat=3)
+
+        self.assertEqual(flush_all.call_count, 3)
+
+    def test_no_names_runs_nothing(self):
+        self.assertEqual(benchmarks.run_benchmarks([], repeat=1)['benchmarks'], {})
+
+
+class BenchmarkCommandTestCase(unittest.TestCase):
+    def test_unknown_name(self):
+        with mock.patch.object(benchmarks, 'run_benchmarks') as run_benchmarks:
+            with self.assertRaises(CommandError):
+                call_command('benchmark', 'typo')
+
+        self.assertFalse(run_benchmarks.called)
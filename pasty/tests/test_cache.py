@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+
+import mock
+from google.appengine.api import memcache
+
+from . import AppEngineTestCase
+from pasty import cache
+
+
+class GetOrSetTestCase(AppEngineTestCase):
+    def test_caches_value(self):
+        func = mock.Mock(return_value=u'foo')
+
+        self.assertEqual(cache.get_or_set('key', func), u'foo')
+        self.assertEqual(cache.get_or_set('key', func), u'foo')
+        self.assertEqual(func.call_count, 1)
+
+    def test_concurrent_callers_share_one_call(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+
+            return u'foo'
+
+        def get():
+            results.append(cache.get_or_set('key', func))
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+
+        for thread in threads[1:]:
+            thread.start()
+
+        release.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [u'foo'] * 5)
+
+    def test_uses_stale_copy_while_another_instance_renders(self):
+        memcache.add('lease:key', 1)
+        memcache.set('stale', u'old')
+        func = mock.Mock(return_value=u'new')
+
+        self.assertEqual(cache.get_or_set('key', func, stale_key='stale'), u'old')
+        self.assertFalse(func.called)
+
+    def test_waits_for_another_instance(self):
+        memcache.add('lease:key', 1)
+        func = mock.Mock(return_value=u'new')
+
+        timer = threading.Timer(0.2, memcache.set, ['key', u'theirs'])
+        timer.start()
+
+        self.assertEqual(cache.get_or_set('key', func), u'theirs')
+        self.assertFalse(func.called)
+
+    def test_gives_up_waiting_for_another_instance(self):
+        memcache.add('lease:key', 1)
+        func = mock.Mock(return_value=u'new')
+
+        with mock.patch.object(cache, 'LEASE_WAIT', 0.2):
+            self.assertEqual(cache.get_or_set('key', func), u'new')
+
+        self.assertEqual(memcache.get('key'), u'new')
+        # The other instance's lease is left alone.
+        self.assertEqual(memcache.get('lease:key'), 1)
+
+    def test_releases_own_lease(self):
+        cache.get_or_set('key', lambda: u'new')
+
+        self.assertIsNone(memcache.get('lease:key'))
+
+    def test_caches_large_values_in_chunks(self):
+        # Random bytes don't compress, so it needs more than one chunk.
+        value = os.urandom(cache.MAX_VALUE_SIZE + 1000)
+        func = mock.Mock(return_value=value)
+
+        self.assertEqual(cache.get_or_set('key', func, stale_key='stale'), value)
+        self.assertEqual(cache.get_or_set('key', func), value)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(memcache.get('key').count, 2)
+        self.assertEqual(cache._get('stale'), value)
+
+    def test_large_unicode_value(self):
+        value = u'caf\xe9\n' * cache.MAX_VALUE_SIZE
+        cache.get_or_set('key', lambda: value)
+
+        self.assertEqual(cache.get_or_set('key', lambda: u'new'), value)
+
+    def test_waits_for_large_value_from_another_instance(self):
+        memcache.add('lease:key', 1)
+        value = os.urandom(cache.MAX_VALUE_SIZE + 1000)
+        func = mock.Mock(return_value=u'new')
+
+        timer = threading.Timer(0.2, cache._cache_value, ['key', value, None])
+        timer.start()
+
+        self.assertEqual(cache.get_or_set('key', func), value)
+        self.assertFalse(func.called)
+
+    def test_stops_waiting_for_a_value_too_large_to_cache(self):
+        memcache.add('lease:key', 1)
+        memcache.set('key', cache.NotCacheable())
+        func = mock.Mock(return_value=u'new')
+        started = time.time()
+
+        self.assertEqual(cache.get_or_set('key', func), u'new')
+        self.assertLess(time.time() - started, cache.LEASE_WAIT)
+
+    def test_value_too_large_for_chunks(self):
+        with mock.patch.object(cache, 'MAX_CHUNKS', 1):
+            cache._cache_value('key', os.urandom(cache.MAX_VALUE_SIZE + 1000), None)
+
+        self.assertIsInstance(memcache.get('key'), cache.NotCacheable)
+        self.assertIsNone(cache._get('key'))
@@ -0,0 +1,95 @@
+import gzip
+import io
+import unittest
+import zipfile
+import zlib
+
+from pasty import compression
+
+
+class GzipTestCase(unittest.TestCase):
+    def test_gzip_bytes_round_trip(self):
+        data = b'foo bar baz\n' * 100
+        compressed = compression.gzip_bytes(data)
+
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(compression.open_gzip(io.BytesIO(compressed)).read(), data)
+
+    def test_gzip_bytes_is_repeatable(self):
+        self.assertEqual(compression.gzip_bytes(b'foo'), compression.gzip_bytes(b'foo'))
+
+    def test_open_gzip_closes_file(self):
+        fh = io.BytesIO(compression.gzip_bytes(b'foo'))
+
+        with compression.open_gzip(fh) as gzip_file:
+            gzip_file.read()
+
+        self.assertTrue(fh.closed)
+
+    def test_split_gzip(self):
+        data = b'foo bar baz\n' * 100
+        deflated, crc, size = compression.split_gzip(compression.gzip_bytes(data))
+
+        self.assertEqual(zlib.decompress(deflated, -zlib.MAX_WBITS), data)
+        self.assertEqual(crc, zlib.crc32(data) & 0xffffffff)
+        self.assertEqual(size, len(data))
+
+    def test_split_gzip_skips_file_name(self):
+        buf = io.BytesIO()
+
+        with gzip.GzipFile(filename='example.txt', mode='wb', fileobj=buf) as fh:
+            fh.write(b'foo')
+
+        deflated, crc, size = compression.split_gzip(buf.getvalue())
+
+        self.assertEqual(zlib.decompress(deflated, -zlib.MAX_WBITS), b'foo')
+
+    def test_split_gzip_rejects_other_data(self):
+        with self.assertRaises(ValueError):
+            compression.split_gzip(b'foo bar baz')
+
+
+class WriteDeflatedTestCase(unittest.TestCase):
+    def test_adds_entry_to_zip(self):
+        data = b'foo bar baz\n' * 100
+        deflated, crc, size = compression.split_gzip(compression.gzip_bytes(data))
+        buf = io.BytesIO()
+
+        with zipfile.ZipFile(buf, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            compression.write_deflated(archive, 'example.txt', deflated, crc, size)
+            archive.writestr('other.txt', b'other')
+
+        with zipfile.ZipFile(buf) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('example.txt'), data)
+            self.assertEqual(archive.read('other.txt'), b'other')
+
+
+class AcceptEncodingTestCase(unittest.TestCase):
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            compression.parse_accept_encoding('gzip, deflate;q=0.5, br;q=0'),
+            {'gzip': 1.0, 'deflate': 0.5, 'br': 0.0},
+        )
+
+    def test_accepts(self):
+        self.assertTrue(compression.accepts('deflate, GZIP', 'gzip'))
+        self.assertTrue(compression.accepts('*', 'gzip'))
+        self.assertFalse(compression.accepts('gzip;q=0', 'gzip'))
+        self.assertFalse(compression.accepts('', 'gzip'))
+
+    def test_accepted_encoding(self):
+        self.assertEqual(compression.accepted_encoding('gzip, deflate'), 'gzip')
+        self.assertIsNone(compression.accepted_encoding('identity'))
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_prefers_brotli(self):
+        self.assertEqual(compression.accepted_encoding('gzip, br'), 'br')
+
+    def test_compress_gzip(self):
+        data = b'foo bar baz\n' * 100
+
+        self.assertEqual(compression.gunzip_bytes(compression.compress(data, 'gzip', best=True)), data)
+
+        with self.assertRaises(ValueError):
+            compression.compress(data, 'deflate')
@@ -0,0 +1,52 @@
+import mock
+from django.template import engines
+from django.test import RequestFactory
+
+from . import AppEngineTestCase
+from pasty import context_processors
+from pasty.models import Paste
+
+
+class PastyContextProcessorTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(PastyContextProcessorTestCase, self).setUp()
+
+        self.request = RequestFactory().get('/foo/')
+        self.request.user_email = u'alice@example.com'
+
+    def render(self, template):
+        return engines['django'].from_string(template).render({}, self.request)
+
+    def test_unused_values_make_no_api_calls(self):
+        with self.assertRPCs(datastore=0, users=0):
+            self.assertEqual(self.render(u'Hello'), u'Hello')
+
+    def test_values_are_made_when_used(self):
+        paste = Paste.create_with_files(files=[('example.txt', 'foo')])
+        paste.create_star_for_author(u'alice@example.com')
+
+        with self.assertRPCs(users=1):
+            result = self.render(u'{% for paste in starred_pastes %}{{ paste }}{% endfor %} {{ login_url }}')
+
+        self.assertIn(unicode(paste), result)
+        self.assertIn(u'/foo/', result)
+
+    def test_values_are_made_once_per_request(self):
+        with mock.patch('pasty.models.get_starred_pastes', return_value=[]) as get_mock:
+            self.render(u'{{ starred_pastes|length }}')
+            self.render(u'{% if starred_pastes %}{% endif %}')
+
+        self.assertEqual(get_mock.call_count, 1)
+
+    def test_uses_prefetched_starred_pastes(self):
+        future = mock.Mock()
+        future.get_result.return_value = [u'foo']
+        self.request.starred_pastes_future = future
+
+        with self.assertRPCs(datastore=0):
+            self.assertEqual(self.render(u'{{ starred_pastes.0 }}'), u'foo')
+
+    def test_style_options_are_shared(self):
+        context = context_processors.pasty(self.request)
+
+        self.assertIs(context['highlight_styles'], context_processors.style_options)
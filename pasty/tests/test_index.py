@@ -0,0 +1,240 @@
+import datetime
+
+import mock
+from django.http.request import QueryDict
+from google.appengine.api import memcache
+
+from . import AppEngineTestCase
+from pasty import index
+from pasty.models import Paste
+
+
+def make_paste(author, filename, created, description=u'spam'):
+    paste = Paste.create_with_files(
+        author=author, created=created, description=description,
+        files=[(filename, 'foo')])
+    index.add_paste(paste)
+
+    return paste
+
+
+class SearchTermsTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(SearchTermsTestCase, self).setUp()
+
+        xmas = datetime.datetime(2016, 12, 25)
+        day = datetime.timedelta(days=1)
+
+        self.pastes = [
+            make_paste(u'alice@example.com', 'a.py', xmas),
+            make_paste(u'alice@example.com', 'b.py', xmas + day, description=u'eggs'),
+            make_paste(u'bob@example.com', 'c.py', xmas + (day * 2)),
+            make_paste(u'alice@example.com', 'd.py', xmas + (day * 3)),
+            make_paste(u'alice@example.com', 'e.py', xmas + (day * 4)),
+        ]
+
+    def search(self, cursor_string=None, limit=None, **params):
+        qdict = QueryDict(mutable=True)
+        qdict.update(params)
+        terms = index.build_query(qdict)
+
+        return index.search_terms(terms, cursor_string, limit=limit)
+
+    def test_matches_every_term_newest_first(self):
+        results = self.search(author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual(
+            [p.filename for p in results],
+            ['e.py', 'd.py', 'a.py'],
+        )
+        self.assertEqual(results.count, 3)
+        self.assertFalse(results.has_next())
+
+    def test_merged_results_paginate_with_cursor(self):
+        page1 = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual([p.filename for p in page1], ['e.py', 'd.py'])
+        self.assertTrue(page1.has_next())
+
+        cursor = page1.next_page_number()
+        page2 = self.search(cursor, limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual([p.filename for p in page2], ['a.py'])
+        self.assertFalse(page2.has_next())
+
+    def test_merged_cursor_is_stable_when_pastes_are_added(self):
+        page1 = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+        cursor = page1.next_page_number()
+
+        # Newer than everything, so it must not push d.py on to page 2.
+        make_paste(u'alice@example.com', 'f.py', datetime.datetime(2017, 1, 1))
+        memcache.flush_all()
+
+        page2 = self.search(cursor, limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual([p.filename for p in page2], ['a.py'])
+
+    def test_single_term_uses_one_query(self):
+        results = self.search(author=u'bob@example.com')
+
+        self.assertEqual([p.filename for p in results], ['c.py'])
+
+    def test_one_page_of_results_uses_one_query(self):
+        with mock.patch.object(index.paste_index, 'search_async') as search_async:
+            with self.assertRPCs(search=1):
+                results = self.search(author=u'alice@example.com', q=u'spam')
+
+        self.assertFalse(search_async.called)
+        self.assertEqual([p.filename for p in results], ['e.py', 'd.py', 'a.py'])
+
+    def test_caches_result_ids(self):
+        self.search(limit=2, author=u'alice@example.com', q=u'spam')
+
+        with self.assertRPCs(search=0):
+            results = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual(len(results), 2)
+
+    def test_adding_paste_keeps_cached_searches(self):
+        self.search(author=u'bob@example.com')
+        make_paste(u'alice@example.com', 'f.py', datetime.datetime(2017, 1, 1))
+
+        with self.assertRPCs(search=0):
+            results = self.search(author=u'bob@example.com')
+
+        self.assertEqual([p.filename for p in results], ['c.py'])
+
+    def test_merged_cursor_when_search_no_longer_splits(self):
+        page1 = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+        cursor = page1.next_page_number()
+
+        # Now alice has too many pastes to split the search, but the single
+        # query's results can still be paged.
+        for n in range(2):
+            make_paste(u'alice@example.com', 'x%d.py' % n, datetime.datetime(2016, 1, 1), u'eggs')
+
+        memcache.flush_all()
+
+        with mock.patch.object(index, 'FANOUT_LIMIT', 4):
+            page2 = self.search(cursor, limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertEqual([p.filename for p in page2], ['a.py'])
+        self.assertFalse(page2.has_next())
+
+    def test_merged_cursor_when_results_can_not_be_paged(self):
+        page1 = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+        cursor = page1.next_page_number()
+        memcache.flush_all()
+
+        with mock.patch.object(index, 'FANOUT_LIMIT', 2):
+            page2 = self.search(cursor, limit=2, author=u'alice@example.com', q=u'spam')
+
+        # The results end, rather than going back to the first page.
+        self.assertEqual(list(page2), [])
+        self.assertFalse(page2.has_next())
+
+    def test_falls_back_to_single_query_when_truncated(self):
+        with mock.patch.object(index, 'FANOUT_LIMIT', 2):
+            with mock.patch.object(index.paste_index, 'search_async') as search_async:
+                results = self.search(limit=2, author=u'alice@example.com', q=u'spam')
+
+        self.assertFalse(search_async.called)
+        self.assertEqual([p.filename for p in results], ['e.py', 'd.py'])
+        self.assertFalse(results.next_page_number().startswith(index.MERGED_CURSOR_PREFIX))
+
+
+class MergedCursorTestCase(AppEngineTestCase):
+    def test_round_trip(self):
+        cursor = index.encode_merged_cursor((1482624000, u'123'))
+
+        self.assertEqual(index.decode_merged_cursor(cursor), (1482624000, 123))
+
+    def test_invalid_cursor(self):
+        self.assertIsNone(index.decode_merged_cursor(None))
+        self.assertIsNone(index.decode_merged_cursor('bogus'))
+        self.assertIsNone(index.decode_merged_cursor(index.MERGED_CURSOR_PREFIX + '!!'))
+
+
+class ListPastesTestCase(AppEngineTestCase):
+    def test_returns_summaries_newest_first(self):
+        make_paste(u'alice@example.com', 'a.py', datetime.datetime(2016, 12, 25))
+        make_paste(u'bob@example.com', 'b.py', datetime.datetime(2016, 12, 26))
+
+        results = index.list_pastes([], None)
+
+        self.assertEqual([unicode(p) for p in results], [
+            u'bob@example.com / b.py',
+            u'alice@example.com / a.py',
+        ])
+        self.assertIsNone(results.count)
+
+    def test_serves_listing_from_cache(self):
+        make_paste(u'alice@example.com', 'a.py', datetime.datetime(2016, 12, 25))
+        index.list_pastes([], None)
+
+        with self.assertRPCs(datastore=0, search=0):
+            results = index.list_pastes([], None)
+
+        self.assertEqual([p.filename for p in results], ['a.py'])
+
+    def test_adding_paste_invalidates_cached_listing(self):
+        make_paste(u'alice@example.com', 'a.py', datetime.datetime(2016, 12, 25))
+        index.list_pastes([], None)
+
+        make_paste(u'alice@example.com', 'b.py', datetime.datetime(2016, 12, 26))
+        results = index.list_pastes([], None)
+
+        self.assertEqual([p.filename for p in results], ['b.py', 'a.py'])
+
+
+class RecentPastesTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(RecentPastesTestCase, self).setUp()
+
+        xmas = datetime.datetime(2016, 12, 25)
+
+        for n in range(7):
+            created = xmas + datetime.timedelta(hours=n)
+            make_paste(u'alice@example.com', 'example-%d.txt' % n, created)
+
+    def page_through(self, func):
+        """Returns a list of pages of paste IDs, following the cursors."""
+        pages, cursor = [], None
+
+        while True:
+            results = func(cursor, limit=3)
+            pages.append([paste.key.id() for paste in results])
+
+            if not results.has_next():
+                return pages
+
+            cursor = results.next_page_number()
+
+    def test_matches_search_ordering_and_pagination(self):
+        recent = self.page_through(index.recent_pastes)
+        searched = self.page_through(lambda c, limit: index.search_pastes('', c, limit=limit))
+
+        self.assertEqual(recent, searched)
+        self.assertEqual([len(page) for page in recent], [3, 3, 1])
+
+    def test_newest_first(self):
+        results = index.recent_pastes(None)
+
+        self.assertEqual(results[0].filename, 'example-6.txt')
+        self.assertEqual(results[-1].filename, 'example-0.txt')
+        self.assertIsNone(results.count)
+
+    def test_bogus_cursor_starts_at_the_beginning(self):
+        results = index.recent_pastes('bogus', limit=3)
+
+        self.assertEqual(
+            [p.filename for p in results],
+            ['example-6.txt', 'example-5.txt', 'example-4.txt'],
+        )
+
+    def test_no_search_terms_does_not_use_search_api(self):
+        with mock.patch.object(index.paste_index, 'search') as search:
+            results = index.get_pastes([], None)
+
+        self.assertFalse(search.called)
+        self.assertEqual(len(results), 7)
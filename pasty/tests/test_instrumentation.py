@@ -0,0 +1,93 @@
+from django.core.urlresolvers import reverse
+from google.appengine.api import memcache
+
+from . import AppEngineTestCase
+from pasty import instrumentation
+from pasty import utils
+from pasty.models import Paste
+
+
+class CollectTestCase(AppEngineTestCase):
+    def test_counts_datastore_calls(self):
+        with instrumentation.collect() as stats:
+            Paste(id=1234).put()
+            Paste.get_by_id(1234)
+
+        self.assertEqual(stats.calls['datastore'], 2)
+
+    def test_counts_memcache_hits_and_misses(self):
+        memcache.set('foo', 'bar')
+
+        with instrumentation.collect() as stats:
+            memcache.get_multi(['foo', 'baz', 'qux'])
+
+        self.assertEqual(stats.calls['memcache'], 1)
+        self.assertEqual(stats.counters['memcache', 'hits'], 1)
+        self.assertEqual(stats.counters['memcache', 'misses'], 2)
+
+    def test_counts_cloud_storage_bytes(self):
+        # Short enough to be stored uncompressed.
+        with self.settings(PASTY_INLINE_MAX_BYTES=0), instrumentation.collect() as stats:
+            paste = Paste.create_with_files(files=[('example.txt', 'foo bar')])
+
+            with paste.files[0].open() as fh:
+                fh.read()
+
+        self.assertEqual(stats.counters['gcs', 'write_bytes'], 7)
+        self.assertEqual(stats.counters['gcs', 'read_bytes'], 7)
+
+    def test_times_pygments(self):
+        with instrumentation.collect() as stats:
+            utils.highlight_content(u'print 1', filename='example.py')
+
+        self.assertEqual(stats.calls['pygments'], 1)
+
+    def test_ignores_calls_outside_block(self):
+        with instrumentation.collect() as stats:
+            pass
+
+        Paste(id=1234).put()
+
+        self.assertEqual(stats.calls['datastore'], 0)
+
+    def test_nested_blocks_count_in_both(self):
+        with instrumentation.collect() as outer:
+            Paste(id=1234).put()
+
+            with instrumentation.collect() as inner:
+                Paste.get_by_id(1234)
+
+        self.assertEqual(inner.calls['datastore'], 1)
+        self.assertEqual(outer.calls['datastore'], 2)
+
+    def test_server_timing_header(self):
+        stats = instrumentation.RequestStats()
+        stats.record('datastore', 12.34, calls=3)
+        stats.record('memcache', 1.0, hits=1, misses=2)
+        stats.wall_ms = 50
+        stats.cpu_ms = 20
+
+        self.assertEqual(
+            stats.server_timing(),
+            'total;dur=50.0, cpu;dur=20.0, '
+            'datastore;dur=12.3;desc="3 calls", '
+            'memcache;dur=1.0;desc="1 calls, 1 hits, 2 misses"',
+        )
+
+
+class RequestStatsMiddlewareTestCase(AppEngineTestCase):
+    def test_adds_server_timing_header(self):
+        url = reverse('api_paste_detail', args=['1234'])
+
+        with self.settings(PASTY_STATS_SAMPLE_RATE=1):
+            response = self.client.get(url)
+
+        self.assertIn('datastore;dur=', response['Server-Timing'])
+
+    def test_skips_requests_not_sampled(self):
+        url = reverse('api_paste_detail', args=['1234'])
+
+        with self.settings(PASTY_STATS_SAMPLE_RATE=0):
+            response = self.client.get(url)
+
+        self.assertNotIn('Server-Timing', response)
@@ -0,0 +1,76 @@
+import random
+import unittest
+
+import mock
+
+from . import AppEngineTestCase
+from pasty import loadtest
+
+
+class PercentileTestCase(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = range(1, 101)
+
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([5], 90), 5)
+        self.assertIsNone(loadtest.percentile([], 90))
+
+
+class ParseMixTestCase(unittest.TestCase):
+    def test_parse_mix(self):
+        mix = loadtest.parse_mix('detail=80, create=20')
+
+        self.assertEqual(list(mix.items()), [('detail', 80), ('create', 20)])
+
+    def test_unknown_request_type(self):
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('bogus=10')
+
+
+class WeightedChoiceTestCase(unittest.TestCase):
+    def test_skews_towards_heavier_items(self):
+        choose = loadtest.WeightedChoice(['a', 'b'], [9, 1])
+        rng = random.Random(1)
+
+        choices = [choose(rng) for _ in range(1000)]
+
+        self.assertGreater(choices.count('a'), choices.count('b') * 4)
+
+
+class LoadTestTestCase(AppEngineTestCase):
+    def test_run_reports_each_endpoint(self):
+        self.login('alice@example.com')
+        test = loadtest.LoadTest(num_pastes=5, seed=1)
+        test.setup()
+
+        elapsed = test.run(20, concurrency=2)
+        report = test.report(elapsed)
+
+        self.assertEqual(report['all']['requests'], 20)
+        self.assertEqual(report['all']['errors'], 0)
+        self.assertIn('p99_ms', report['detail'])
+
+    def test_replay(self):
+        test = loadtest.LoadTest(num_pastes=1, replay=[('GET', '/recent/')])
+        test.setup()
+
+        test.run(3, concurrency=1)
+
+        self.assertEqual(
+            [(r.endpoint, r.status) for r in test.results],
+            [('GET /recent/', 200)] * 3,
+        )
+
+    def test_exceptions_are_counted_as_errors(self):
+        test = loadtest.LoadTest(num_pastes=1, seed=1, mix={'detail': 1})
+        test.setup()
+
+        with mock.patch.object(test, 'request_detail') as request_detail:
+            request_detail.return_value.side_effect = ValueError
+            elapsed = test.run(3, concurrency=1)
+
+        report = test.report(elapsed)
+
+        self.assertEqual(report['all']['requests'], 3)
+        self.assertEqual(report['all']['errors'], 3)
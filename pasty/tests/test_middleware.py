@@ -0,0 +1,143 @@
+import re
+
+import session_csrf
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import Client, RequestFactory
+from google.appengine.api import memcache
+
+from . import AppEngineTestCase
+from pasty import compression
+from pasty import middleware
+from pasty.models import Paste
+
+
+class SessionlessTestCase(AppEngineTestCase):
+    def test_is_sessionless(self):
+        factory = RequestFactory()
+        raw_url = reverse('paste_raw', args=[1, '1/example.txt'])
+
+        self.assertTrue(middleware.is_sessionless(factory.get(raw_url)))
+        self.assertTrue(middleware.is_sessionless(factory.head(raw_url)))
+        self.assertFalse(middleware.is_sessionless(factory.post(raw_url)))
+        self.assertFalse(middleware.is_sessionless(factory.get(reverse('paste_detail', args=[1]))))
+        self.assertFalse(middleware.is_sessionless(factory.get('/does/not/exist/')))
+
+    def test_raw_file_skips_session_and_csrf(self):
+        paste = Paste.create_with_files(files=[('example.txt', 'foo')])
+        url = reverse('paste_raw', args=[paste.key.id(), '1/example.txt'])
+        self.client.cookies[session_csrf.ANON_COOKIE] = 'abc'
+
+        with self.assertRPCs(memcache=0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertFalse(hasattr(response.wsgi_request, 'csrf_token'))
+        self.assertEqual(response.cookies, {})
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+
+    def test_pages_with_forms_have_a_session(self):
+        response = self.client.get(reverse('paste_create'))
+
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertTrue(hasattr(response.wsgi_request, 'csrf_token'))
+
+
+class CompressionMiddlewareTestCase(AppEngineTestCase):
+    content = b'<p>Hello world</p>\n' * 100
+
+    def get(self, response, accept_encoding='gzip, deflate'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        compress = middleware.CompressionMiddleware(lambda request: response)
+
+        return compress(request)
+
+    def test_compresses_html(self):
+        response = HttpResponse(self.content)
+        response['ETag'] = '"foo"'
+        response = self.get(response)
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['ETag'], 'W/"foo"')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(compression.gunzip_bytes(response.content), self.content)
+
+    def test_paste_detail_is_compressed(self):
+        paste = Paste.create_with_files(files=[('example.py', 'foo = 1\n' * 500)])
+        url = reverse('paste_detail', args=[paste.key.id()])
+        key = paste.files[0].deflated_cache_key({})
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'<span class="n">foo</span>', compression.gunzip_bytes(response.content))
+
+        # The compressed markup is cached and used for the next response.
+        self.assertIsNotNone(memcache.get(key))
+        memcache.set(key, compression.deflate_fragment(b'cached'))
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        content = compression.gunzip_bytes(response.content)
+
+        self.assertIn(b'cached', content)
+        self.assertNotIn(b'<span class="n">foo</span>', content)
+
+    def test_page_with_plain_csrf_token_is_not_compressed(self):
+        response = self.client.get(reverse('paste_create'), HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.wsgi_request.csrf_token)
+        self.assertIn(response.wsgi_request.csrf_token, response.content)
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_client_without_gzip(self):
+        response = self.get(HttpResponse(self.content), accept_encoding='')
+
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.content, self.content)
+
+    def test_skips_small_compressed_and_streaming_responses(self):
+        precompressed = HttpResponse(self.content)
+        precompressed['Content-Encoding'] = 'br'
+        responses = [
+            HttpResponse(b'<p>Hello world</p>'),
+            HttpResponse(self.content, content_type='application/zip'),
+            precompressed,
+            StreamingHttpResponse([self.content]),
+        ]
+
+        for response in responses:
+            self.assertNotIn('Vary', self.get(response))
+
+    def test_zip_download_is_not_compressed(self):
+        paste = Paste.create_with_files(files=[('example.txt', 'foo bar baz\n' * 1000)])
+        url = reverse('paste_download', args=[paste.key.id()])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertNotIn('Content-Encoding', response)
+
+
+class MaskedCsrfTokenTestCase(AppEngineTestCase):
+    def test_masked_token_is_accepted(self):
+        self.login(u'alice@example.com')
+        client = Client(enforce_csrf_checks=True)
+        paste = Paste.create_with_files(files=[('example.txt', 'foo')])
+        response = client.get(reverse('paste_detail', args=[paste.key.id()]))
+        masked = re.search(r'data-csrf-token="(\w+)"', response.content).group(1)
+
+        self.assertNotIn(response.wsgi_request.csrf_token, response.content)
+
+        url = reverse('api_star_create')
+        data = {'paste': paste.key.id()}
+        response = client.post(url, data, HTTP_X_CSRFTOKEN=masked)
+
+        self.assertEqual(response.status_code, 200)
+
+        response = client.post(url, data, HTTP_X_CSRFTOKEN='x' * len(masked))
+
+        self.assertEqual(response.status_code, 403)
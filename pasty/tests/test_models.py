@@ -1,10 +1,16 @@
 import datetime
+import io
 import unittest
 
+import mock
 from django.http import Http404
+from google.appengine.ext import ndb
 
 from . import AppEngineTestCase
-from pasty.models import LexerConfig, Paste, PastyFile, make_relative_path
+from pasty import analysis
+from pasty.models import (
+    LexerConfig, Paste, PasteSummary, PastyFile, get_starred_pastes, get_summaries,
+    make_relative_path, highlight_files, prefetch_forks, read_files)
 
 
 class PasteTestCase(AppEngineTestCase):
@@ -71,6 +77,26 @@ class PasteTestCase(AppEngineTestCase):
             },
         )
 
+    def test_create_with_files_saves_fork_title(self):
+        orig = Paste.create_with_files(author='alice@example.com', files=[('a.txt', 'foo')])
+
+        paste = Paste.create_with_files(fork=orig, files=[('b.txt', 'bar')])
+
+        self.assertEqual(paste.fork, orig.key)
+        self.assertEqual(paste.fork_title, u'alice@example.com / a.txt')
+
+    def test_create_with_files_limits_inline_content(self):
+        files = [('example-%d.txt' % n, 'foo %d' % n) for n in range(3)]
+
+        with self.settings(PASTY_INLINE_MAX_BYTES=10, PASTY_INLINE_PASTE_MAX_BYTES=10):
+            paste = Paste.create_with_files(files=files)
+
+        self.assertEqual([f.is_inline for f in paste.files], [True, True, False])
+
+        for pasty_file, (filename, content) in zip(paste.files, files):
+            with pasty_file.open() as fh:
+                self.assertEqual(fh.read(), content)
+
     def test_highlight_content_with_custom_lexer_config(self):
         config = LexerConfig.get()
         config.lexers = [{'extension': 'sass', 'language': 'CSS'}]
@@ -101,6 +127,101 @@ class PasteTestCase(AppEngineTestCase):
         self.assertEqual(paste.files[1].content_highlight(), txt_expected)
 
 
+class PasteSummaryTestCase(AppEngineTestCase):
+    def test_create_with_files_saves_summary(self):
+        files = [('example.txt', 'foo\nbar'), ('example.py', 'baz')]
+        paste = Paste.create_with_files(id=1234, author='alice@example.com', files=files)
+
+        summary = PasteSummary.get_by_id(1234)
+
+        self.assertEqual(unicode(summary), u'alice@example.com / example.txt')
+        self.assertEqual(summary.preview, paste.preview)
+        self.assertEqual(summary.num_lines, 3)
+        self.assertEqual(summary.num_files, 2)
+        self.assertEqual(summary.url, u'/1234/')
+
+    def test_get_summaries_makes_missing_summaries(self):
+        Paste(id=1234, filename=u'example.txt').put()
+        keys = [ndb.Key(Paste, 1234), ndb.Key(Paste, 5678)]
+
+        summary, missing = get_summaries(keys)
+
+        self.assertEqual(summary.filename, u'example.txt')
+        self.assertIsNone(missing)
+        self.assertEqual(PasteSummary.get_by_id(1234), summary)
+
+    def test_deleting_paste_deletes_summary(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo')])
+
+        paste.key.delete()
+
+        self.assertEqual(get_summaries([paste.key]), [None])
+        self.assertIsNone(PasteSummary.get_by_id(1234))
+
+    def test_summary_has_file_details_without_content(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo bar baz\n' * 100)])
+        summary = PasteSummary.get_by_id(1234)
+
+        self.assertTrue(paste.files[0].is_inline)
+        self.assertEqual([f.relative_path for f in summary.files], [u'1/example.txt'])
+        self.assertIsNone(summary.files[0].inline_content)
+        self.assertEqual(summary.to_dict(), paste.to_dict())
+
+    def test_get_summaries_updates_summaries_without_files(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo')])
+        summary = paste.to_summary()
+        summary.files = []
+        summary.put()
+
+        summary, = get_summaries([paste.key])
+
+        self.assertEqual(len(summary.files), 1)
+        self.assertEqual(len(PasteSummary.get_by_id(1234).files), 1)
+
+    def test_get_starred_pastes_returns_summaries(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo')])
+        paste.create_star_for_author(u'alice@example.com')
+
+        summary, = get_starred_pastes(u'alice@example.com')
+
+        self.assertIsInstance(summary, PasteSummary)
+        self.assertEqual(summary.key.id(), 1234)
+
+
+class PrefetchForksTestCase(AppEngineTestCase):
+    def test_fetches_fork_titles_at_once(self):
+        orig1 = Paste(id=1, author=u'alice@example.com', filename=u'a.txt')
+        orig2 = Paste(id=2, filename=u'b.txt')
+        ndb.put_multi([orig1, orig2])
+
+        pastes = [
+            Paste(id=3, fork=orig1.key),
+            Paste(id=4, fork=orig2.key),
+            Paste(id=5, fork=orig1.key),
+            Paste(id=6),
+            Paste(id=7, fork=ndb.Key(Paste, 1234)),
+        ]
+
+        with mock.patch('pasty.models.ndb.get_multi', wraps=ndb.get_multi) as get_multi:
+            prefetch_forks(pastes)
+
+        self.assertEqual(get_multi.call_count, 1)
+        self.assertEqual(
+            [p.fork_title for p in pastes],
+            [u'alice@example.com / a.txt', u'anonymous / b.txt',
+             u'alice@example.com / a.txt', None, None],
+        )
+
+    def test_skips_pastes_with_saved_title(self):
+        paste = Paste(id=3, fork=ndb.Key(Paste, 1), fork_title=u'Saved')
+
+        with mock.patch('pasty.models.ndb.get_multi', wraps=ndb.get_multi) as get_multi:
+            prefetch_forks([paste])
+
+        self.assertEqual(paste.fork_title, u'Saved')
+        self.assertFalse(get_multi.called)
+
+
 class PastyFileTestCase(AppEngineTestCase):
     def test_default_content_type(self):
         obj = PastyFile()
@@ -112,6 +233,103 @@ class PastyFileTestCase(AppEngineTestCase):
 
         self.assertEqual(obj.content_type, 'image/jpeg')
 
+    def test_highlight_files(self):
+        files = [('example-%d.txt' % n, 'foo %d' % n) for n in range(5)]
+
+        with self.settings(PASTY_INLINE_MAX_BYTES=0):
+            paste = Paste.create_with_files(files=files)
+
+        result = highlight_files(paste.files, {})
+
+        self.assertEqual(result, [f.content_highlight() for f in paste.files])
+        self.assertIn('foo 4', result[4])
+
+    def test_content_highlight_is_cached(self):
+        paste = Paste.create_with_files(files=[('example.txt', 'foo')])
+        pasty_file = paste.files[0]
+        expected = pasty_file.content_highlight({})
+
+        with mock.patch.object(PastyFile, 'open') as open_mock:
+            self.assertEqual(pasty_file.content_highlight({}), expected)
+
+            # A different lexer config is another render.
+            open_mock.return_value = io.BytesIO(b'foo')
+            pasty_file.content_highlight({'.txt': 'Python'})
+
+        self.assertEqual(open_mock.call_count, 1)
+
+    def test_content_highlight_renders_markdown(self):
+        paste = Paste.create_with_files(files=[('README.md', '# Title\n')])
+
+        self.assertEqual(
+            paste.files[0].content_highlight({}),
+            u'<div class="content markdown"><h1>Title</h1>\n</div>\n',
+        )
+
+    def test_render_version_depends_on_renderer(self):
+        pasty_file = PastyFile(filename='README.md', path='pasty/2016/12/25/1/1/README.md')
+
+        self.assertNotEqual(
+            pasty_file.render_version({}), pasty_file.render_version({'md': 'Text only'}))
+
+    def test_read_files(self):
+        files = [('example.txt', 'foo'), ('example.css', 'body { color: red; }\n' * 100)]
+
+        with self.settings(PASTY_INLINE_MAX_BYTES=10):
+            paste = Paste.create_with_files(files=files)
+
+        self.assertEqual([f.is_inline for f in paste.files], [True, False])
+        self.assertEqual(read_files(paste.files), [content for _, content in files])
+
+    def test_create_keeps_small_content_inline(self):
+        obj = PastyFile.create(
+            filename='example.txt', content=u'foo', path='pasty/example.txt',
+            relative_path='example.txt', num_lines=1, inline_limit=10)
+
+        with obj.open() as fh:
+            read = fh.read()
+
+        self.assertTrue(obj.is_inline)
+        self.assertEqual(read, 'foo')
+
+    def test_create_compresses_content(self):
+        content = u'foo bar baz\n' * 100
+        obj = PastyFile.create(
+            filename='example.txt', content=content, path='pasty/example.txt',
+            relative_path='example.txt', num_lines=100)
+
+        with obj.open(raw=True) as fh:
+            stored = fh.read()
+
+        with obj.open() as fh:
+            read = fh.read()
+
+        self.assertEqual(obj.encoding, 'gzip')
+        self.assertLess(len(stored), len(content))
+        self.assertEqual(read, content.encode('utf-8'))
+
+    def test_create_leaves_short_content_uncompressed(self):
+        obj = PastyFile.create(
+            filename='example.txt', content=u'foo', path='pasty/example.txt',
+            relative_path='example.txt', num_lines=1)
+
+        with obj.open() as fh:
+            read = fh.read()
+
+        self.assertIsNone(obj.encoding)
+        self.assertEqual(read, 'foo')
+
+    def test_create_saves_analysis(self):
+        content = u'caf\xe9\n' * 300
+        obj = PastyFile.create(
+            filename='example.txt', content=content, path='pasty/example.txt',
+            relative_path='example.txt')
+
+        self.assertEqual(obj.num_lines, 300)
+        self.assertEqual(obj.size, 1800)
+        self.assertEqual(obj.content_hash, analysis.analyze(content).content_hash)
+        self.assertFalse(obj.is_binary)
+
 
 class LexerConfigTestCase(AppEngineTestCase):
     def test_get_singleton(self):
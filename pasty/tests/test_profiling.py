@@ -0,0 +1,173 @@
+import cProfile
+import marshal
+import shutil
+import tempfile
+
+import mock
+from django.core.urlresolvers import reverse
+from django.test import override_settings
+
+from . import AppEngineTestCase
+from pasty import profiling
+
+
+def inner():
+    return sum(range(1000))
+
+
+def outer():
+    return inner() + inner()
+
+
+class CollapsedStacksTestCase(AppEngineTestCase):
+    def test_stacks_follow_calls(self):
+        profiler = cProfile.Profile()
+        profiler.runcall(outer)
+        profiler.create_stats()
+
+        stacks = [stack for stack, value in profiling.collapsed_stacks(profiler.stats)]
+
+        self.assertTrue(any(s.endswith('test_profiling.py:14:outer;test_profiling.py:10:inner') for s in stacks))
+
+    def make_stats(self, edges, times):
+        """Returns a cProfile stats dict for a call graph. edges is a list of
+        (<caller>, <callee>, <calls>) and times maps function names to
+        (<self seconds>, <cumulative seconds>).
+        """
+        stats = {}
+
+        for name, (tt, ct) in times.items():
+            callers = {
+                ('x.py', 1, caller): (calls, calls, 0, 0)
+                for caller, callee, calls in edges if callee == name}
+            calls = sum(edge[0] for edge in callers.values()) or 1
+            stats[('x.py', 1, name)] = (calls, calls, tt, ct, callers)
+
+        return stats
+
+    def test_shared_callee_time_is_split_between_callers(self):
+        stats = self.make_stats(
+            [('main', 'a', 1), ('main', 'b', 1), ('a', 'f', 1), ('b', 'f', 3)],
+            {'main': (0, 5), 'a': (0, 1), 'b': (0, 4), 'f': (4, 4)})
+
+        stacks = dict(profiling.collapsed_stacks(stats))
+
+        self.assertEqual(stacks, {
+            'x.py:1:main;x.py:1:a;x.py:1:f': 1000000,
+            'x.py:1:main;x.py:1:b;x.py:1:f': 3000000,
+        })
+
+    def test_shares_use_all_calls_on_an_edge(self):
+        # cProfile edges are (nc, cc, tt, ct). Recursive calls make cc less
+        # than nc, here none of the calls are primitive.
+        stats = {
+            ('x.py', 1, 'main'): (1, 1, 0, 2, {}),
+            ('x.py', 1, 'f'): (0, 2, 2, 2, {('x.py', 1, 'main'): (2, 0, 2, 2)}),
+        }
+
+        self.assertEqual(dict(profiling.collapsed_stacks(stats)), {'x.py:1:main;x.py:1:f': 2000000})
+
+    def test_stacks_are_limited(self):
+        # Each level calls both functions in the next, so there are 2 ** 40
+        # paths to the bottom.
+        edges = [('main', 'f0a', 1), ('main', 'f0b', 1)]
+        times = {'main': (0, 100)}
+
+        for n in range(40):
+            for name in ['f%da' % n, 'f%db' % n]:
+                times[name] = (1, 100)
+                edges.extend([(name, 'f%da' % (n + 1), 1), (name, 'f%db' % (n + 1), 1)])
+
+        times.update({'f40a': (1, 1), 'f40b': (1, 1)})
+
+        with mock.patch.object(profiling, 'MAX_STACKS', 100):
+            stacks = list(profiling.collapsed_stacks(self.make_stats(edges, times)))
+
+        self.assertEqual(len(stacks), 100)
+
+
+class ProfilerMiddlewareTestCase(AppEngineTestCase):
+    def test_admin_can_profile_request(self):
+        self.login('alice@example.com', is_admin=True)
+
+        url = reverse('api_paste_detail', args=['1234'])
+        response = self.client.get(url, {'_profile': '1'})
+
+        self.assertEqual(response.status_code, 404)
+
+        download_url = response['X-Pasty-Profile']
+        self.assertTrue(download_url.endswith('.pstats'))
+
+        download = self.client.get(download_url)
+        stats = marshal.loads(download.content)
+
+        self.assertTrue(stats)
+
+    def test_profile_header(self):
+        self.login('alice@example.com', is_admin=True)
+
+        url = reverse('api_paste_detail', args=['1234'])
+        response = self.client.get(url, HTTP_X_PASTY_PROFILE='1')
+
+        self.assertIn('X-Pasty-Profile', response)
+        self.assertEqual(len(profiling.list_profiles()), 2)
+
+    def test_non_admin_denied(self):
+        self.login('alice@example.com')
+
+        url = reverse('api_paste_detail', args=['1234'])
+        response = self.client.get(url, {'_profile': '1'})
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(profiling.list_profiles(), [])
+
+    def test_requests_without_flag_are_not_profiled(self):
+        self.login('alice@example.com', is_admin=True)
+
+        url = reverse('api_paste_detail', args=['1234'])
+        response = self.client.get(url)
+
+        self.assertNotIn('X-Pasty-Profile', response)
+
+    def test_missing_profile(self):
+        self.login('alice@example.com', is_admin=True)
+
+        url = reverse('admin_profile_download', args=['missing.pstats'])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class LocalStorageProfilerTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(LocalStorageProfilerTestCase, self).setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            PASTY_STORAGE='pasty.storage.LocalStorage',
+            PASTY_LOCAL_STORAGE_ROOT=self.root,
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.root)
+
+        super(LocalStorageProfilerTestCase, self).tearDown()
+
+    def test_profiles_are_saved_locally(self):
+        self.login('alice@example.com', is_admin=True)
+
+        url = reverse('api_paste_detail', args=['1234'])
+        response = self.client.get(url, {'_profile': '1'})
+        download = self.client.get(response['X-Pasty-Profile'])
+
+        self.assertTrue(marshal.loads(download.content))
+
+        names = [obj.name for obj in profiling.list_profiles()]
+        self.assertEqual(len(names), 2)
+        self.assertEqual(sorted(names, reverse=True), names)
+
+        response = self.client.get(reverse('admin_profiles'))
+
+        self.assertContains(response, names[0])
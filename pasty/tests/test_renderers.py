@@ -0,0 +1,46 @@
+import unittest
+
+from . import AppEngineTestCase
+from pasty import renderers
+
+
+class GetRendererTestCase(unittest.TestCase):
+    def test_chooses_by_extension(self):
+        self.assertEqual(renderers.get_renderer('README.md').name, 'markdown')
+        self.assertEqual(renderers.get_renderer('NOTES.Markdown').name, 'markdown')
+        self.assertEqual(renderers.get_renderer('example.py').name, 'pygments')
+        self.assertEqual(renderers.get_renderer(None).name, 'pygments')
+
+    def test_lexer_config_is_highlighted(self):
+        renderer = renderers.get_renderer('README.md', config={'md': 'Text only'})
+
+        self.assertEqual(renderer.name, 'pygments')
+
+
+class RenderTestCase(AppEngineTestCase):
+    plain = (
+        u'<div class="highlight highlight__autumn"><pre><span></span>'
+        u'&lt;b&gt;Title&lt;/b&gt;\n</pre></div>\n'
+    )
+
+    def test_markdown_escapes_html(self):
+        markup = renderers.render(u'<b>Title</b>', filename='README.md')
+
+        self.assertEqual(
+            markup, u'<div class="content markdown"><p>&lt;b&gt;Title&lt;/b&gt;</p>\n</div>\n')
+
+    def test_plain(self):
+        markup = renderers.RENDERERS['plain'].render(b'<b>Title</b>')
+
+        self.assertEqual(markup, self.plain)
+
+    def test_long_content_is_plain_text(self):
+        with self.settings(PASTY_MARKDOWN_MAX_CHARS=5):
+            markup = renderers.render(u'<b>Title</b>', filename='README.md')
+
+        self.assertEqual(markup, self.plain)
+
+    def test_binary_content_is_plain_text(self):
+        markup = renderers.render(u'<b>Title</b>', filename='README.md', is_binary=True)
+
+        self.assertEqual(markup, self.plain)
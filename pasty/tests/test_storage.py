@@ -0,0 +1,161 @@
+import shutil
+import tempfile
+import unittest
+
+from django.http import FileResponse
+from django.test import override_settings
+from django.core.urlresolvers import reverse
+
+from . import AppEngineTestCase
+from pasty import storage
+from pasty.models import Paste
+
+
+class LocalStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(root=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_write_and_read(self):
+        self.storage.write('pasty/1/example.txt', b'foo bar baz')
+
+        self.assertTrue(self.storage.exists('pasty/1/example.txt'))
+        self.assertEqual(self.storage.read('pasty/1/example.txt'), b'foo bar baz')
+        self.assertEqual(self.storage.read_range('pasty/1/example.txt', 4, 7), b'bar')
+
+    def test_read_range_of_empty_file(self):
+        self.storage.write('empty.txt', b'')
+
+        self.assertEqual(self.storage.read_range('empty.txt', 0, 10), b'')
+
+    def test_read_multi_and_delete_multi(self):
+        self.storage.write('a.txt', b'a')
+        self.storage.write('b.txt', b'b')
+
+        self.assertEqual(self.storage.read_multi(['b.txt', 'a.txt']), [b'b', b'a'])
+
+        self.storage.delete_multi(['a.txt', 'b.txt', 'missing.txt'])
+
+        self.assertFalse(self.storage.exists('a.txt'))
+        self.assertFalse(self.storage.exists('b.txt'))
+
+    def test_open_missing_file(self):
+        with self.assertRaises(IOError):
+            self.storage.open('missing.txt')
+
+    def test_rejects_names_outside_root(self):
+        with self.assertRaises(ValueError):
+            self.storage.read('../example.txt')
+
+    def test_listdir(self):
+        self.storage.write('profiles/b.txt', b'bb')
+        self.storage.write('profiles/a.txt', b'a')
+        self.storage.write('pasty/1/c.txt', b'c')
+
+        self.assertEqual(self.storage.listdir('profiles/'), [
+            storage.StoredFile('profiles/a.txt', 1),
+            storage.StoredFile('profiles/b.txt', 2),
+        ])
+        self.assertEqual(self.storage.listdir('profiles/b'), [storage.StoredFile('profiles/b.txt', 2)])
+        self.assertEqual(self.storage.listdir('missing/'), [])
+
+    def test_serve_streams_file(self):
+        self.storage.write('example.txt', b'foo')
+
+        response = self.storage.serve('example.txt', 'text/plain')
+
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), b'foo')
+        response.close()
+
+
+class GCSStorageTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(GCSStorageTestCase, self).setUp()
+
+        self.storage = storage.GCSStorage()
+
+    def test_write_and_read(self):
+        self.storage.write('pasty/1/example.txt', b'foo bar baz', content_type='text/plain')
+
+        self.assertTrue(self.storage.exists('pasty/1/example.txt'))
+        self.assertEqual(self.storage.read('pasty/1/example.txt'), b'foo bar baz')
+        self.assertEqual(self.storage.read_range('pasty/1/example.txt', 4, 7), b'bar')
+
+    def test_delete(self):
+        self.storage.write('example.txt', b'foo')
+        self.storage.delete('example.txt')
+        self.storage.delete('example.txt')
+
+        self.assertFalse(self.storage.exists('example.txt'))
+
+    def test_open_missing_file(self):
+        with self.assertRaises(IOError):
+            self.storage.open('missing.txt')
+
+    def test_listdir(self):
+        self.storage.write('profiles/b.txt', b'bb', metadata={'path': '/'})
+        self.storage.write('profiles/a.txt', b'a')
+        self.storage.write('pasty/1/c.txt', b'c')
+
+        self.assertEqual(self.storage.listdir('profiles/'), [
+            storage.StoredFile('profiles/a.txt', 1),
+            storage.StoredFile('profiles/b.txt', 2),
+        ])
+
+
+class LocalStoragePasteTestCase(AppEngineTestCase):
+    def setUp(self):
+        super(LocalStoragePasteTestCase, self).setUp()
+
+        self.root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            PASTY_STORAGE='pasty.storage.LocalStorage',
+            PASTY_LOCAL_STORAGE_ROOT=self.root,
+            PASTY_INLINE_MAX_BYTES=0,
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.root)
+
+        super(LocalStoragePasteTestCase, self).tearDown()
+
+    def test_paste_files_are_saved_locally(self):
+        content = 'foo bar baz\n' * 100
+        paste = Paste.create_with_files(files=[('example.txt', content)])
+
+        with paste.files[0].open() as fh:
+            self.assertEqual(fh.read(), content)
+
+        self.assertTrue(storage.get_storage().exists(paste.files[0].path))
+
+    def test_serves_raw_file(self):
+        content = 'foo bar baz\n' * 100
+        paste = Paste.create_with_files(files=[('example.txt', content)])
+
+        url = reverse('paste_raw', args=[paste.key.id(), '1/example.txt'])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-type'], 'text/plain')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        response.close()
+
+    def test_serves_raw_file_decompressed_without_accept_encoding(self):
+        content = 'foo bar baz\n' * 100
+        paste = Paste.create_with_files(files=[('example.txt', content)])
+
+        url = reverse('paste_raw', args=[paste.key.id(), '1/example.txt'])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(b''.join(response.streaming_content), content)
+        response.close()
@@ -6,6 +6,7 @@ from django.http.request import QueryDict
 from django.template import Context, Template
 from django.test import TestCase
 
+from pasty import utils
 from pasty.templatetags import pastytags
 
 
@@ -97,3 +98,16 @@ class SinceTestCase(TestCase):
             result = pastytags.since(xmas)
 
         self.assertEqual(result, 'Dec. 25, 1999')
+
+
+class HighlightCssUrlTestCase(TestCase):
+    def test_url_has_fingerprint(self):
+        result = Template('{% highlight_css_url "monokai" %}').render(Context())
+        fingerprint = utils.highlight_css_fingerprints['monokai']
+
+        self.assertEqual(result, '/styles/highlight-monokai.%s.css' % fingerprint)
+
+    def test_default_style(self):
+        result = pastytags.highlight_css_url()
+
+        self.assertIn('/highlight-%s.' % utils.PYGMENTS_STYLE, result)
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import mock
+from google.appengine.api import memcache
+from pygments import lexers
+from pygments.token import Token
+
+from . import AppEngineTestCase
+from pasty import tokens
+
+
+class TokenStreamTestCase(AppEngineTestCase):
+    content = u'def foo():\n    return foo\n'
+
+    def make_stream(self, content=None):
+        lexer = lexers.get_lexer_by_name('python')
+
+        return tokens.TokenStream.from_tokens(lexer.get_tokens(content or self.content))
+
+    def text(self, stream):
+        return u''.join(value for _, value in stream)
+
+    def test_iterates_tokens(self):
+        lexer = lexers.get_lexer_by_name('python')
+        stream = self.make_stream()
+
+        self.assertEqual(list(stream), list(lexer.get_tokens(self.content)))
+
+    def test_values_are_kept_once(self):
+        stream = self.make_stream()
+
+        self.assertEqual(stream.values.count(u'foo'), 1)
+        self.assertLess(len(stream.values), len(stream))
+
+    def test_dumps_and_loads(self):
+        stream = self.make_stream()
+        loaded = tokens.TokenStream.loads(stream.dumps())
+
+        self.assertEqual(list(loaded), list(stream))
+        self.assertIs(loaded.types[0], stream.types[0])
+
+    def test_lines(self):
+        stream = self.make_stream(u'a = 1\nb = """x\ny"""\nc = 3\n')
+
+        self.assertEqual(self.text(stream.lines(1, 2)), u'b = """x\n')
+        self.assertEqual(self.text(stream.lines(2)), u'y"""\nc = 3\n')
+
+    def test_summary_skips_blank_lines_at_the_ends(self):
+        stream = tokens.TokenStream.from_tokens(
+            [(Token.Text, u'\n  \n'), (Token.Name, u'foo'), (Token.Text, u'\n\n\n')])
+
+        self.assertEqual(self.text(stream.summary(10, 100)), u'foo\n')
+
+    def test_summary_is_limited(self):
+        stream = self.make_stream(u'x = 1\n' * 20)
+
+        self.assertEqual(self.text(stream.summary(2, 100)), u'x = 1\n' * 2)
+        self.assertEqual(self.text(stream.summary(10, 3)), u'x =\n')
+
+
+class LexTestCase(AppEngineTestCase):
+    def test_caches_tokens_by_content(self):
+        lexer = lexers.get_lexer_by_name('python')
+        stream = tokens.lex(u'foo = 1\n', lexer)
+
+        key = 'tokens:%d:Python:%s' % (tokens.TOKENS_VERSION, tokens.content_hash(u'foo = 1\n'))
+        self.assertEqual(memcache.get(key), stream.dumps())
+
+        # Cached tokens are used rather than lexing again.
+        memcache.set(key, tokens.TokenStream.from_tokens([(Token.Name, u'bar')]).dumps())
+
+        self.assertEqual(list(tokens.lex(u'foo = 1\n', lexer)), [(Token.Name, u'bar')])
+
+    def test_uses_the_given_digest(self):
+        lexer = lexers.get_lexer_by_name('python')
+
+        with mock.patch.object(tokens, 'content_hash') as content_hash:
+            tokens.lex(u'foo = 1\n', lexer, digest='abc')
+
+        self.assertFalse(content_hash.called)
+        self.assertIsNotNone(memcache.get('tokens:%d:Python:abc' % tokens.TOKENS_VERSION))
+
+    def test_too_large_tokens_are_not_cached(self):
+        lexer = lexers.get_lexer_by_name('python')
+
+        with mock.patch.object(tokens, 'MAX_CACHED_SIZE', 10):
+            tokens.lex(u'foo = 1\n', lexer)
+
+        key = 'tokens:%d:Python:%s' % (tokens.TOKENS_VERSION, tokens.content_hash(u'foo = 1\n'))
+        self.assertIsNone(memcache.get(key))
+
+
+class StuckLexer(object):
+    """A lexer which never yields a token, like a regular expression that
+    backtracks forever.
+    """
+    name = 'Stuck'
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def get_tokens(self, content):
+        self.release.wait(10)
+        yield Token.Text, content
+
+
+class GetTokensTestCase(AppEngineTestCase):
+    def test_lexer_stuck_in_one_match_is_stopped(self):
+        lexer = StuckLexer()
+        started = time.time()
+
+        try:
+            with self.settings(PASTY_HIGHLIGHT_TIME_LIMIT=0.2):
+                result = tokens.get_tokens(u'foo\n', lexer)
+        finally:
+            lexer.release.set()
+
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(result, list(lexers.TextLexer().get_tokens(u'foo\n')))
+
+        # It is remembered, so it isn't tried again.
+        key = tokens.slow_highlight_key(tokens.content_hash(u'foo\n'), lexer)
+        self.assertTrue(memcache.get(key))
+
+    def test_lexer_errors_are_raised(self):
+        lexer = mock.Mock()
+        lexer.get_tokens.side_effect = ValueError
+
+        with self.assertRaises(ValueError):
+            tokens.get_tokens(u'foo\n', lexer)
@@ -1,5 +1,9 @@
+import threading
 import unittest
 
+from pygments.token import Token
+
+from . import AppEngineTestCase
 from pasty import utils
 
 
@@ -30,3 +34,103 @@ class BaseConverterTestCase(unittest.TestCase):
 
     def test_base62_base(self):
         self.assertEqual(utils.base62.base, 62)
+
+
+class MapThreadedTestCase(unittest.TestCase):
+    def test_results_are_in_order(self):
+        result = utils.map_threaded(lambda x: x * 2, range(20), max_workers=4)
+
+        self.assertEqual(result, [x * 2 for x in range(20)])
+
+    def test_uses_several_threads(self):
+        barrier = threading.Event()
+        seen = set()
+
+        def func(item):
+            seen.add(threading.current_thread().ident)
+
+            # Both threads have to be running for either to finish.
+            if len(seen) == 2:
+                barrier.set()
+
+            return barrier.wait(5)
+
+        self.assertEqual(utils.map_threaded(func, [1, 2], max_workers=2), [True, True])
+
+    def test_raises_errors_from_workers(self):
+        def func(item):
+            if item == 3:
+                raise ValueError(item)
+
+            return item
+
+        with self.assertRaises(ValueError):
+            utils.map_threaded(func, range(10), max_workers=4)
+
+
+class HighlightContentTestCase(AppEngineTestCase):
+    content = u'def foo():\n    return 1\n'
+    highlighted = u'<span class="k">def</span>'
+    plain = (
+        u'<div class="highlight highlight__autumn"><pre><span></span>'
+        u'def foo():\n    return 1\n</pre></div>\n'
+    )
+
+    def test_highlights_content(self):
+        lexer, markup = utils.highlight_content(self.content, filename='example.py')
+
+        self.assertEqual(lexer.name, 'Python')
+        self.assertIn(self.highlighted, markup)
+
+    def test_long_content_is_plain_text(self):
+        with self.settings(PASTY_HIGHLIGHT_MAX_CHARS=10):
+            lexer, markup = utils.highlight_content(self.content, filename='example.py')
+
+        self.assertEqual(lexer.name, 'Python')
+        self.assertEqual(markup, self.plain)
+
+    def test_slow_content_is_plain_text_from_then_on(self):
+        with self.settings(PASTY_HIGHLIGHT_TIME_LIMIT=-1):
+            _, markup = utils.highlight_content(self.content, filename='example.py')
+
+        self.assertEqual(markup, self.plain)
+
+        # Now it doesn't try again, even with time to spare.
+        _, markup = utils.highlight_content(self.content, filename='example.py')
+
+        self.assertEqual(markup, self.plain)
+
+        # But the same content in another language is tried.
+        _, markup = utils.highlight_content(self.content, filename='example.rb')
+
+        self.assertNotEqual(markup, self.plain)
+
+    def test_tokenize_content(self):
+        lexer, tokens = utils.tokenize_content(u'def foo(): pass', filename='example.py')
+
+        self.assertEqual(lexer.name, 'Python')
+        self.assertEqual(
+            tokens,
+            {
+                'classes': ['k', '', 'nf', 'p'],
+                'tokens': [0, u'def', 1, u' ', 2, u'foo', 3, u'():', 1, u' ', 0, u'pass', 1, u'\n'],
+            },
+        )
+
+    def test_summarize_content(self):
+        content = u'\n  \n' + u'x = 1\n' * 20
+        lexer, markup = utils.summarize_content(content, filename='example.py')
+
+        self.assertEqual(lexer.name, 'Python')
+        self.assertEqual(markup.count(u'\n'), utils.SUMMARY_LINES + 1)
+        self.assertIn(u'<span class="n">x</span>', markup)
+
+    def test_summary_prefix_is_limited(self):
+        self.assertEqual(utils.summary_prefix(u'\n \nfoo\n' * 100), u'foo\n\n \n' * 3 + u'foo\n')
+        self.assertEqual(len(utils.summary_prefix(u'x' * 10 ** 6)), 2 * utils.SUMMARY_CHARS)
+
+    def test_token_css_class(self):
+        self.assertEqual(utils.token_css_class(Token.Name.Function), 'nf')
+        self.assertEqual(utils.token_css_class(Token.Text), '')
+        # Types Pygments doesn't know use the parent's class.
+        self.assertEqual(utils.token_css_class(Token.Name.Function.Pasty), 'nfPasty')
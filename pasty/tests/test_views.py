@@ -1,10 +1,15 @@
 import datetime
+import io
 import json
+import zipfile
 
+import mock
 from django.core.urlresolvers import reverse
+from google.appengine.ext import blobstore
 
 from . import AppEngineTestCase, freeze_time
 from pasty.models import LexerConfig, Paste, get_starred_pastes
+from pasty import compression
 from pasty import index
 from pasty import utils
 
@@ -35,7 +40,8 @@ class PasteListTestCase(AppEngineTestCase):
             sorted(response.context_data),
             ['page_title', 'pastes', 'section', 'terms'],
         )
-        self.assertEqual(response.context_data['pastes'].count, 11)
+        self.assertEqual(len(response.context_data['pastes']), 10)
+        self.assertTrue(response.context_data['pastes'].has_next())
 
 
 class PasteDetailTestCase(AppEngineTestCase):
@@ -45,12 +51,19 @@ class PasteDetailTestCase(AppEngineTestCase):
         url = reverse('paste_detail', args=[paste.key.id()])
         response = self.client.get(url)
 
+        content = (
+            u'<div class="highlight highlight__autumn"><pre><span></span>'
+            u'foo\n</pre></div>\n'
+        )
+
         self.assertEqual(response.status_code, 200)
         self.assertEqual(
             response.context_data,
             {
+                'files': [(paste.files[0], content)],
                 'page_title': 'example.txt',
                 'paste': paste,
+                'render_client': False,
                 'starred': None,
             },
         )
@@ -63,6 +76,37 @@ class PasteDetailTestCase(AppEngineTestCase):
 
         self.assertContains(response, 'foo bar baz', status_code=200)
 
+    def test_shows_star_for_signed_in_user(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo')])
+        star = paste.create_star_for_author(u'alice@example.com')
+        self.login(u'alice@example.com')
+
+        url = reverse('paste_detail', args=[paste.key.id()])
+        response = self.client.get(url)
+
+        self.assertEqual(response.context_data['starred'], star)
+        self.assertEqual(response.context['starred_pastes'], [paste])
+
+    def test_returns_404_for_unknown_paste(self):
+        url = reverse('paste_detail', args=[1234])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_client_rendering_links_to_tokens(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.txt', 'foo')])
+        version = paste.files[0].render_version({})
+
+        url = reverse('paste_detail', args=[paste.key.id()])
+        response = self.client.get(url, {'render': 'client'})
+
+        self.assertEqual(
+            response.context_data['files'],
+            [(paste.files[0], '/api/v1/pastes/1234/tokens/1/example.txt?v=' + version)],
+        )
+        self.assertContains(response, 'class="paste__tokens"')
+
+
 class PasteRedirectTestCase(AppEngineTestCase):
     def test_redirects_peelings_link(self):
         paste_code = utils.base62.encode(123456789)
@@ -87,6 +131,21 @@ class PasteDownloadTestCase(AppEngineTestCase):
         self.assertEqual(response['Content-Disposition'], 'attachment; filename="example.txt.zip"')
         self.assertEqual(response['Content-type'], 'application/zip')
 
+    def test_download_compressed_files(self):
+        content = 'foo bar baz\n' * 100
+        files = [('example.txt', content), ('short.txt', 'foo')]
+        paste = Paste.create_with_files(id=1234, files=files)
+
+        url = reverse('paste_download', args=[paste.key.id()])
+        response = self.client.get(url)
+
+        archive = zipfile.ZipFile(io.BytesIO(response.content))
+
+        self.assertEqual(paste.files[0].encoding, 'gzip')
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.read('example.txt'), content)
+        self.assertEqual(archive.read('short.txt'), 'foo')
+
 
 class PasteRawTestCase(AppEngineTestCase):
     def test_serves_raw_file(self):
@@ -97,6 +156,35 @@ class PasteRawTestCase(AppEngineTestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-type'], 'image/jpeg')
+        self.assertEqual(response.content, 'example')
+
+    def test_serves_file_in_cloud_storage_with_blobstore(self):
+        with self.settings(PASTY_INLINE_MAX_BYTES=0):
+            paste = Paste.create_with_files(files=[('image.jpg', 'example')])
+
+        url = reverse('paste_raw', args=[paste.key.id(), '1/image.jpg'])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(blobstore.BLOB_KEY_HEADER, response)
+
+    def test_serves_inline_gzipped_file_as_stored(self):
+        content = 'foo bar baz\n' * 100
+        paste = Paste.create_with_files(files=[('example.txt', content)])
+        pasty_file = paste.files[0]
+        url = reverse('paste_raw', args=[paste.key.id(), '1/example.txt'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.content, pasty_file.inline_content)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        # Clients which don't accept gzip get the content as it is.
+        response = self.client.get(url)
+
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, content)
 
     def test_returns_404_for_bogus_filename(self):
         paste = Paste.create_with_files(files=[('image.jpg', 'example')])
@@ -450,7 +538,7 @@ class ApiStarDeleteTestCase(AppEngineTestCase):
         paste.put()
         starred = paste.create_star_for_author(user_email)
 
-        self.assertEqual(get_starred_pastes(user_email), [paste])
+        self.assertEqual([p.key.id() for p in get_starred_pastes(user_email)], [paste.key.id()])
 
         data = {'paste': paste.key.id()}
 
@@ -522,6 +610,63 @@ class ApiPasteDetailTestCase(AppEngineTestCase):
         )
 
 
+class ApiPasteTokensTestCase(AppEngineTestCase):
+    def test_returns_tokens(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.py', 'def foo(): pass')])
+        version = paste.files[0].render_version({})
+
+        url = reverse('api_paste_tokens', args=[paste.key.id(), '1/example.py'])
+        response = self.client.get(url, {'v': version})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-type'], 'application/json')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(
+            response.json(),
+            {
+                u'classes': [u'k', u'', u'nf', u'p'],
+                u'cssclass': u'highlight highlight__autumn',
+                u'lexer': u'Python',
+                u'tokens': [
+                    0, u'def', 1, u' ', 2, u'foo', 3, u'():', 1, u' ', 0, u'pass', 1, u'\n',
+                ],
+            },
+        )
+
+    def test_error_for_non_existent_file(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.py', 'def foo(): pass')])
+
+        url = reverse('api_paste_tokens', args=[paste.key.id(), '1/bogus.py'])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_short_cache_without_version(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.py', 'def foo(): pass')])
+
+        url = reverse('api_paste_tokens', args=[paste.key.id(), '1/example.py'])
+        response = self.client.get(url)
+
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+
+    def test_compressed_tokens_are_cached(self):
+        paste = Paste.create_with_files(id=1234, files=[('example.py', 'def foo(): pass')])
+        version = paste.files[0].render_version({})
+        url = reverse('api_paste_tokens', args=[paste.key.id(), '1/example.py'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['ETag'], '"%s-gzip"' % version)
+        self.assertEqual(json.loads(compression.gunzip_bytes(response.content))['lexer'], 'Python')
+
+        with mock.patch('pasty.compression.compress') as compress_mock:
+            second = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertFalse(compress_mock.called)
+        self.assertEqual(second.content, response.content)
+
+
 class ApiPasteCreateTestCase(AppEngineTestCase):
     def test_anonymous_user_returns_error(self):
         url = reverse('api_paste_list')
@@ -617,6 +762,31 @@ class ApiPasteCreateTestCase(AppEngineTestCase):
         )
 
 
+class HighlightCssTestCase(AppEngineTestCase):
+    def test_returns_css_for_one_style(self):
+        fingerprint = utils.highlight_css_fingerprints['monokai']
+        url = reverse('highlight_css', args=['monokai', fingerprint])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertIn('.highlight__monokai ', response.content)
+        self.assertNotIn('.highlight__autumn ', response.content)
+
+    def test_short_cache_for_old_fingerprint(self):
+        url = reverse('highlight_css', args=['monokai', '0123abcd'])
+        response = self.client.get(url)
+
+        self.assertEqual(response['Cache-Control'], 'public, max-age=300')
+
+    def test_returns_404_for_unknown_style(self):
+        url = reverse('highlight_css', args=['bogus', '0123abcd'])
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+
 class AdminLexersTestCase(AppEngineTestCase):
     def test_shows_form(self):
         url = reverse('admin_lexers')
@@ -645,3 +815,85 @@ class AdminLexersTestCase(AppEngineTestCase):
 
         self.assertRedirects(response, url)
         self.assertEqual(LexerConfig.get_config(), {'script': 'AppleScript'})
+
+
+class RPCBudgetTestCase(AppEngineTestCase):
+    """Guards against views making an API call per item (N+1 queries).
+    Budgets stay the same however many files or pastes there are.
+    """
+    def setUp(self):
+        super(RPCBudgetTestCase, self).setUp()
+
+        LexerConfig.get()
+        self.files = [('example-%d.txt' % n, 'foo %d' % n) for n in range(5)]
+
+    def test_paste_detail(self):
+        paste = Paste.create_with_files(files=self.files)
+        url = reverse('paste_detail', args=[paste.key.id()])
+
+        # Paste, star, lexer config and starred pastes. Small files are
+        # stored with the paste.
+        with self.assertRPCs(datastore=4, gcs=0, search=0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_paste_list(self):
+        for n in range(15):
+            index.add_paste(Paste.create_with_files(files=self.files[:1]))
+
+        url = reverse('paste_list')
+
+        with self.assertRPCs(datastore=4, gcs=0, search=0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+
+        # Then the page comes from the listing cache.
+        with self.assertRPCs(datastore=1, gcs=0, search=0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_paste_search(self):
+        for n in range(15):
+            paste = Paste.create_with_files(description=u'spam', files=self.files[:1])
+            index.add_paste(paste)
+
+        url = reverse('paste_search')
+
+        with self.assertRPCs(datastore=3, gcs=0, search=1):
+            response = self.client.get(url, {'q': 'spam'})
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_api_star_list(self):
+        user_email = u'alice@example.com'
+
+        for n in range(10):
+            paste = Paste.create_with_files(files=self.files[:1])
+            paste.create_star_for_author(user_email)
+
+        url = reverse('api_star_list')
+        self.login(user_email)
+
+        with self.assertRPCs(datastore=3, gcs=0):
+            response = self.client.get(url)
+
+        self.assertEqual(len(response.json()['stars']), 10)
+
+    def test_api_paste_create(self):
+        url = reverse('api_paste_list')
+        self.login('alice@example.com')
+
+        data = {
+            'description': 'Short description',
+            'files': [{'filename': name, 'content': content} for name, content in self.files],
+        }
+        data = json.dumps(data)
+
+        # Put the paste, get the lexer config, put the paste and its summary.
+        with self.assertRPCs(datastore=4, gcs=0, search=1):
+            response = self.client.post(url, data, content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
@@ -0,0 +1,262 @@
+"""Lexing content into Pygments tokens, and a compact form of the tokens
+which is cached by content hash.
+
+Every output format (HTML, previews, the tokens API) starts from the same
+cached tokens, so content is lexed once however it is shown.
+"""
+import array
+import hashlib
+import logging
+import marshal
+import threading
+import time
+
+from django.conf import settings
+from google.appengine.api import memcache
+from pygments import lexers
+from pygments.token import Token, string_to_tokentype
+
+
+#: Change this when lexing changes, e.g. upgrading Pygments.
+TOKENS_VERSION = 1
+TOKENS_CACHE_TTL = 24 * 60 * 60
+#: Memcache refuses values of 1 MB or more.
+MAX_CACHED_SIZE = 1000 * 1000 - 1024
+#: Seconds to remember content which was too slow to highlight.
+SLOW_HIGHLIGHT_TTL = 7 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class HighlightTimeout(Exception):
+    pass
+
+
+def with_deadline(tokens, deadline):
+    """Yields the tokens, raising HighlightTimeout after the deadline."""
+    for token in tokens:
+        if time.time() > deadline:
+            raise HighlightTimeout
+
+        yield token
+
+
+def lex_with_deadline(content, lexer, deadline):
+    """Returns a list of tokens from the lexer, raising HighlightTimeout if
+    it doesn't finish by the deadline.
+
+    The lexer runs in a worker thread, because a regular expression which
+    backtracks badly never returns to us to check the time. Such a thread
+    can't be stopped, so it is left to finish and its tokens are dropped.
+    """
+    result = {}
+
+    def lex():
+        try:
+            result['tokens'] = list(with_deadline(lexer.get_tokens(content), deadline))
+        except Exception as err:
+            result['error'] = err
+
+    thread = threading.Thread(target=lex, name='lex')
+    thread.daemon = True
+    thread.start()
+    thread.join(max(deadline - time.time(), 0))
+
+    if thread.is_alive():
+        raise HighlightTimeout
+
+    if 'error' in result:
+        raise result['error']
+
+    return result['tokens']
+
+
+def slow_highlight_key(digest, lexer):
+    return 'slow-highlight:%s:%s' % (lexer.name, digest)
+
+
+def get_tokens(content, lexer, filename=None, digest=None):
+    """Returns a list of (<token type>, <text>) pairs for the content.
+
+    Content longer than PASTY_HIGHLIGHT_MAX_CHARS, or which takes longer than
+    PASTY_HIGHLIGHT_TIME_LIMIT seconds to tokenize, is treated as plain text.
+    Content that was too slow is remembered, so it isn't tried again. digest
+    is the content_hash() of the content, if you already have it.
+    """
+    plain_lexer = lexers.TextLexer()
+
+    if len(content) > settings.PASTY_HIGHLIGHT_MAX_CHARS:
+        return list(plain_lexer.get_tokens(content))
+
+    key = slow_highlight_key(digest or content_hash(content), lexer)
+
+    if memcache.get(key):
+        return list(plain_lexer.get_tokens(content))
+
+    deadline = time.time() + settings.PASTY_HIGHLIGHT_TIME_LIMIT
+
+    try:
+        return lex_with_deadline(content, lexer, deadline)
+    except HighlightTimeout:
+        logger.warning('Highlighting %r with %s was too slow', filename, lexer.name)
+        memcache.set(key, True, time=SLOW_HIGHLIGHT_TTL)
+
+        return list(plain_lexer.get_tokens(content))
+
+
+class TokenStream(object):
+    """A list of (<token type>, <text>) pairs, stored as an array of
+    alternating type and text ids. Each distinct type and text is kept once.
+    """
+    def __init__(self, types=None, values=None, codes=None):
+        self.types = types or []
+        self.values = values or []
+        self.codes = codes if codes is not None else array.array('I')
+        self._type_ids = {ttype: n for n, ttype in enumerate(self.types)}
+        self._value_ids = {value: n for n, value in enumerate(self.values)}
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        stream = cls()
+
+        for ttype, value in tokens:
+            stream.append(ttype, value)
+
+        return stream
+
+    def append(self, ttype, value):
+        type_id = self._type_ids.get(ttype)
+
+        if type_id is None:
+            type_id = self._type_ids[ttype] = len(self.types)
+            self.types.append(ttype)
+
+        value_id = self._value_ids.get(value)
+
+        if value_id is None:
+            value_id = self._value_ids[value] = len(self.values)
+            self.values.append(value)
+
+        self.codes.extend([type_id, value_id])
+
+    def __iter__(self):
+        codes, types, values = self.codes, self.types, self.values
+
+        for n in xrange(0, len(codes), 2):
+            yield types[codes[n]], values[codes[n + 1]]
+
+    def __len__(self):
+        return len(self.codes) // 2
+
+    def dumps(self):
+        types = [str(ttype) for ttype in self.types]
+
+        return marshal.dumps((types, self.values, self.codes.tostring()))
+
+    @classmethod
+    def loads(cls, data):
+        types, values, codes = marshal.loads(data)
+        types = [string_to_tokentype(name) for name in types]
+        codes = array.array('I', codes)
+
+        return cls(types, values, codes)
+
+    def iter_lines(self):
+        """Yields a list of (<token type>, <text>) pairs for each line. Text
+        at the end of a line includes the newline.
+        """
+        line = []
+
+        for ttype, value in self:
+            parts = value.split(u'\n')
+
+            for part in parts[:-1]:
+                line.append((ttype, part + u'\n'))
+                yield line
+                line = []
+
+            if parts[-1]:
+                line.append((ttype, parts[-1]))
+
+        if line:
+            yield line
+
+    def lines(self, start, stop=None):
+        """Returns a TokenStream for lines start up to stop, counting from 0."""
+        stream = TokenStream()
+
+        for n, line in enumerate(self.iter_lines()):
+            if stop is not None and n >= stop:
+                break
+
+            if n >= start:
+                for ttype, value in line:
+                    stream.append(ttype, value)
+
+        return stream
+
+    def summary(self, max_lines, max_chars):
+        """Returns a TokenStream for the first lines, skipping blank lines at
+        the start and end, and no more than max_chars long.
+        """
+        lines = []
+        size = 0
+
+        for line in self.iter_lines():
+            if len(lines) >= max_lines or size >= max_chars:
+                break
+
+            if lines or not is_blank(line):
+                lines.append(line)
+                size += sum(len(value) for _, value in line)
+
+        while lines and is_blank(lines[-1]):
+            lines.pop()
+
+        stream = TokenStream()
+        size = 0
+
+        for line in lines:
+            for ttype, value in line:
+                value = value[:max_chars - size]
+                size += len(value)
+
+                if value:
+                    stream.append(ttype, value)
+
+        if stream.values and not stream.values[stream.codes[-1]].endswith(u'\n'):
+            stream.append(Token.Text, u'\n')
+
+        return stream
+
+
+def is_blank(line):
+    return not u''.join(value for _, value in line).strip()
+
+
+def lex(content, lexer, filename=None, digest=None):
+    """Returns a TokenStream for the content. It is cached by the lexer and
+    a hash of the content. Pass the content_hash() as digest if you already
+    have it, such as PastyFile.content_hash, to save hashing it again.
+    """
+    digest = digest or content_hash(content)
+    key = 'tokens:%d:%s:%s' % (TOKENS_VERSION, lexer.name, digest)
+    data = memcache.get(key)
+
+    if data is not None:
+        return TokenStream.loads(data)
+
+    stream = TokenStream.from_tokens(get_tokens(content, lexer, filename=filename, digest=digest))
+    data = stream.dumps()
+
+    if len(data) <= MAX_CACHED_SIZE:
+        memcache.set(key, data, time=TOKENS_CACHE_TTL)
+
+    return stream
+
+
+def content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    return hashlib.sha1(content).hexdigest()
@@ -7,6 +7,7 @@ urlpatterns = [
     url(r'^api/v1/', include([
         url(r'^pastes/$', views.api_paste_list, name='api_paste_list'),
         url(r'^pastes/([a-zA-Z0-9]+)/$', views.api_paste_detail, name='api_paste_detail'),
+        url(r'^pastes/([a-zA-Z0-9]+)/tokens/(.+)$', views.api_paste_tokens, name='api_paste_tokens'),
         url(r'^star/$', views.api_star_create, name='api_star_create'),
         url(r'^star/list/$', views.api_star_list, name='api_star_list'),
         url(r'^star/delete/$', views.api_star_delete, name='api_star_delete'),
@@ -19,6 +20,10 @@ urlpatterns = [
 
     url(r'^admin/$', views.admin, name='admin'),
     url(r'^admin/lexers/$', views.admin_lexers, name='admin_lexers'),
+    url(r'^admin/profiles/$', views.admin_profiles, name='admin_profiles'),
+    url(r'^admin/profiles/([\w.-]+)$', views.admin_profile_download, name='admin_profile_download'),
+
+    url(r'^styles/highlight-([\w-]+)\.([0-9a-f]+)\.css$', views.highlight_css, name='highlight_css'),
 
     url(r'^p/([a-zA-Z0-9]+)/$', views.paste_redirect, name='paste_redirect'),
     url(r'^([a-zA-Z0-9]+)/$', views.paste_detail, name='paste_detail'),
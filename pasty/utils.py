@@ -1,17 +1,33 @@
+import Queue
+import hashlib
 import io
 import os.path
+import re
 import string
+import threading
 
 import pygments
 from google.appengine.api import users
 from pygments import formatters
 from pygments import lexers
 from pygments import styles
+from pygments.token import STANDARD_TYPES
 from pygments.util import ClassNotFound
 
+from . import analysis
+from . import instrumentation
+from . import tokens
+
 
 PYGMENTS_STYLE = 'autumn'
 
+#: The most lines and characters shown in a paste's preview.
+SUMMARY_LINES = 10
+SUMMARY_CHARS = 10 * 256
+
+#: Blank lines at the start of content, which previews skip.
+BLANK_LINES_RE = re.compile(r'(?:[^\S\n]*\n)*')
+
 
 def get_current_user_email():
     user = users.get_current_user()
@@ -77,37 +93,114 @@ def ext_for_lexer(lexer):
     return ext
 
 
-def highlight_content(content, filename=None, config=None):
+def highlight_cssclass():
+    """Returns the CSS class for the element wrapping highlighted content."""
+    return 'highlight ' + highlight_css[PYGMENTS_STYLE][0]
+
+
+def highlight_content(content, filename=None, config=None, digest=None):
     """Chooses a lexer and applies code highlighting. If filename is None then
-    the language is guessed from the content.
+    the language is guessed from the content. Long or slow content is shown
+    as plain text, see tokens.get_tokens(). digest is the content's
+    tokens.content_hash(), if you already have it.
 
     Returns a pair of (lexer, content).
     """
-    lexer = choose_lexer(content, filename=filename, config=config)
-
-    style_class = highlight_css[PYGMENTS_STYLE][0]
-    cssclass = 'highlight ' + style_class
-    formatter = formatters.HtmlFormatter(style=PYGMENTS_STYLE, cssclass=cssclass)
-    highlighted = pygments.highlight(content, lexer, formatter)
+    with instrumentation.timer('pygments'):
+        lexer = choose_lexer(content, filename=filename, config=config)
+        stream = tokens.lex(content, lexer, filename=filename, digest=digest)
+        highlighted = format_html(stream)
 
     return lexer, highlighted
 
 
-def summarize_content(content, **kwargs):
-    """Summarizes and adds code highlighting to text.
+def format_html(stream):
+    """Returns highlighted HTML for (<token type>, <text>) pairs, such as a
+    tokens.TokenStream.
+    """
+    formatter = formatters.HtmlFormatter(style=PYGMENTS_STYLE, cssclass=highlight_cssclass())
 
-    Returns a pair of (lexer, summary).
+    return pygments.format(stream, formatter)
+
+
+def token_css_class(ttype):
+    """Returns the short CSS class Pygments uses for a token type, like 'nf'
+    for Token.Name.Function.
+    """
+    suffix = ''
+    css_class = STANDARD_TYPES.get(ttype)
+
+    while css_class is None:
+        suffix = ttype[-1] + suffix
+        ttype = ttype.parent
+        css_class = STANDARD_TYPES.get(ttype)
+
+    return css_class + suffix
+
+
+def tokenize_content(content, filename=None, config=None, digest=None, lexer=None):
+    """Chooses a lexer like highlight_content(), for highlighting in the
+    browser. Pass a lexer to use it rather than choosing one.
+
+    Returns a pair of (lexer, tokens). tokens is a dict with a list of CSS
+    classes, and a flat list of [<class index>, <text>, ...] where runs of
+    text with the same class are joined together.
     """
-    lines = 10
-    max_summary_size = 10 * 256
-    content = content[:max_summary_size]
+    classes = []
+    class_ids = {}
+    runs = []
+
+    with instrumentation.timer('pygments'):
+        if lexer is None:
+            lexer = choose_lexer(content, filename=filename, config=config)
+
+        for ttype, text in tokens.lex(content, lexer, filename=filename, digest=digest):
+            css_class = token_css_class(ttype)
 
-    summary = u'\n'.join(content.strip().splitlines()[:lines]).strip()
-    lexer, summary = highlight_content(summary, **kwargs)
+            if css_class not in class_ids:
+                class_ids[css_class] = len(classes)
+                classes.append(css_class)
+
+            class_id = class_ids[css_class]
+
+            if runs and runs[-2] == class_id:
+                runs[-1] += text
+            else:
+                runs.extend([class_id, text])
+
+    return lexer, {'classes': classes, 'tokens': runs}
+
+
+def summarize_content(content, filename=None, config=None):
+    """Summarizes and adds code highlighting to text. Only the start of the
+    content is lexed, see summary_prefix(), so the cost doesn't grow with
+    the size of the file. The tokens aren't cached, showing the file in full
+    lexes and caches the whole content.
+
+    Returns a pair of (lexer, summary).
+    """
+    with instrumentation.timer('pygments'):
+        lexer = choose_lexer(content, filename=filename, config=config)
+        prefix = summary_prefix(content)
+        stream = tokens.TokenStream.from_tokens(
+            tokens.get_tokens(prefix, lexer, filename=filename))
+        summary = format_html(stream.summary(SUMMARY_LINES, SUMMARY_CHARS))
 
     return lexer, summary
 
 
+def summary_prefix(content):
+    """Returns the start of the content which a summary is cut from: the
+    first SUMMARY_LINES lines after any blank ones, and no more than twice
+    SUMMARY_CHARS characters, so the lexer usually sees whole lines.
+    """
+    start = BLANK_LINES_RE.match(content).end()
+    prefix = content[start:start + 2 * SUMMARY_CHARS]
+    lines = analysis.lines_pattern(SUMMARY_LINES).match(prefix)
+
+    return prefix[:lines.end()] if lines else prefix
+
+
 def get_all_highlight_css():
     """Yields pairs of (<name>, <css-string>) for every Pygment HTML style."""
     for name in styles.get_all_styles():
@@ -123,9 +216,23 @@ def get_all_highlight_css():
 highlight_css = {name: (klass, style) for name, klass, style in get_all_highlight_css()}
 
 
-def highlight_styles():
-    """Returns the syntax highlighting CSS as an encoded string."""
-    content = u'\n\n'.join(css for _, css in highlight_css.values())
+#: Mapping of {<style-name>: <fingerprint>}, a hash of the style's CSS for
+#: URLs which can be cached for ever.
+highlight_css_fingerprints = {
+    name: hashlib.sha1(style.encode('utf-8')).hexdigest()[:12]
+    for name, (_, style) in highlight_css.items()
+}
+
+
+def highlight_styles(name=None):
+    """Returns the syntax highlighting CSS as an encoded string, for one
+    style or for all of them.
+    """
+    if name:
+        content = highlight_css[name][1]
+    else:
+        content = u'\n\n'.join(css for _, css in highlight_css.values())
+
     content = content.encode('utf-8')
 
     return content
@@ -146,6 +253,51 @@ def count_lines(content):
     return count
 
 
+def map_threaded(func, items, max_workers=8):
+    """Returns [func(item) for item in items], calling func from up to
+    max_workers threads. The first exception raised by func is re-raised.
+    """
+    items = list(items)
+
+    if len(items) < 2 or max_workers < 2:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    # Worker threads record API calls in this request's stats too.
+    stats = instrumentation.current()
+
+    for pair in enumerate(items):
+        queue.put(pair)
+
+    def worker():
+        with instrumentation.bind(stats):
+            while not errors:
+                try:
+                    n, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    results[n] = func(item)
+                except Exception as err:
+                    errors.append(err)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
 class BaseConverter(object):
     def __init__(self, digits):
         self.digits = digits
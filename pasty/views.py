@@ -4,18 +4,25 @@ import zipfile
 import jsonschema
 from djangae import environment
 from django.contrib import messages
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse as render
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.http import require_http_methods
-from google.appengine.ext import blobstore
 from google.appengine.ext import ndb
 
+from . import compression
 from . import index
+from . import profiling
+from . import storage
 from . import utils
 from . import validators
+from .middleware import sessionless
 from .forms import AdminForm, AdminLexersFormSet, PasteForm
-from .models import Paste, Star, get_starred_pastes
+from .models import (
+    LexerConfig, Paste, Star, get_starred_pastes, get_starred_pastes_async, highlight_files,
+    prefetch_forks)
 
 
 def home(request):
@@ -30,10 +37,11 @@ def paste_list(request):
     /?author=jeff@example.com - finds pastes by jeff@example.com
     /?q=foo - finds pastes containing the word 'foo'
     """
+    prefetch_starred_pastes(request)
+
     page = request.GET.get('p')
     terms = index.build_query(request.GET)
-    query = u' '.join(term for term, label, param in terms).encode('utf-8')
-    pastes = index.search_pastes(query, page)
+    pastes = index.list_pastes(terms, page)
     tags = [label for term, label, param in terms]
     page_title = u'Pastes ' + u', '.join(tags)
 
@@ -47,6 +55,7 @@ def paste_list(request):
     return render(request, 'pasty/paste_list.html', context)
 
 
+@sessionless
 def paste_redirect(request, paste_code):
     """Redirect from old peelings links."""
     paste_id = utils.base62.decode(paste_code)
@@ -55,22 +64,72 @@ def paste_redirect(request, paste_code):
     return url
 
 
+def prefetch_starred_pastes(request):
+    """Starts fetching the user's starred pastes for the sidebar, so it runs
+    alongside the view's own calls. See context_processors.pasty.
+    """
+    request.starred_pastes_future = get_starred_pastes_async(request.user_email)
+
+
 def paste_detail(request, paste_id):
-    paste = Paste.get_or_404(paste_id)
+    # Start everything that doesn't depend on the paste, then wait.
+    paste_future = Paste.get_or_404_async(paste_id)
+    starred_future = Star.get_for_author_async(request.user_email, paste_id)
+    config_future = LexerConfig.get_config_async()
+    prefetch_starred_pastes(request)
+
+    paste = paste_future.get_result()
+    prefetch_forks([paste])
+
+    config = config_future.get_result()
+    # With ?render=client the browser highlights files using the tokens API.
+    render_client = request.GET.get('render') == 'client'
+
+    if render_client:
+        files = [(pasty_file, tokens_url(paste, pasty_file, config)) for pasty_file in paste.files]
+    else:
+        files = zip(paste.files, highlight_files(paste.files, config))
+        # Compressed copies of the markup are cached next to it, see
+        # middleware.CompressionMiddleware.
+        request.deflated_fragments = [
+            (markup.encode('utf-8'), pasty_file.deflated_cache_key(config))
+            for pasty_file, markup in files]
 
-    starred = Star.query(Star.author==request.user_email, Star.paste==paste.key).get()
+    starred = starred_future.get_result()
 
     context = {
+        'files': files,
         'page_title': paste.filename,
         'paste': paste,
+        'render_client': render_client,
         'starred': starred,
     }
 
     return render(request, 'pasty/paste_detail.html', context)
 
 
+def tokens_url(paste, pasty_file, config):
+    """Returns the tokens API URL for a file. It includes the render version,
+    so the response can be cached for ever.
+    """
+    url = reverse('api_paste_tokens', args=[paste.key.id(), pasty_file.relative_path])
+
+    return url + '?v=' + pasty_file.render_version(config)
+
+
+def get_file_or_404(paste, relative_path):
+    for pasty_file in paste.files:
+        if pasty_file.relative_path == relative_path:
+            return pasty_file
+
+    raise Http404
+
+
+@sessionless
 def paste_download(request, paste_id):
-    """Returns a zip with all the files."""
+    """Returns a zip with all the files. Gzipped files are added without
+    decompressing them, since zip and gzip both use deflate.
+    """
     paste = Paste.get_or_404(paste_id)
 
     filename = paste.filename.encode('latin-1') + '.zip'
@@ -82,25 +141,44 @@ def paste_download(request, paste_id):
         for pasty_file in paste.files:
             name = pasty_file.filename
 
-            with pasty_file.open() as fh:
-                archive.writestr(name, fh.read())
+            with pasty_file.open(raw=True) as fh:
+                data = fh.read()
+
+            if pasty_file.encoding == compression.GZIP:
+                deflated, crc, size = compression.split_gzip(data)
+                compression.write_deflated(archive, name, deflated, crc, size)
+            else:
+                archive.writestr(name, data)
 
     return response
 
 
+@sessionless
 def paste_raw(request, paste_id, relative_path):
-    """Serve a file in Google Cloud Storage using the blobstore API."""
+    """Serve a file. Files which aren't inline are served by the storage
+    backend, e.g. with the blobstore API for Google Cloud Storage.
+    """
     paste = Paste.get_or_404(paste_id)
-
-    for pasty_file in paste.files:
-        if pasty_file.relative_path == relative_path:
-            break
+    pasty_file = get_file_or_404(paste, relative_path)
+
+    # Gzipped content is sent as it is stored, if the client accepts it.
+    accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    raw = bool(pasty_file.encoding) and compression.accepts(accept_encoding, pasty_file.encoding)
+
+    if pasty_file.is_inline:
+        with pasty_file.open(raw=raw) as fh:
+            response = HttpResponse(fh.read(), content_type=pasty_file.content_type)
+    elif pasty_file.encoding and not raw:
+        # Decompressed as it is streamed.
+        response = FileResponse(pasty_file.open(), content_type=pasty_file.content_type)
     else:
-        raise Http404
+        response = storage.get_storage().serve(pasty_file.path, pasty_file.content_type)
+
+    if raw:
+        response['Content-Encoding'] = pasty_file.encoding
 
-    blob_key = blobstore.create_gs_key('/gs' + pasty_file.bucket_path())
-    response = HttpResponse(content_type=pasty_file.content_type)
-    response[blobstore.BLOB_KEY_HEADER] = str(blob_key)
+    if pasty_file.encoding:
+        patch_vary_headers(response, ('Accept-Encoding',))
 
     return response
 
@@ -111,6 +189,8 @@ def paste_create(request):
     Add ?fork=xyz to a GET request and the initial form will have an existing
     Paste's contents.
     """
+    prefetch_starred_pastes(request)
+
     fork_id = request.GET.get('fork')
     fork = Paste.get_by_id(int(fork_id)) if fork_id else None
 
@@ -154,6 +234,7 @@ def paste_create(request):
     return render(request, 'pasty/paste_form.html', context)
 
 
+@sessionless
 def api_star_list(request):
     """Show what pastes the current user has starred (if any)."""
     if not request.user_email:
@@ -203,7 +284,7 @@ def api_star_delete(request):
     except Http404:
         return JsonResponse({'error': 'Does not exist'}, status=400)
 
-    star_id = u'%s/%s' % (request.user_email, paste.key.id())
+    star_id = Star.make_id(request.user_email, paste.key.id())
     star_key = ndb.Key(Star, star_id)
     star_key.delete()
 
@@ -215,17 +296,20 @@ def api_star_delete(request):
     return JsonResponse(result)
 
 
+@sessionless
 def api_paste_list(request):
     if request.method == 'POST':
         return api_paste_create(request)
 
     page = request.GET.get('p')
     terms = index.build_query(request.GET)
-    query = u' '.join(term for term, label, param in terms).encode('utf-8')
-    pastes = index.search_pastes(query, page)
+    pastes = index.get_pastes(terms, page)
 
     if pastes.has_next():
-        next_page = '%s?p=%s' % (request.path, pastes.next_page_number())
+        # Keep the search terms, the next page cursor only makes sense with them.
+        params = request.GET.copy()
+        params['p'] = pastes.next_page_number()
+        next_page = '%s?%s' % (request.path, params.urlencode())
         next_page = request.build_absolute_uri(next_page)
     else:
         next_page = None
@@ -238,6 +322,7 @@ def api_paste_list(request):
     return JsonResponse(result)
 
 
+@sessionless
 def api_paste_detail(request, paste_id):
     try:
         paste = Paste.get_or_404(paste_id)
@@ -284,6 +369,58 @@ def api_paste_create(request):
     return JsonResponse(result, status=status)
 
 
+@sessionless
+def api_paste_tokens(request, paste_id, relative_path):
+    """Returns the highlighting tokens for a file, for the browser to render.
+    See utils.tokenize_content() for the format.
+    """
+    try:
+        paste = Paste.get_or_404(paste_id)
+        pasty_file = get_file_or_404(paste, relative_path)
+    except Http404:
+        return JsonResponse({'error': 'File does not exist'}, status=404)
+
+    config = LexerConfig.get_config()
+    version = pasty_file.render_version(config)
+    # The compressed JSON is cached, rather than compressed for each response.
+    encoding = compression.accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    content = pasty_file.content_tokens(config, encoding=encoding)
+    response = HttpResponse(content, content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+        response['ETag'] = '"%s-%s"' % (version, encoding)
+    else:
+        response['ETag'] = '"%s"' % version
+
+    if request.GET.get('v') == version:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'public, max-age=300'
+
+    return response
+
+
+@sessionless
+def highlight_css(request, name, fingerprint):
+    """Returns the CSS for one highlighting style. The URL includes a hash of
+    the CSS, so the response can be cached for ever.
+    """
+    if name not in utils.highlight_css:
+        raise Http404
+
+    response = HttpResponse(utils.highlight_styles(name), content_type='text/css')
+    response['ETag'] = '"%s"' % utils.highlight_css_fingerprints[name]
+
+    if fingerprint == utils.highlight_css_fingerprints[name]:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'public, max-age=300'
+
+    return response
+
+
 @environment.task_or_admin_only
 def admin(request):
     """For firing migration tasks."""
@@ -329,3 +466,33 @@ def admin_lexers(request):
     }
 
     return render(request, 'pasty/admin_lexers.html', context)
+
+
+@environment.task_or_admin_only
+def admin_profiles(request):
+    """Lists profiles saved by pasty.middleware.ProfilerMiddleware."""
+    context = {
+        'profiles': profiling.list_profiles(),
+        'section': 'admin',
+        'page_title': u'Profiles',
+    }
+
+    return render(request, 'pasty/admin_profiles.html', context)
+
+
+@environment.task_or_admin_only
+def admin_profile_download(request, name):
+    """Download a saved profile."""
+    try:
+        fh = profiling.open_profile(name)
+    except IOError:
+        raise Http404
+
+    with fh:
+        content = fh.read()
+
+    header = 'attachment; filename="%s"' % name
+    response = HttpResponse(content, content_type='application/octet-stream')
+    response['Content-disposition'] = header
+
+    return response
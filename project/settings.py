@@ -20,12 +20,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pasty.middleware.RequestStatsMiddleware',
+    'pasty.middleware.ProfilerMiddleware',
+    'pasty.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    # Sessions, messages and CSRF are skipped for views marked with
+    # pasty.middleware.sessionless.
+    'pasty.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    'pasty.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'session_csrf.CsrfMiddleware',
+    'pasty.middleware.CsrfMiddleware',
     'pasty.middleware.GoogleUserMiddleware',
     'pasty.middleware.PastyVersionMiddleware',
     'pasty.middleware.CSPHostnameMiddleware',
@@ -42,7 +47,7 @@ TEMPLATES = [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
                 'django.contrib.messages.context_processors.messages',
-                'session_csrf.context_processor',
+                'pasty.context_processors.csrf',
                 'pasty.context_processors.pasty',
             ],
             'loaders': ['django.template.loaders.app_directories.Loader'],
@@ -72,7 +77,7 @@ STATIC_URL = '/static/'
 # The '{host}' shortcut is handled by pasty.middleware.CSPHostnameMiddleware.
 CSP_DEFAULT_SRC = ["'none'"]
 CSP_CONNECT_SRC = ['{host}/api/v1/']
-CSP_STYLE_SRC = ['{host}/static/styles.css']
+CSP_STYLE_SRC = ['{host}/static/styles.css', '{host}/styles/']
 CSP_SCRIPT_SRC = ['{host}/static/app.min.js', '{host}/static/src/']
 CSP_IMG_SRC = ['{host}/static/pic/', '{host}/favicon.ico']
 CSP_FONT_SRC = ['{host}/static/fonts/']
@@ -80,6 +85,32 @@ CSP_FONT_SRC = ['{host}/static/fonts/']
 # Results per page.
 PAGE_SIZE = 10
 
+# Fraction of requests to record timings and API calls for, see
+# pasty.middleware.RequestStatsMiddleware.
+PASTY_STATS_SAMPLE_RATE = 0.01 if ON_PROD else 1.0
+
+# Files no bigger than this (in bytes, after compression) are stored on the
+# Paste entity rather than in Cloud Storage. The second setting limits the
+# total for all of a paste's files.
+PASTY_INLINE_MAX_BYTES = 8 * 1024
+PASTY_INLINE_PASTE_MAX_BYTES = 256 * 1024
+
+# Where file content is stored, see pasty.storage. LocalStorage keeps files
+# under PASTY_LOCAL_STORAGE_ROOT, for development and benchmarks.
+PASTY_STORAGE = 'pasty.storage.GCSStorage'
+PASTY_LOCAL_STORAGE_ROOT = os.path.join(BASE_DIR, 'storage')
+
+# Threads for reading and highlighting a paste's files.
+PASTY_WORKER_THREADS = 8
+
+# Limits for syntax highlighting, in characters and seconds. Content over
+# the limits is shown as plain text.
+PASTY_HIGHLIGHT_MAX_CHARS = 512 * 1024
+PASTY_HIGHLIGHT_TIME_LIMIT = 2.0
+
+# Markdown files longer than this (in characters) are shown as plain text.
+PASTY_MARKDOWN_MAX_CHARS = 256 * 1024
+
 DATABASES = {
     'default': {'ENGINE': 'djangae.db.backends.appengine'},
 }
@@ -96,6 +96,46 @@ $(document).ready(function() {
 	$('.paste-form__add-file').click(addFileInputs);
 
 
+	/* Highlighting in the browser, for pages shown with ?render=client. The
+	 * tokens are a flat list of [<class index>, <text>, ...]. */
+	function escapeHtml(text) {
+		return text
+			.replace(/&/g, '&amp;')
+			.replace(/</g, '&lt;')
+			.replace(/>/g, '&gt;')
+			.replace(/"/g, '&quot;')
+			.replace(/'/g, '&#39;');
+	}
+
+	function renderTokens(data) {
+		var parts = ['<div class="' + data.cssclass + '"><pre><span></span>'],
+			cssClass,
+			text,
+			idx;
+
+		for (idx = 0; idx < data.tokens.length; idx += 2) {
+			cssClass = data.classes[data.tokens[idx]];
+			text = escapeHtml(data.tokens[idx + 1]);
+			parts.push(cssClass ? '<span class="' + cssClass + '">' + text + '</span>' : text);
+		}
+
+		parts.push('</pre></div>');
+
+		return parts.join('');
+	}
+
+	$('.paste__tokens').each(function() {
+		var el = this;
+
+		$.get({
+			url: el.dataset.tokensUrl,
+			success: function(data) {
+				$(el).html(renderTokens(data));
+			}
+		});
+	});
+
+
 	/* Dismiss notifications (admins). */
 	$('.notification').on('click', '.delete', function() {
 		$(this).parent('.notification').remove();